@@ -71,7 +71,8 @@ def index():
 		'server/<id,hostname,ip>/config/get':'get HAProxy config from the server by id or hostname or ip',
 		'server/<id,hostname,ip>/config/send':'send HAProxy config to the server by id or hostname or ip. Has to have config header with config and action header for action after upload. Action header accepts next value: save, test, reload and restart. May be empty for just save',
 		'server/<id,hostname,ip>/config/add':'add section to the HAProxy config by id or hostname or ip. Has to have config header with section and action header for action after upload. Action header accepts next value: save, test, reload and restart. May be empty for just save',
-		'server/<id,hostname,ip>/log':'show HAProxy log by id or hostname or ip. May to have config next headers: rows(format INT) default: 10 grep, waf(if needs WAF log) deault: 0, start_hour(format: 24) default: 00, start_minut, end_hour(format: 24) default: 24, end_minut'
+		'server/<id,hostname,ip>/log':'show HAProxy log by id or hostname or ip. May to have config next headers: rows(format INT) default: 10 grep, waf(if needs WAF log) deault: 0, start_hour(format: 24) default: 00, start_minut, end_hour(format: 24) default: 24, end_minut. With the log collector enabled also frontend, backend, status, client_ip, min_time(ms)',
+		'server/<id,hostname,ip>/log/analytics':'show p50/p95/p99 latency, status histograms and error rates per frontend and backend and top talkers from HAProxy log. May to have config next headers: start_hour(format: 24) default: 00, start_minut, end_hour(format: 24) default: 24, end_minut'
 	}
 	return dict(help=data)
 	
@@ -172,6 +173,14 @@ def callback(id):
 	return api_funct.add_to_config(id)
 	
 	
+@route('/server/<id>/log/analytics', method=['GET', 'POST'])
+@route('/server/<id:int>/log/analytics', method=['GET', 'POST'])
+def callback(id):
+	if not check_login():
+		return dict(error=_error_auth)
+	return api_funct.log_analytics(id)
+	
+	
 @route('/server/<id>/log', method=['GET', 'POST'])
 @route('/server/<id:int>/log', method=['GET', 'POST'])
 def callback(id):
@@ -7,17 +7,20 @@ sys.path.append(os.path.join(sys.path[0], '/var/www/haproxy-wi/app/'))
 from bottle import route, run, template, hook, response, request, post
 import sql
 import funct
+import haproxy_sock
 
 
-def return_dict_from_out(id, out):
+def return_dict_from_out(id, serv, **kwargs):
 	data = {}
 	data[id] = {}
-	for k in out:
-		if "Ncat:" not in k:
+	try:
+		info = haproxy_sock.show_info(serv, port=kwargs.get('port'))
+	except OSError:
+		data[id] = {"error":"Can\'t connect to HAproxy"}
+	else:
+		for k in haproxy_sock.info_lines(info, ('Ver', 'CurrConns', 'Maxco', 'MB', 'Uptime:')):
 			k = k.split(':')
 			data[id][k[0]] = k[1].strip()
-		else:
-			data[id] = {"error":"Can\'t connect to HAproxy"}
 			
 	return data
 	
@@ -60,10 +63,9 @@ def get_status(id):
 		servers = check_permit_to_server(id)
 		
 		for s in servers:
-			cmd = 'echo "show info" |nc %s %s -w 1|grep -e "Ver\|CurrConns\|Maxco\|MB\|Uptime:"' % (s[2], sql.get_setting('haproxy_sock_port'))
+			ip = s[2]
 			
-		out = funct.subprocess_execute(cmd)
-		data = return_dict_from_out(id, out[0])
+		data = return_dict_from_out(id, ip)
 		
 	except:
 		data = {}
@@ -76,18 +78,14 @@ def get_status(id):
 def get_all_statuses():
 	data = {}
 	try:
-		servers = sql.select_servers()
 		login = request.headers.get('login')
-		sock_port = sql.get_setting('haproxy_sock_port')
-			
-		for s in servers:		
-			servers = sql.get_dick_permit(username=login)
+		servers = sql.get_dick_permit(username=login)
+		port = sql.get_setting('haproxy_sock_port')
 			
-		for s in servers:
-			cmd = 'echo "show info" |nc %s %s -w 1|grep -e "Ver\|CurrConns\|Maxco\|MB\|Uptime:"' % (s[2], sock_port)
-			data[s[2]] = {}	
-			out = funct.subprocess_execute(cmd)
-			data[s[2]] = return_dict_from_out(s[1], out[0])
+		for s, status in funct.fan_out(lambda s: return_dict_from_out(s[1], s[2], port=port), servers):
+			if isinstance(status, Exception):
+				status = {s[1]: {"error": "Can\'t connect to HAproxy"}}
+			data[s[2]] = status
 	except:
 		data = {"error":"Cannot find the server"}
 		return dict(error=data)
@@ -296,9 +294,31 @@ def show_log(id):
 		data[id] = {"error":"Cannot find the server"}
 		return dict(error=data)
 		
-	out = funct.show_haproxy_log(ip, rows=rows, waf=str(waf), grep=grep, hour=str(hour), minut=str(minut), hour1=str(hour1), minut1=str(minut1), html=0)
+	filters = dict((field, request.headers.get(field)) for field in ('frontend', 'backend', 'status', 'client_ip', 'min_time') if request.headers.get(field))
+	out = funct.show_haproxy_log(ip, rows=rows, waf=str(waf), grep=grep, hour=str(hour), minut=str(minut), hour1=str(hour1), minut1=str(minut1), html=0, **filters)
 	data = {id: out}
 
 	return dict(log=data)
+	
+	
+def log_analytics(id):
+	import loganalytics
+	data = {}
+	hour = request.headers.get('starthour') or '00'
+	minut = request.headers.get('startminut') or '00'
+	hour1 = request.headers.get('endhour') or '24'
+	minut1 = request.headers.get('endminut') or '00'
+
+	servers = check_permit_to_server(id)
+	if not servers:
+		data[id] = {"error":"Cannot find the server"}
+		return dict(error=data)
+	ip = servers[-1][2]
 		
-	
\ No newline at end of file
+	try:
+		data[id] = loganalytics.server_analytics(ip, hour=str(hour), minut=str(minut), hour1=str(hour1), minut1=str(minut1))
+	except (IOError, ValueError) as e:
+		data[id] = {"error":str(e)}
+		return dict(error=data)
+
+	return dict(log_analytics=data)
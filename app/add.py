@@ -4,8 +4,8 @@ import os
 import funct
 import sql
 import http.cookies
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('add.html')
 form = funct.form
 serv = form.getvalue('serv')
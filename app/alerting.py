@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-"
+import os
+import json
+import time
+import queue
+import threading
+
+# Alerts are queued and sent from a background thread. Messages to one channel
+# that arrive within digest_wait seconds go out as one digest, each channel may
+# get rate_limit messages per minute, failed sends are retried with backoff and
+# what is still pending on exit is spooled to disk and sent by the next process.
+digest_wait = 2
+rate_limit = 20
+max_backoff = 300
+max_attempts = 10
+max_message = 4000
+close_timeout = 10
+channels_ttl = 60
+
+
+class TelegramTransport:
+	name = 'telegram'
+
+	def __init__(self):
+		self.bots = {}
+
+	def channels(self, ip):
+		import sql
+		return [(telegram[1], telegram[2]) for telegram in sql.get_telegram_by_ip(ip) or []]
+
+	def send(self, channel, mess):
+		import telebot
+		from telebot import apihelper
+		import sql
+		token_bot, channel_name = channel
+		proxy = sql.get_setting('proxy')
+		if proxy is not None:
+			apihelper.proxy = {'https': proxy}
+		if token_bot not in self.bots:
+			self.bots[token_bot] = telebot.TeleBot(token=token_bot)
+		self.bots[token_bot].send_message(chat_id=channel_name, text=mess)
+
+
+class FileTransport:
+	"""
+	Appends alerts to a file instead of sending them, to test alerting offline
+	"""
+	name = 'file'
+
+	def __init__(self, path):
+		self.path = path
+
+	def channels(self, ip):
+		return [(self.path, ip)]
+
+	def send(self, channel, mess):
+		with open(channel[0], 'a') as f:
+			f.write(json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'ip': channel[1], 'message': mess}) + '\n')
+
+
+class WebhookTransport:
+	name = 'webhook'
+
+	def __init__(self, url):
+		self.url = url
+
+	def channels(self, ip):
+		return [(self.url, ip)]
+
+	def send(self, channel, mess):
+		import urllib.request
+		data = json.dumps({'ip': channel[1], 'text': mess}).encode('utf-8')
+		request = urllib.request.Request(channel[0], data=data, headers={'Content-Type': 'application/json'})
+		urllib.request.urlopen(request, timeout=10).close()
+
+
+def get_transport():
+	import sql
+	transport = sql.get_setting('alert_transport')
+	if transport == 'file':
+		return FileTransport(sql.get_setting('alert_transport_target'))
+	elif transport == 'webhook':
+		return WebhookTransport(sql.get_setting('alert_transport_target'))
+	return TelegramTransport()
+
+
+class Channel:
+	def __init__(self, messages=None, attempts=0):
+		self.messages = messages or []
+		self.attempts = attempts
+		self.retry_at = 0
+		self.tokens = rate_limit
+		self.refilled = time.time()
+
+	def refill(self, now):
+		self.tokens = min(rate_limit, self.tokens + (now - self.refilled) * rate_limit / 60.0)
+		self.refilled = now
+
+	def ready(self, now, flush=False):
+		if not self.messages or now < self.retry_at:
+			return False
+		self.refill(now)
+		if self.tokens < 1:
+			return False
+		return flush or now - self.messages[0][0] >= digest_wait
+
+
+def digest(messages):
+	"""
+	Return the digest of the first messages that fit in max_message and how many it holds,
+	the others stay queued for the next send
+	"""
+	count = 1
+	body = messages[0][1]
+	for created, mess in messages[1:]:
+		if len('%s alerts:\n%s\n%s' % (count + 1, body, mess)) > max_message:
+			break
+		body += '\n' + mess
+		count += 1
+	if count == 1:
+		return messages[0][1][:max_message], 1
+	return '%s alerts:\n%s' % (count, body), count
+
+
+class AlertDispatcher:
+	def __init__(self, spool_file, transport=None):
+		self.spool_file = spool_file
+		self.transport = transport or get_transport()
+		self.queue = queue.Queue()
+		self.channels = {}
+		self.ip_channels = {}
+		self.dirty = False
+		self.unspool()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def send(self, mess, ip=None):
+		self.queue.put((time.time(), ip, mess))
+
+	def get_channels(self, ip):
+		cached = self.ip_channels.get(ip)
+		if cached is None or time.time() - cached[0] > channels_ttl:
+			cached = (time.time(), [tuple(channel) for channel in self.transport.channels(ip)])
+			self.ip_channels[ip] = cached
+		return cached[1]
+
+	def add(self, item):
+		created, ip, mess = item
+		try:
+			channels = self.get_channels(ip)
+		except Exception as e:
+			channels = []
+			self.log('Cannot get alert channels for %s: %s' % (ip, e))
+		if not channels:
+			self.log("Can't send message. Add Telegram chanel before use alerting at this servers group: " + mess)
+		for channel in channels:
+			self.channels.setdefault(channel, Channel()).messages.append((created, mess))
+			self.dirty = True
+
+	def deliver(self, flush=False):
+		now = time.time()
+		for key, channel in list(self.channels.items()):
+			if not channel.ready(now, flush):
+				continue
+			messages = channel.messages
+			mess, count = digest(messages)
+			try:
+				self.transport.send(key, mess)
+			except Exception as e:
+				channel.attempts += 1
+				if channel.attempts >= max_attempts:
+					self.log('Dropped %s alerts after %s attempts: %s' % (len(messages), channel.attempts, e))
+					channel.messages, channel.attempts = [], 0
+				else:
+					channel.retry_at = now + min(2 ** channel.attempts, max_backoff)
+					self.log('Cannot send alert, retry in %s sec: %s' % (int(channel.retry_at - now), e))
+			else:
+				channel.tokens -= 1
+				channel.messages, channel.attempts = messages[count:], 0
+			self.dirty = True
+
+	def run(self):
+		closing = False
+		while True:
+			try:
+				item = self.queue.get(timeout=0.5)
+			except queue.Empty:
+				item = False
+			if item is None:
+				closing = time.time()
+			elif item:
+				self.add(item)
+			self.deliver(flush=bool(closing))
+			if self.dirty:
+				self.spool()
+			if closing and (not self.pending() or time.time() - closing > close_timeout):
+				return
+
+	def pending(self):
+		return [(key, channel) for key, channel in self.channels.items() if channel.messages]
+
+	def spool(self):
+		self.dirty = False
+		try:
+			if not self.pending():
+				if os.path.exists(self.spool_file):
+					os.remove(self.spool_file)
+				return
+			spool = [[list(key), channel.messages, channel.attempts] for key, channel in self.pending()]
+			with open(self.spool_file + '.tmp', 'w') as f:
+				json.dump({'transport': self.transport.name, 'channels': spool}, f)
+			os.replace(self.spool_file + '.tmp', self.spool_file)
+		except (IOError, OSError) as e:
+			self.log('Cannot spool alerts to %s: %s' % (self.spool_file, e))
+
+	def unspool(self):
+		try:
+			with open(self.spool_file, 'r') as f:
+				spool = json.load(f)
+		except (IOError, ValueError):
+			return
+		if spool.get('transport') != self.transport.name:
+			return
+		for key, messages, attempts in spool.get('channels', []):
+			channel = self.channels.setdefault(tuple(key), Channel(attempts=attempts))
+			channel.messages += [tuple(m) for m in messages]
+
+	def log(self, mess):
+		import funct
+		funct.logging('localhost', ' ' + mess, alerting=1)
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join(close_timeout + 1)
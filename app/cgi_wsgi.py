@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-"
+import os
+import sys
+import io
+import cgi
+import threading
+import traceback
+import contextlib
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+if app_dir not in sys.path:
+	sys.path.insert(0, app_dir)
+os.chdir(app_dir)
+
+import funct
+import sql
+import create_db
+
+pages = ('add.py', 'config.py', 'edit.py', 'ha.py', 'hapservers.py', 'keepalivedconfig.py', 'lists.py', 'login.py',
+		'logs.py', 'metrics.py', 'options.py', 'overview.py', 'sections.py', 'servers.py', 'sql.py', 'users.py',
+		'versions.py', 'viewlogs.py', 'viewsttats.py', 'waf.py')
+cgi_vars = ('REQUEST_METHOD', 'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH', 'SCRIPT_NAME', 'PATH_INFO',
+			'REMOTE_ADDR', 'REMOTE_PORT', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'HTTPS', 'REQUEST_URI')
+compiled = {}
+# Page scripts share module globals, os.environ and sys.stdout, so one request runs at a time per process
+lock = threading.Lock()
+base_environ = dict(os.environ)
+
+create_db.pool_connections = True
+
+
+def get_page(environ):
+	name = os.path.basename(environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''))
+	if name not in pages:
+		return None
+	path = os.path.join(app_dir, name)
+	mtime = os.path.getmtime(path)
+	if name not in compiled or compiled[name][0] != mtime:
+		with open(path, 'r', encoding='utf-8') as f:
+			compiled[name] = (mtime, compile(f.read(), path, 'exec'))
+
+	return path, compiled[name][1]
+
+
+def cgi_environ(environ):
+	env = dict(base_environ)
+	for key, value in environ.items():
+		if key in cgi_vars or key.startswith('HTTP_'):
+			env[key] = str(value)
+	env['GATEWAY_INTERFACE'] = 'CGI/1.1'
+
+	return env
+
+
+def parse_output(output):
+	head, sep, body = output.partition('\n\n')
+	if not sep or ':' not in head.split('\n')[0]:
+		return '200 OK', [('Content-type', 'text/html')], output
+
+	status = '200 OK'
+	headers = []
+	for line in head.split('\n'):
+		line = line.rstrip('\r')
+		if ':' not in line:
+			continue
+		key, value = line.split(':', 1)
+		if key.lower() == 'status':
+			status = value.strip()
+		else:
+			headers.append((key.strip(), value.strip()))
+			if key.lower() == 'location' and status == '200 OK':
+				status = '302 Found'
+
+	return status, headers, body
+
+
+def run_page(environ, path, code):
+	env = cgi_environ(environ)
+	out = io.StringIO()
+
+	os.environ.clear()
+	os.environ.update(env)
+	funct.form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=env)
+	funct.serv = funct.form.getvalue('serv')
+	sql.form = funct.form
+	try:
+		with contextlib.redirect_stdout(out):
+			try:
+				exec(code, {'__name__': '__main__', '__file__': path, '__builtins__': __builtins__})
+			except SystemExit:
+				pass
+	finally:
+		os.environ.clear()
+		os.environ.update(base_environ)
+		# Writes through the sql module invalidate its caches themselves, the sql.py page
+		# runs its own copy of the module, so its writes are not seen by the shared caches.
+		# Changes from other processes show up when the cache TTLs end.
+		if os.path.basename(path) == 'sql.py':
+			sql.settings_cache_version += 1
+			sql.invalidate_permit_cache()
+
+	return out.getvalue()
+
+
+def application(environ, start_response):
+	page = get_page(environ)
+	if page is None:
+		start_response('404 Not Found', [('Content-type', 'text/plain')])
+		return [b'Not Found']
+
+	with lock:
+		try:
+			output = run_page(environ, *page)
+		except Exception:
+			environ['wsgi.errors'].write(traceback.format_exc())
+			start_response('500 Internal Server Error', [('Content-type', 'text/plain')])
+			return [b'Internal Server Error']
+
+	status, headers, body = parse_output(output)
+	start_response(status, headers)
+	return [body.encode('utf-8')]
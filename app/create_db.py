@@ -2,6 +2,7 @@
 import cgi
 import os
 import sys
+import threading
 import funct
 
 mysql_enable = funct.get_config_var('mysql', 'enable')
@@ -48,15 +49,81 @@ def check_db():
 			return False
 			con.close()
 			
+pool_connections = False
+connections = threading.local()
+# A pooled MySQL connection idle longer than this is pinged before use
+ping_interval = 30
+
+
+class PooledConnection:
+	"""
+	Keeps the connection of the current thread open when a caller closes it.
+	Ending the transaction on close makes the next request see fresh data.
+	"""
+	def __init__(self, con):
+		self.con = con
+		
+	def __getattr__(self, name):
+		return getattr(self.con, name)
+		
+	def close(self):
+		try:
+			self.con.rollback()
+		except sqltool.Error:
+			connections.con = None
+			connections.cur = None
+			
+			
+class PooledCursor:
+	"""
+	The cursor of the current thread, shared by all queries on its connection,
+	so it is not closed by callers either.
+	"""
+	def __init__(self, cur):
+		self.cur = cur
+		
+	def __getattr__(self, name):
+		return getattr(self.cur, name)
+		
+	def __iter__(self):
+		return iter(self.cur)
+		
+	def close(self):
+		pass
+			
+			
+def connect():
+	if mysql_enable == '0':
+		return sqltool.connect(db, isolation_level=None, cached_statements=256)  
+	else:
+		return sqltool.connect(user=mysql_user, password=mysql_password,
+								host=mysql_host,
+								database=mysql_db)	
+			
+			
 def get_cur():
 	try:
-		if mysql_enable == '0':
-			con = sqltool.connect(db, isolation_level=None)  
+		if pool_connections:
+			import time
+			con = getattr(connections, 'con', None)
+			idle = time.time() - getattr(connections, 'used', 0)
+			if con is None or (mysql_enable == '1' and idle > ping_interval and not con.is_connected()):
+				con = connect()
+				connections.con = con
+				connections.cur = None
+			connections.used = time.time()
+			cur = getattr(connections, 'cur', None)
+			if cur is None:
+				if mysql_enable == '1':
+					cur = con.cursor(buffered=True)
+				else:
+					cur = con.cursor()
+				connections.cur = cur
+			cur = PooledCursor(cur)
+			con = PooledConnection(con)
 		else:
-			con = sqltool.connect(user=mysql_user, password=mysql_password,
-									host=mysql_host,
-									database=mysql_db)	
-		cur = con.cursor()
+			con = connect()
+			cur = con.cursor()
 	except sqltool.Error as e:
 		print("An error occurred:", e)
 	else:
@@ -457,6 +524,159 @@ def update_db_v_3_8_1(**kwargs):
 	cur.close() 
 	con.close()
 	
+def update_db_v_3_8_2(**kwargs):
+	con, cur = get_cur()
+	sql = """CREATE TABLE IF NOT EXISTS `metrics_rollup` (`serv` varchar(64), `period` INTEGER, `bucket` INTEGER, 
+		sess_sum INTEGER, sess_max INTEGER, con_sum INTEGER, con_max INTEGER, ssl_sum INTEGER, `count` INTEGER, 
+		PRIMARY KEY(`serv`, `period`, `bucket`)); """
+	try:    
+		cur.execute(sql)
+		con.commit()
+	except sqltool.Error as e:
+		if kwargs.get('silent') != 1:
+			print("An error occurred:", e)
+		return False
+	else:
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2')
+		return True
+	cur.close() 
+	con.close()
+	
+	
+def already_applied(statement, e):
+	"""
+	True for errors of a statement that was run before: an existing column, index or setting
+	"""
+	statement = statement.lower()
+	error = str(e).lower()
+	if statement.startswith('insert'):
+		return 'duplicate entry' in error or 'unique constraint failed: settings' in error
+	return 'duplicate column' in error or 'duplicate key name' in error or 'already exists' in error
+	
+	
+def run_statements(sql, **kwargs):
+	"""
+	Run the statements of a migration, return False if one of them failed
+	"""
+	con, cur = get_cur()
+	applied = True
+	for i in sql:
+		try:
+			cur.execute(i)
+			con.commit()
+		except sqltool.Error as e:
+			if not already_applied(i, e):
+				applied = False
+				if kwargs.get('silent') != 1:
+					print("An error occurred:", e)
+				funct.logging('localhost', ' Migration statement failed: %s %s' % (i, e), haproxywi=1)
+	cur.close() 
+	con.close()
+	return applied
+	
+	
+def update_db_v_3_8_2_1(**kwargs):
+	sql = []
+	sql.append("ALTER TABLE `metrics` ADD COLUMN `ts` INTEGER;")
+	sql.append("ALTER TABLE `waf_metrics` ADD COLUMN `ts` INTEGER;")
+	if mysql_enable == '1':
+		sql.append("UPDATE `metrics` SET `ts` = UNIX_TIMESTAMP(`date`) WHERE `ts` IS NULL;")
+		sql.append("UPDATE `waf_metrics` SET `ts` = UNIX_TIMESTAMP(`date`) WHERE `ts` IS NULL;")
+		sql.append("CREATE INDEX `metrics_serv_ts` ON `metrics` (`serv`, `ts`);")
+		sql.append("CREATE INDEX `metrics_ts` ON `metrics` (`ts`);")
+		sql.append("CREATE INDEX `waf_metrics_serv_ts` ON `waf_metrics` (`serv`, `ts`);")
+		sql.append("CREATE INDEX `waf_metrics_ts` ON `waf_metrics` (`ts`);")
+		# The tables have no key, so one row of each duplicate is kept aside, the copies are deleted
+		# and the row is put back. It keeps the latest exp, like the newest rowid kept on sqlite.
+		for table, column in (('uuid', 'uuid'), ('token', 'token')):
+			sql.append("DROP TEMPORARY TABLE IF EXISTS `%s_keep`;" % table)
+			sql.append("CREATE TEMPORARY TABLE `{0}_keep` AS SELECT max(`user_id`) AS `user_id`, `{1}`, max(`exp`) AS `exp` FROM `{0}` GROUP BY `{1}` HAVING count(*) > 1;".format(table, column))
+			sql.append("DELETE `{0}` FROM `{0}` JOIN `{0}_keep` ON `{0}`.`{1}` = `{0}_keep`.`{1}`;".format(table, column))
+			sql.append("INSERT INTO `{0}` (`user_id`, `{1}`, `exp`) SELECT `user_id`, `{1}`, `exp` FROM `{0}_keep`;".format(table, column))
+			sql.append("DROP TEMPORARY TABLE `%s_keep`;" % table)
+		sql.append("CREATE UNIQUE INDEX `uuid_uuid` ON `uuid` (`uuid`);")
+		sql.append("CREATE UNIQUE INDEX `token_token` ON `token` (`token`);")
+	else:
+		sql.append("UPDATE `metrics` SET `ts` = CAST(strftime('%s', `date`, 'utc') AS INTEGER) WHERE `ts` IS NULL;")
+		sql.append("UPDATE `waf_metrics` SET `ts` = CAST(strftime('%s', `date`, 'utc') AS INTEGER) WHERE `ts` IS NULL;")
+		sql.append("CREATE INDEX IF NOT EXISTS `metrics_serv_ts` ON `metrics` (`serv`, `ts`);")
+		sql.append("CREATE INDEX IF NOT EXISTS `metrics_ts` ON `metrics` (`ts`);")
+		sql.append("CREATE INDEX IF NOT EXISTS `waf_metrics_serv_ts` ON `waf_metrics` (`serv`, `ts`);")
+		sql.append("CREATE INDEX IF NOT EXISTS `waf_metrics_ts` ON `waf_metrics` (`ts`);")
+		sql.append("DELETE FROM `uuid` WHERE rowid NOT IN (SELECT max(rowid) FROM `uuid` GROUP BY `uuid`);")
+		sql.append("DELETE FROM `token` WHERE rowid NOT IN (SELECT max(rowid) FROM `token` GROUP BY `token`);")
+		sql.append("CREATE UNIQUE INDEX IF NOT EXISTS `uuid_uuid` ON `uuid` (`uuid`);")
+		sql.append("CREATE UNIQUE INDEX IF NOT EXISTS `token_token` ON `token` (`token`);")
+	
+	if run_statements(sql, **kwargs):
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2.1')
+		return True
+	return False
+	
+	
+def update_db_v_3_8_2_2(**kwargs):
+	sql = list()
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('fan_out_workers', '20', 'main', 'How many servers are polled in parallel');")
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('fan_out_timeout', '15', 'main', 'Timeout for one server while polling servers in parallel, in seconds');")
+	
+	if run_statements(sql, **kwargs):
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2.2')
+		return True
+	return False
+	
+	
+def update_db_v_3_8_2_3(**kwargs):
+	sql = list()
+	if mysql_enable == '1':
+		sql.append("CREATE INDEX `uuid_user_id` ON `uuid` (`user_id`);")
+		sql.append("CREATE INDEX `token_user_id` ON `token` (`user_id`);")
+	else:
+		sql.append("CREATE INDEX IF NOT EXISTS `uuid_user_id` ON `uuid` (`user_id`);")
+		sql.append("CREATE INDEX IF NOT EXISTS `token_user_id` ON `token` (`user_id`);")
+	
+	if run_statements(sql, **kwargs):
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2.3')
+		return True
+	return False
+	
+	
+def update_db_v_3_8_2_4(**kwargs):
+	sql = list()
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('log_collector_enable', '0', 'logs', 'Collect HAProxy logs into the local store and search them there instead of over SSH');")
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('log_store_retention', '14', 'logs', 'How many days collected HAProxy logs are kept');")
+	
+	if run_statements(sql, **kwargs):
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2.4')
+		return True
+	return False
+	
+	
+def update_db_v_3_8_2_5(**kwargs):
+	sql = list()
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('alert_transport', 'telegram', 'main', 'How alerts are delivered: telegram, webhook or file');")
+	sql.append("INSERT  INTO settings (param, value, section, `desc`) values('alert_transport_target', '', 'main', 'URL for webhook alerts or path of the file for file alerts');")
+	
+	if run_statements(sql, **kwargs):
+		if kwargs.get('silent') != 1:
+			print('DB was update to 3.8.2.5')
+		return True
+	return False
+	
+	
+def run_update(update, **kwargs):
+	import time
+	start = time.time()
+	result = update(**kwargs)
+	if kwargs.get('silent') != 1:
+		print('%s took %.3f sec' % (update.__name__, time.time() - start))
+	return result
+	
+	
 def update_ver(**kwargs):
 	con, cur = get_cur()
 	sql = """update version set version = '3.8.2'; """
@@ -497,44 +717,104 @@ def update_to_hash():
 						print("An error occurred:", e)
 						
 			
-def update_all():	
-	update_db_v_31()
-	update_db_v_3_2()
-	update_db_v_3_21()
-	update_db_v_3_2_3()
-	update_db_v_3_2_8()
-	update_db_v_3_31()
-	update_db_v_3_4()
-	update_db_v_3_4_1()
-	update_db_v_3_4_5_2()
-	if funct.check_ver() is None:
-		update_db_v_3_4_5_22()
-	update_db_v_3_4_7()
-	update_db_v_3_4_9_5()
-	update_db_v_3_5_3()
-	update_db_v_3_8_1()
-	update_to_hash()
-	update_ver()
+migrations = [update_db_v_31, update_db_v_3_2, update_db_v_3_21, update_db_v_3_2_3, update_db_v_3_2_8, update_db_v_3_31, 
+			update_db_v_3_4, update_db_v_3_4_1, update_db_v_3_4_5_2, update_db_v_3_4_5_22, update_db_v_3_4_7, update_db_v_3_4_9_5, 
+			update_db_v_3_5_3, update_db_v_3_8_1, update_db_v_3_8_2, update_db_v_3_8_2_1, update_db_v_3_8_2_2, update_db_v_3_8_2_3,
+			update_db_v_3_8_2_4, update_db_v_3_8_2_5]
+# These ran before migrations were recorded and return False when their change exists already,
+# so they are recorded whatever they return. The later ones are recorded only when they succeed.
+legacy_migrations = migrations[:migrations.index(update_db_v_3_8_2)]
+schema_current = False
+migrations_failed = False
+	
+	
+def get_applied_migrations():
+	con, cur = get_cur()
+	sql = """ select id from `migrations` """
+	try:
+		cur.execute(sql)
+	except sqltool.Error as e:
+		return None
+	else:
+		return set(row[0] for row in cur.fetchall())
+	finally:
+		cur.close()
+		con.close()
+		
+		
+def add_applied_migration(id):
+	con, cur = get_cur()
+	sql = """ insert into `migrations` (id) values ('%s') """ % id
+	try:
+		cur.execute(sql)
+		con.commit()
+	except sqltool.Error as e:
+		print("An error occurred:", e)
+	cur.close()
+	con.close()
+	
+	
+def check_schema():
+	"""
+	Cheap check for hot paths: the newest migration is recorded once the schema is current
+	"""
+	global schema_current
+	if not schema_current:
+		con, cur = get_cur()
+		sql = """ select id from `migrations` where id = '%s' """ % migrations[-1].__name__
+		try:
+			cur.execute(sql)
+			schema_current = cur.fetchone() is not None
+		except sqltool.Error as e:
+			schema_current = False
+		cur.close()
+		con.close()
+	return schema_current
+	
+	
+def update_all(**kwargs):
+	import fcntl
+	import tempfile
+	global schema_current, migrations_failed
+	
+	with open(os.path.join(tempfile.gettempdir(), 'haproxy-wi-migrations.lock'), 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		con, cur = get_cur()
+		try:
+			cur.execute("""CREATE TABLE IF NOT EXISTS `migrations` (`id` varchar(64) PRIMARY KEY, `applied` timestamp default CURRENT_TIMESTAMP); """)
+			con.commit()
+		except sqltool.Error as e:
+			print("An error occurred:", e)
+			return False
+		finally:
+			cur.close()
+			con.close()
+			
+		applied = get_applied_migrations() or set()
+		pending = [update for update in migrations if update.__name__ not in applied]
+		failed = []
+		for update in pending:
+			result = None
+			if update is not update_db_v_3_4_5_22 or funct.check_ver() is None:
+				result = run_update(update, **kwargs)
+			if result is False and update not in legacy_migrations:
+				failed.append(update.__name__)
+				funct.logging('localhost', ' Migration %s failed, it runs again on the next update' % update.__name__, haproxywi=1)
+				continue
+			add_applied_migration(update.__name__)
+			
+		if pending:
+			update_to_hash()
+			update_ver()
+		schema_current = not failed
+		migrations_failed = bool(failed)
+	return not failed
 		
 	
 def update_all_silent():
-	update_db_v_31(silent=1)
-	update_db_v_3_2(silent=1)
-	update_db_v_3_21(silent=1)
-	update_db_v_3_2_3(silent=1)
-	update_db_v_3_2_8(silent=1)
-	update_db_v_3_31(silent=1)
-	update_db_v_3_4(silent=1)
-	update_db_v_3_4_1(silent=1)
-	update_db_v_3_4_5_2(silent=1)
-	if funct.check_ver() is None:
-		update_db_v_3_4_5_22()
-	update_db_v_3_4_7(silent=1)
-	update_db_v_3_4_9_5(silent=1)
-	update_db_v_3_5_3(silent=1)
-	update_db_v_3_8_1(silent=1)
-	update_to_hash()
-	update_ver()
+	# A failed migration is retried by the update_db action or on startup, not on every page render
+	if not migrations_failed and not check_schema():
+		update_all(silent=1)
 	
 		
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-"
+import os
+import json
+import time
+import threading
+
+# Every daemon keeps a registry of its targets and publishes it as a JSON file
+# in the status dir, overview pages read these files instead of running ps.
+publish_interval = 5
+stale_after = 60
+
+
+def get_status_dir():
+	import funct
+	return os.path.join(funct.get_config_var('main', 'log_path'), 'status')
+
+
+class Registry:
+	def __init__(self, name):
+		self.name = name
+		self.pid = os.getpid()
+		self.started = time.time()
+		self.targets = {}
+		self.errors = 0
+		self.published = 0
+		self.lock = threading.Lock()
+		self.path = os.path.join(get_status_dir(), name + '.json')
+
+	def target(self, key):
+		if key not in self.targets:
+			self.targets[key] = {'started': time.time(), 'last_poll': None, 'polls': 0, 'errors': 0, 'last_error': None, 'lag': 0}
+		return self.targets[key]
+
+	def poll(self, key, interval=None):
+		"""
+		Record a successful poll of key. With the expected interval between polls,
+		lag is how much later than that this poll came.
+		"""
+		now = time.time()
+		with self.lock:
+			target = self.target(key)
+			if interval is not None and target['last_poll'] is not None:
+				target['lag'] = round(max(now - target['last_poll'] - interval, 0), 3)
+			target['last_poll'] = now
+			target['polls'] += 1
+		self.publish()
+
+	def error(self, key, error):
+		with self.lock:
+			target = self.target(key)
+			target['errors'] += 1
+			target['last_error'] = str(error)
+			self.errors += 1
+		self.publish()
+
+	def update(self, key, **fields):
+		with self.lock:
+			self.target(key).update(fields)
+		self.publish(force=True)
+
+	def remove(self, key):
+		with self.lock:
+			self.targets.pop(key, None)
+		self.publish(force=True)
+
+	def publish(self, force=False):
+		now = time.time()
+		if not force and now - self.published < publish_interval:
+			return
+		self.published = now
+		with self.lock:
+			status = {'name': self.name, 'pid': self.pid, 'started': self.started, 'updated': now,
+						'errors': self.errors, 'targets': dict(self.targets)}
+			try:
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				with open(self.path + '.tmp', 'w') as f:
+					json.dump(status, f)
+				os.replace(self.path + '.tmp', self.path)
+			except (IOError, OSError):
+				pass
+
+	def close(self):
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+
+
+def is_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except PermissionError:
+		return True
+	except OSError:
+		return False
+	return True
+
+
+def read(name):
+	"""
+	Return the published status of a daemon or None when it is not running
+	"""
+	try:
+		with open(os.path.join(get_status_dir(), name + '.json'), 'r') as f:
+			status = json.load(f)
+	except (IOError, ValueError):
+		return None
+	if time.time() - status['updated'] > stale_after or not is_alive(status['pid']):
+		return None
+	return status
+
+
+def count(name, targets=False):
+	status = read(name)
+	if status is None:
+		return 0
+	return len(status['targets']) if targets else 1
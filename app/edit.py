@@ -3,8 +3,8 @@ import os
 import http, cgi
 import funct
 import sql
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('runtimeapi.html')
 
 print('Content-type: text/html\n')
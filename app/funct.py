@@ -10,21 +10,37 @@ def get_app_dir():
 	d = d.split('/')[-1]		
 	return sys.path[0] if d == "app" else os.path.dirname(sys.path[0])	
 
+parsed_config = None
+
 def get_config_var(sec, var):
 	from configparser import ConfigParser, ExtendedInterpolation
+	global parsed_config
+	if parsed_config is None:
+		try:
+			path_config = "/var/www/haproxy-wi/app/haproxy-wi.cfg"
+			parsed_config = ConfigParser(interpolation=ExtendedInterpolation())
+			parsed_config.read(path_config)
+		except:
+			parsed_config = None
+			print('Content-type: text/html\n')
+			print('<center><div class="alert alert-danger">Check the config file, whether it exists and the path. Must be: app/haproxy-webintarface.config</div>')
 	try:
-		path_config = "/var/www/haproxy-wi/app/haproxy-wi.cfg"
-		config = ConfigParser(interpolation=ExtendedInterpolation())
-		config.read(path_config)
-	except:
-		print('Content-type: text/html\n')
-		print('<center><div class="alert alert-danger">Check the config file, whether it exists and the path. Must be: app/haproxy-webintarface.config</div>')
-	try:
-		return config.get(sec, var)
+		return parsed_config.get(sec, var)
 	except:
 		print('Content-type: text/html\n')
 		print('<center><div class="alert alert-danger">Check the config file. Presence section %s and parameter %s</div>' % (sec, var))
 					
+jinja_envs = {}
+
+def get_env(**kwargs):
+	from jinja2 import Environment
+	loader = kwargs.get('loader')
+	key = (tuple(os.path.abspath(p) for p in getattr(loader, 'searchpath', [])),
+			repr(sorted((k, v) for k, v in kwargs.items() if k != 'loader')))
+	if key not in jinja_envs:
+		jinja_envs[key] = Environment(**kwargs)
+	return jinja_envs[key]
+	
 def get_data(type):
 	from datetime import datetime
 	from pytz import timezone
@@ -39,18 +55,84 @@ def get_data(type):
 		fmt = '%Y%m%d'
 	if type == "date_in_log":
 		fmt = "%b %d %H:%M:%S"
+	if type == "date_in_json":
+		fmt = "%Y-%m-%dT%H:%M:%S%z"
 		
 	return now_utc.strftime(fmt)
 			
+class LogWriter:
+	"""
+	Writes log lines from a background thread into long-lived daily files,
+	as text and as JSON lines. Files are reopened only when the date changes.
+	Other processes append to the same files, so every line goes out in one
+	unbuffered write and lines of two processes do not interleave.
+	"""
+	def __init__(self, log_path):
+		import queue
+		import threading
+		self.log_path = log_path
+		self.queue = queue.Queue()
+		self.files = {}
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		
+	def write(self, name, date, mess, record):
+		self.queue.put((name, date, mess, record))
+		
+	def get_files(self, name, date):
+		files = self.files.get(name)
+		if files is None or files[0] != date:
+			if files is not None:
+				files[1].close()
+				files[2].close()
+			if not os.path.exists(self.log_path):
+				os.makedirs(self.log_path)
+			base = os.path.join(self.log_path, name + "-" + date)
+			files = (date, open(base + ".log", "ab", buffering=0), open(base + ".json", "ab", buffering=0))
+			self.files[name] = files
+		return files
+		
+	def run(self):
+		import json
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					for date, log, json_log in self.files.values():
+						log.close()
+						json_log.close()
+					return
+				name, date, mess, record = item
+				date, log, json_log = self.get_files(name, date)
+				log.write(mess.encode('utf-8', errors='replace'))
+				json_log.write((json.dumps(record) + "\n").encode('utf-8'))
+			except IOError as e:
+				sys.stderr.write("Can't write log. Please check log_path in config %s\n" % e)
+			finally:
+				self.queue.task_done()
+				
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+		
+		
+log_writer = None
+
+
+def get_log_writer():
+	global log_writer
+	if log_writer is None:
+		import atexit
+		log_writer = LogWriter(get_config_var('main', 'log_path'))
+		atexit.register(log_writer.close)
+	return log_writer
+	
+	
 def logging(serv, action, **kwargs):
 	import sql
 	import http.cookies
-	log_path = get_config_var('main', 'log_path')
 	login = ''
 	
-	if not os.path.exists(log_path):
-		os.makedirs(log_path)
-		
 	try:
 		IP = cgi.escape(os.environ["REMOTE_ADDR"])
 		cookie = http.cookies.SimpleCookie(os.environ.get("HTTP_COOKIE"))
@@ -61,52 +143,49 @@ def logging(serv, action, **kwargs):
 		login = kwargs.get('login')
 		
 	if kwargs.get('alerting') == 1:
-		mess = get_data('date_in_log') + action + "\n"
-		log = open(log_path + "/checker-"+get_data('logs')+".log", "a")
+		name = "checker"
+		mess = action
 	elif kwargs.get('metrics') == 1:
-		mess = get_data('date_in_log') + action + "\n"
-		log = open(log_path + "/metrics-"+get_data('logs')+".log", "a")
+		name = "metrics"
+		mess = action
 	elif kwargs.get('keep_alive') == 1:
-		mess = get_data('date_in_log') + action + "\n"
-		log = open(log_path + "/keep_alive-"+get_data('logs')+".log", "a")
+		name = "keep_alive"
+		mess = action
+	elif kwargs.get('log_collector') == 1:
+		name = "log_collector"
+		mess = action
 	elif kwargs.get('haproxywi') == 1:
+		name = "haproxy-wi"
 		if kwargs.get('login'):
-			mess = get_data('date_in_log') + " from " + IP + " user: " + login + " " + action + " for: " + serv + "\n"
+			mess = " from " + IP + " user: " + str(login) + " " + action + " for: " + serv
 		else:
-			mess = get_data('date_in_log') + action + "\n"
-		log = open(log_path + "/haproxy-wi-"+get_data('logs')+".log", "a")
+			mess = action
 	else:
-		mess = get_data('date_in_log') + " from " + IP + " user: " + login + " " + action + " for: " + serv + "\n"
-		log = open(log_path + "/config_edit-"+get_data('logs')+".log", "a")
-	try:	
-		log.write(mess)
-		log.close
-	except IOError as e:
-		print('<center><div class="alert alert-danger">Can\'t write log. Please check log_path in config %e</div></center>' % e)
-		pass
+		name = "config_edit"
+		mess = " from " + IP + " user: " + str(login) + " " + action + " for: " + serv
+		
+	record = {'time': get_data('date_in_json'), 'log': name, 'server': serv, 'ip': IP, 'user': login, 'message': action.strip()}
+	get_log_writer().write(name, get_data('logs'), get_data('date_in_log') + mess + "\n", record)
 	
-def telegram_send_mess(mess, **kwargs):
-	import telebot
-	from telebot import apihelper
-	import sql
+alert_dispatcher = None
+
+
+def get_alert_dispatcher():
+	global alert_dispatcher
+	if alert_dispatcher is None:
+		import atexit
+		import alerting
+		# Closed before the log writer, atexit runs in reverse order
+		get_log_writer()
+		name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'haproxy-wi'
+		alert_dispatcher = alerting.AlertDispatcher(os.path.join(get_config_var('main', 'log_path'), 'alerts-spool-' + name + '.json'))
+		atexit.register(alert_dispatcher.close)
+	return alert_dispatcher
 	
-	telegrams = sql.get_telegram_by_ip(kwargs.get('ip'))
-	proxy = sql.get_setting('proxy')
 	
-	for telegram in telegrams:
-		token_bot = telegram[1]
-		channel_name = telegram[2]
-			
-	if proxy is not None:
-		apihelper.proxy = {'https': proxy}
-	try:
-		bot = telebot.TeleBot(token=token_bot)
-		bot.send_message(chat_id=channel_name, text=mess)
-	except:
-		mess = " Fatal: Can't send message. Add Telegram chanel before use alerting at this servers group"
-		print(mess)
-		logging('localhost', mess, haproxywi=1)
-		sys.exit()
+def telegram_send_mess(mess, **kwargs):
+	get_alert_dispatcher().send(mess, ip=kwargs.get('ip'))
+	
 	
 def check_login(**kwargs):
 	import sql
@@ -115,8 +194,6 @@ def check_login(**kwargs):
 	user_uuid = cookie.get('uuid')
 	ref = os.environ.get("SCRIPT_NAME")
 
-	sql.delete_old_uuid()
-	
 	if user_uuid is not None:
 		sql.update_last_act_user(user_uuid.value)
 		if sql.get_user_name_by_uuid(user_uuid.value) is None:
@@ -157,35 +234,100 @@ def page_for_admin(**kwargs):
 		import sys
 		sys.exit()
 				
+import threading
+
+# Connections are keyed by (serv, port, cred id), so a changed port or credential
+# opens a new connection and the old one is closed
+ssh_pool = {}
+ssh_pool_lock = threading.Lock()
+ssh_pool_idle_timeout = 60
+ssh_pool_max_sessions = 10
+# Credentials of a server, so a pooled hit does not query the database
+ssh_pool_creds = {}
+ssh_pool_creds_ttl = 60
+
+
+def ssh_pool_get_creds(serv):
+	import sql
+	import time
+	
+	cached = ssh_pool_creds.get(serv)
+	if cached is not None and time.time() - cached[0] < ssh_pool_creds_ttl:
+		return cached[1]
+	creds = sql.select_ssh(serv=serv) or []
+	ssh_pool_creds[serv] = (time.time(), creds)
+	return creds
+
+
 def ssh_connect(serv, **kwargs):
+	"""
+	Return a pooled SSH connection checked out for the caller, who gives it back with ssh_release
+	"""
 	import paramiko
 	from paramiko import SSHClient
-	import sql
+	import time
+
+	creds = ssh_pool_get_creds(serv)
+	key = (serv, creds[-1][7], creds[-1][0]) if creds else (serv, '', '')
+	
+	with ssh_pool_lock:
+		pooled = ssh_pool.get(key)
+		if pooled is not None and kwargs.get('new') is None:
+			transport = pooled['ssh'].get_transport()
+			if (transport is not None and transport.is_active() and 
+				(pooled['in_use'] or time.time() - pooled['last_used'] < ssh_pool_idle_timeout)):
+				try:
+					transport.send_ignore()
+				except Exception:
+					pass
+				else:
+					pooled['in_use'] += 1
+					pooled['last_used'] = time.time()
+					return pooled['ssh']
+		if pooled is not None:
+			ssh_pool_remove(key)
+	
 	fullpath = get_config_var('main', 'fullpath')
 	ssh_enable = ''
 	ssh_port = ''
 	ssh_user_name = ''
 	ssh_user_password = ''
 	
-	for sshs in sql.select_ssh(serv=serv):
+	for sshs in creds:
 		ssh_enable = sshs[3]
 		ssh_user_name = sshs[4]
 		ssh_user_password = sshs[5]
 		ssh_key_name = fullpath+'/keys/%s.pem' % sshs[2]
-
-	servers = sql.select_servers(server=serv)
-	for server in servers:
-		ssh_port = server[10]
+		ssh_port = sshs[7]
 
 	ssh = SSHClient()
 	ssh.load_system_host_keys()
 	ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+	# A hung host must not outlive fan_out_timeout, the interpreter waits for pool threads on exit
+	timeout = get_fan_out_timeout()
 	try:
 		if ssh_enable == 1:
 			k = paramiko.RSAKey.from_private_key_file(ssh_key_name)
-			ssh.connect(hostname = serv, port =  ssh_port, username = ssh_user_name, pkey = k)
+			ssh.connect(hostname = serv, port =  ssh_port, username = ssh_user_name, pkey = k, 
+						timeout = timeout, banner_timeout = timeout, auth_timeout = timeout)
 		else:
-			ssh.connect(hostname = serv, port =  ssh_port, username = ssh_user_name, password = ssh_user_password)
+			ssh.connect(hostname = serv, port =  ssh_port, username = ssh_user_name, password = ssh_user_password, 
+						timeout = timeout, banner_timeout = timeout, auth_timeout = timeout)
+		with ssh_pool_lock:
+			if key in ssh_pool:
+				# Another thread connected meanwhile, its connection may be in use already
+				ssh.close()
+				pooled = ssh_pool[key]
+				pooled['in_use'] += 1
+				pooled['last_used'] = time.time()
+				return pooled['ssh']
+			ssh.pool_entry = ssh_pool[key] = {
+				'ssh': ssh, 
+				'last_used': time.time(), 
+				'in_use': 1,
+				'closed': False,
+				'sessions': threading.BoundedSemaphore(ssh_pool_max_sessions)
+			}
 		return ssh
 	except paramiko.AuthenticationException:
 		return 'Authentication failed, please verify your credentials'
@@ -207,6 +349,71 @@ def ssh_connect(serv, **kwargs):
 			error = e	
 			pass
 		return str(error)
+		
+		
+def ssh_release(ssh):
+	"""
+	Give back a connection from ssh_connect, it stays open in the pool
+	"""
+	import time
+	
+	pooled = getattr(ssh, 'pool_entry', None)
+	if pooled is None:
+		return
+	with ssh_pool_lock:
+		pooled['in_use'] -= 1
+		pooled['last_used'] = time.time()
+		if pooled['closed'] and pooled['in_use'] <= 0:
+			ssh_pool_close(pooled)
+		
+		
+def ssh_pool_remove(key, force=False):
+	"""
+	Drop a connection from the pool, the caller holds ssh_pool_lock.
+	A connection that is checked out is closed by its last ssh_release.
+	"""
+	pooled = ssh_pool.pop(key, None)
+	if pooled is not None:
+		pooled['closed'] = True
+		if force or pooled['in_use'] <= 0:
+			ssh_pool_close(pooled)
+			
+			
+def ssh_pool_close(pooled):
+	try:
+		pooled['ssh'].close()
+	except Exception:
+		pass
+			
+			
+def ssh_pool_forget(cred_id=None):
+	"""
+	Drop the cached server credentials and close the connections opened with
+	a credential that was changed or deleted
+	"""
+	with ssh_pool_lock:
+		ssh_pool_creds.clear()
+		if cred_id is not None:
+			for key in [k for k in ssh_pool if str(k[2]) == str(cred_id)]:
+				ssh_pool_remove(key)
+			
+			
+def ssh_pool_close_all():
+	with ssh_pool_lock:
+		for key in list(ssh_pool):
+			ssh_pool_remove(key, force=True)
+		
+		
+def ssh_pool_session(ssh):
+	pooled = getattr(ssh, 'pool_entry', None)
+	if pooled is not None:
+		return pooled['sessions']
+	return threading.BoundedSemaphore(1)
+	
+
+import atexit
+atexit.register(ssh_pool_close_all)
+
 
 def get_config(serv, cfg, **kwargs):
 	import sql
@@ -217,11 +424,12 @@ def get_config(serv, cfg, **kwargs):
 		sftp = ssh.open_sftp()
 		sftp.get(config_path, cfg)
 		sftp.close()
-		ssh.close()
 	except Exception as e:
-		ssh = str(e)
-		logging('localhost', ssh, haproxywi=1)
-		return ssh
+		error = str(e)
+		logging('localhost', error, haproxywi=1)
+		return error
+	finally:
+		ssh_release(ssh)
 	
 def diff_config(oldcfg, cfg):
 	log_path = get_config_var('main', 'log_path')
@@ -418,13 +626,12 @@ def update_haproxy_wi():
 	
 
 def check_haproxy_version(serv):
-	import sql
-	haproxy_sock_port = sql.get_setting('haproxy_sock_port')
+	import haproxy_sock
 	ver = ""
-	cmd="echo 'show info' |nc %s %s |grep Version |awk '{print $2}'" % (serv, haproxy_sock_port)
-	output, stderr = subprocess_execute(cmd)
-	for line in output:
-		ver = line
+	try:
+		ver = haproxy_sock.show_info(serv).get('Version', '')
+	except OSError as e:
+		logging('localhost', ' '+str(e), haproxywi=1)
 	return ver
 	
 	
@@ -454,11 +661,12 @@ def upload(serv, path, file, **kwargs):
 		
 	try:
 		sftp.close()
-		ssh.close()
 	except Exception as e:
 		error = e.args
 		logging('localhost', str(error[0]), haproxywi=1)
 		pass
+	finally:
+		ssh_release(ssh)
 
 	return str(error)
 	
@@ -538,29 +746,90 @@ def check_haproxy_config(serv):
 	import sql
 	commands = [ "haproxy  -q -c -f %s" % sql.get_setting('haproxy_config_path') ]
 	ssh = ssh_connect(serv)
-	for command in commands:
-		stdin , stdout, stderr = ssh.exec_command(command, get_pty=True)
-		if not stderr.read():
-			return True
-		else:
-			return False
-	ssh.close()
+	try:
+		for command in commands:
+			stdin , stdout, stderr = ssh.exec_command(command, get_pty=True)
+			if not stderr.read():
+				return True
+			else:
+				return False
+	finally:
+		ssh_release(ssh)
 		
 		
-def show_log(stdout, **kwargs):
+def log_lines_html(stdout, **kwargs):
 	i = 0
-	out = ''
 	for line in stdout:		
 		if kwargs.get("html") != 0:
 			i = i + 1
 			line_class = "line3" if i % 2 == 0 else "line"
-			out += '<div class="'+line_class+'">' + escape_html(line) + '</div>'
+			yield '<div class="'+line_class+'">' + escape_html(line) + '</div>'
 		else:
-			out += line
-		
-	return out
+			yield line
+			
+			
+def show_log(stdout, **kwargs):
+	return ''.join(log_lines_html(stdout, **kwargs))
+	
+	
+def print_log(stdout, chunk=500, **kwargs):
+	out = []
+	for line in log_lines_html(stdout, **kwargs):
+		out.append(line)
+		if len(out) >= chunk:
+			print(''.join(out), end='', flush=True)
+			out = []
+	print(''.join(out))
 		
 		
+def get_haproxy_log_source(serv, waf='0'):
+	import sql
+	syslog_server_enable = sql.get_setting('syslog_server_enable')
+	if syslog_server_enable is None or syslog_server_enable == "0":
+		syslog_server = serv
+		path = sql.get_setting('local_path_logs')
+	else:
+		syslog_server = sql.get_setting('syslog_server')
+		path = '/var/log/%s/syslog.log' % serv
+	if waf == "1":
+		path = '/var/log/modsec_audit.log'
+	return syslog_server, path
+	
+	
+def read_remote_log(serv, path, offset=None, inode=None, max_bytes=1048576, follow=False):
+	"""
+	Return (inode, offset, rotated, lines, size) of the log at path on serv read from offset.
+	Without follow a backlog over max_bytes is skipped to its last max_bytes, with follow
+	only max_bytes are read from offset and the caller calls again until offset reaches size.
+	"""
+	import logindex
+	import shlex
+	# offset and inode come from the browser, int() keeps them out of the shell as anything but numbers
+	offset = -1 if offset is None or offset == '' else int(offset)
+	inode = -1 if inode is None or inode == '' else int(inode)
+	max_bytes = int(max_bytes)
+	if follow:
+		limit = "n=$((s-o)); if [ $n -gt %d ]; then n=%d; fi; " % (max_bytes, max_bytes)
+	else:
+		limit = "if [ $((s-o)) -gt %d ]; then o=$((s-%d)); fi; if [ $o -lt 0 ]; then o=0; fi; n=$((s-o)); " % (max_bytes, max_bytes)
+	script = ("f=%s; i=$(stat -c %%i \"$f\") || exit 1; s=$(stat -c %%s \"$f\"); o=%d; "
+		"if [ $o -lt 0 ]; then o=$((s-%d)); elif [ \"$i\" != \"%d\" ] || [ $o -gt $s ]; then o=0; fi; "
+		"if [ $o -lt 0 ]; then o=0; fi; %s"
+		"echo \"$i $s $o\"; tail -c +$((o+1)) \"$f\" | head -c $n") % (shlex.quote(path), offset, max_bytes, inode, limit)
+	cmd = 'sudo sh -c ' + shlex.quote(script)
+	out = ssh_command(serv, [cmd], raw=1)
+	if not out:
+		raise IOError('Cannot read %s on %s' % (path, serv))
+	head, sep, data = out.partition(b'\n')
+	new_inode, size, start = head.decode().split()
+	# The read range ends at start + len(data), which is before size when following a backlog
+	return logindex.split_tail(data, int(new_inode), int(start), int(start) + len(data), offset, inode) + (int(size),)
+	
+	
+def tail_remote_log(serv, path, offset=None, inode=None, max_bytes=1048576):
+	return read_remote_log(serv, path, offset, inode, max_bytes)[:4]
+	
+	
 def show_haproxy_log(serv, rows=10, waf='0', grep=None, hour='00', minut='00', hour1='24', minut1='00', **kwargs):
 	import sql
 	date = hour+':'+minut
@@ -571,19 +840,20 @@ def show_haproxy_log(serv, rows=10, waf='0', grep=None, hour='00', minut='00', h
 		grep_act = ''
 		grep = ''
 
-	syslog_server_enable = sql.get_setting('syslog_server_enable')
-	if syslog_server_enable is None or syslog_server_enable == "0":
-		local_path_logs = sql.get_setting('local_path_logs')
-		syslog_server = serv	
-		commands = [ "sudo cat %s| awk '$3>\"%s:00\" && $3<\"%s:00\"' |tail -%s  %s %s" % (local_path_logs, date, date1, rows, grep_act, grep) ]		
-	else:
-		commands = [ "sudo cat /var/log/%s/syslog.log | sed '/ %s:00/,/ %s:00/! d' |tail -%s  %s %s" % (serv, date, date1, rows, grep_act, grep) ]
-		syslog_server = sql.get_setting('syslog_server')
+	if waf != "1" and sql.get_setting('log_collector_enable') == "1":
+		import logstore
+		if logstore.has(serv):
+			filters = dict((field, kwargs.get(field)) for field in logstore.fields[:-1] + ('min_time',) if kwargs.get(field))
+			lines = logstore.query(serv, date+':00', date1+':00', rows=rows, grep=grep, **filters)
+			return show_log(lines, html=kwargs.get('html'))
 	
+	syslog_server, path = get_haproxy_log_source(serv, waf)
 	if waf == "1":
-		local_path_logs = '/var/log/modsec_audit.log'
-		commands = [ "sudo cat %s |tail -%s  %s %s" % (local_path_logs, rows, grep_act, grep) ]	
-		
+		commands = [ "sudo cat %s |tail -%s  %s %s" % (path, rows, grep_act, grep) ]
+	elif syslog_server == serv:
+		commands = [ "sudo cat %s| awk '$3>\"%s:00\" && $3<\"%s:00\"' |tail -%s  %s %s" % (path, date, date1, rows, grep_act, grep) ]
+	else:
+		commands = [ "sudo cat %s | sed '/ %s:00/,/ %s:00/! d' |tail -%s  %s %s" % (path, date, date1, rows, grep_act, grep) ]
 	
 	if kwargs.get('html') == 0:
 		a = ssh_command(syslog_server, commands)
@@ -591,6 +861,36 @@ def show_haproxy_log(serv, rows=10, waf='0', grep=None, hour='00', minut='00', h
 	else:
 		return ssh_command(syslog_server, commands, show_log='1')
 
+
+def stream_haproxy_log(serv, rows, since, until):
+	"""
+	Yield the last rows lines of the HAProxy log of serv with since < time < until as they arrive over SSH
+	"""
+	syslog_server, path = get_haproxy_log_source(serv)
+	if syslog_server == serv:
+		command = "sudo cat %s| awk '$3>\"%s\" && $3<\"%s\"' |tail -%s" % (path, since, until, int(rows))
+	else:
+		command = "sudo cat %s | sed '/ %s/,/ %s/! d' |tail -%s" % (path, since, until, int(rows))
+	return ssh_command_lines(syslog_server, command)
+	
+	
+def ssh_command_lines(serv, command):
+	"""
+	Yield the output of command line by line, without holding it in memory
+	"""
+	ssh = ssh_connect(serv)
+	if isinstance(ssh, str):
+		raise IOError(ssh)
+	session = ssh_pool_session(ssh)
+	session.acquire()
+	try:
+		stdin, stdout, stderr = ssh.exec_command(command)
+		for line in stdout:
+			yield line
+	finally:
+		session.release()
+		ssh_release(ssh)
+
 	
 			
 			
@@ -613,37 +913,47 @@ def server_status(stdout):
 
 def ssh_command(serv, commands, **kwargs):
 	ssh = ssh_connect(serv)
+	if kwargs.get('raw') and isinstance(ssh, str):
+		raise IOError(ssh)
 		  
-	for command in commands:
-		try:
-			stdin, stdout, stderr = ssh.exec_command(command, get_pty=True)
-		except:
-			continue
+	try:
+		for command in commands:
+			session = ssh_pool_session(ssh)
+			session.acquire()
+			try:
+				try:
+					stdin, stdout, stderr = ssh.exec_command(command, get_pty=not kwargs.get('raw'))
+				except:
+					continue
+					
+				if kwargs.get('raw'):
+					return stdout.read()
+				elif kwargs.get("ip") == "1":
+					show_ip(stdout)
+				elif kwargs.get("show_log") == "1":
+					return show_log(stdout)
+				elif kwargs.get("server_status") == "1":
+					server_status(stdout)
+				elif kwargs.get('print_out'):
+					print(stdout.read().decode(encoding='UTF-8'))
+					return stdout.read().decode(encoding='UTF-8')
+				elif kwargs.get('retunr_err') == 1:
+					return stderr.read().decode(encoding='UTF-8')
+				else:
+					return stdout.read().decode(encoding='UTF-8')
 				
-		if kwargs.get("ip") == "1":
-			show_ip(stdout)
-		elif kwargs.get("show_log") == "1":
-			return show_log(stdout)
-		elif kwargs.get("server_status") == "1":
-			server_status(stdout)
-		elif kwargs.get('print_out'):
-			print(stdout.read().decode(encoding='UTF-8'))
-			return stdout.read().decode(encoding='UTF-8')
-		elif kwargs.get('retunr_err') == 1:
-			return stderr.read().decode(encoding='UTF-8')
-		else:
-			return stdout.read().decode(encoding='UTF-8')
+				for line in stderr.read().decode(encoding='UTF-8'):
+					if line:
+						print("<div class='alert alert-warning'>"+line+"</div>")
+						logging('localhost', ' '+line, haproxywi=1)
+			finally:
+				session.release()
+	finally:
+		ssh_release(ssh)
 			
-		for line in stderr.read().decode(encoding='UTF-8'):
-			if line:
-				print("<div class='alert alert-warning'>"+line+"</div>")
-				logging('localhost', ' '+line, haproxywi=1)
-	try:	
-		ssh.close()
-	except:
-		print("<div class='alert alert-danger' style='margin: 0;'>"+str(ssh)+"<a title='Close' id='errorMess'><b>X</b></a></div>")
-		logging('localhost', ' '+str(ssh), haproxywi=1)
-		pass
+	if isinstance(ssh, str):
+		print("<div class='alert alert-danger' style='margin: 0;'>"+ssh+"<a title='Close' id='errorMess'><b>X</b></a></div>")
+		logging('localhost', ' '+ssh, haproxywi=1)
 
 
 def escape_html(text):
@@ -660,33 +970,33 @@ def subprocess_execute(cmd):
 
 
 def show_backends(serv, **kwargs):
-	import json
-	import sql
-	haproxy_sock_port = sql.get_setting('haproxy_sock_port')
-	cmd='echo "show backend" |nc %s %s' % (serv, haproxy_sock_port)
-	output, stderr = subprocess_execute(cmd)
-	if stderr:
-		logging('localhost', ' '+stderr, haproxywi=1)
+	import haproxy_sock
+	try:
+		output = haproxy_sock.show_backend(serv)
+	except OSError as e:
+		output = []
+		logging('localhost', ' '+str(e), haproxywi=1)
 	if kwargs.get('ret'):
 		ret = list()
 	else:
 		ret = ""
 	for line in output:
-		if "#" in  line or "stats" in line or "MASTER" in line:
+		if "stats" in line or "MASTER" in line:
 			continue
 		if len(line) > 1:
-			back = json.dumps(line).split("\"")
 			if kwargs.get('ret'):
-				ret.append(back[1])
+				ret.append(line)
 			else:
-				print(back[1], end="<br>")
+				print(line, end="<br>")
 		
 	if kwargs.get('ret'):
 		return ret
 		
 		
-def get_files(dir = get_config_var('configs', 'haproxy_save_configs_dir'), format = 'cfg', **kwargs):
+def get_files(dir = None, format = 'cfg', **kwargs):
 	import glob
+	if dir is None:
+		dir = get_config_var('configs', 'haproxy_save_configs_dir')
 	if format == 'log':
 		file = []
 	else:
@@ -710,6 +1020,72 @@ def get_files(dir = get_config_var('configs', 'haproxy_save_configs_dir'), forma
 		return files
 	
 	
+fan_out_pool = None
+fan_out_workers = 20
+
+
+def get_fan_out_pool():
+	import concurrent.futures
+	import sql
+	global fan_out_pool, fan_out_workers
+	if fan_out_pool is None:
+		try:
+			fan_out_workers = int(sql.get_setting('fan_out_workers'))
+		except (TypeError, ValueError):
+			pass
+		fan_out_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fan_out_workers)
+	return fan_out_pool
+	
+	
+def get_fan_out_timeout():
+	import sql
+	try:
+		return int(sql.get_setting('fan_out_timeout'))
+	except (TypeError, ValueError):
+		return 15
+	
+	
+def fan_out(func, items, **kwargs):
+	"""
+	Run func(item) for all items in the shared pool and yield (item, result) as hosts answer.
+	A host that fails or does not answer within the timeout yields its exception as result.
+	"""
+	import concurrent.futures
+	import math
+	import sql
+	timeout = int(kwargs.get('timeout') or get_fan_out_timeout())
+	pool = get_fan_out_pool()
+	futures = dict((pool.submit(func, item), item) for item in items)
+	if not futures:
+		return
+	deadline = timeout * math.ceil(len(futures) / fan_out_workers)
+	
+	try:
+		for future in concurrent.futures.as_completed(futures, timeout=deadline):
+			item = futures.pop(future)
+			try:
+				yield item, future.result()
+			except Exception as e:
+				yield item, e
+	except concurrent.futures.TimeoutError:
+		for future, item in futures.items():
+			if future.cancel() or not future.done():
+				yield item, concurrent.futures.TimeoutError('No answer in %s sec' % timeout)
+			elif future.exception() is not None:
+				yield item, future.exception()
+			else:
+				yield item, future.result()
+	
+	
+async def run_in_pool(func, *args, **kwargs):
+	"""
+	Await a blocking call (SSH, subprocess, DB) in the shared pool without stalling the event loop
+	"""
+	import asyncio
+	import functools
+	return await asyncio.get_event_loop().run_in_executor(get_fan_out_pool(), functools.partial(func, *args, **kwargs))
+	
+	
 def get_key(item):
 	return item[0]
 	
@@ -725,6 +1101,7 @@ def check_new_version():
 	import sql	
 
 	proxy = sql.get_setting('proxy')
+	res = None
 	
 	try:
 		if proxy:
@@ -741,6 +1118,33 @@ def check_new_version():
 	return res
 	
 	
+def get_new_version_file():
+	return os.path.join(get_config_var('main', 'fullpath'), 'new_version')
+	
+	
+def update_new_version():
+	new_ver = check_new_version()
+	if new_ver is None:
+		return False
+	new_version_file = get_new_version_file()
+	try:
+		with open(new_version_file + '.tmp', 'w') as f:
+			f.write(new_ver)
+		os.replace(new_version_file + '.tmp', new_version_file)
+	except IOError as e:
+		logging('localhost', ' Cannot save new version: '+str(e), haproxywi=1)
+		return False
+	return True
+	
+	
+def get_new_version():
+	try:
+		with open(get_new_version_file(), 'r') as f:
+			return f.read()
+	except IOError:
+		return None
+	
+	
 def versions():	
 	try: 
 		current_ver = check_ver()
@@ -757,7 +1161,7 @@ def versions():
 		current_ver_without_dots = 0
 
 	try:
-		new_ver = check_new_version()
+		new_ver = get_new_version()
 		new_ver_without_dots = new_ver.split('.')
 		new_ver_without_dots = ''.join(new_ver_without_dots)
 		new_ver_without_dots = new_ver_without_dots.replace('\n', '')
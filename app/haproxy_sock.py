@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-"
+import socket
+import asyncio
+
+
+def get_port(port=None):
+	if port is None:
+		import sql
+		port = sql.get_setting('haproxy_sock_port')
+	return int(port)
+
+
+def send_command(serv, command, port=None, timeout=1):
+	with socket.create_connection((serv, get_port(port)), timeout=timeout) as sock:
+		sock.sendall(command.encode('utf-8') + b'\n')
+		out = b''
+		while True:
+			data = sock.recv(65536)
+			if not data:
+				break
+			out += data
+
+	return out.decode(encoding='UTF-8', errors='replace')
+
+
+async def async_send_command(serv, command, port=None, timeout=1):
+	reader, writer = await asyncio.wait_for(asyncio.open_connection(serv, get_port(port)), timeout)
+	try:
+		writer.write(command.encode('utf-8') + b'\n')
+		await writer.drain()
+		out = b''
+		while True:
+			data = await asyncio.wait_for(reader.read(65536), timeout)
+			if not data:
+				break
+			out += data
+	finally:
+		writer.close()
+
+	return out.decode(encoding='UTF-8', errors='replace')
+
+
+def is_prompt(out):
+	return out.endswith(b'\n> ') or out == b'> '
+
+
+class Session:
+	"""
+	A kept-alive runtime API session in "prompt" mode for code that sends several
+	commands to one HAProxy. The session is reopened once if HAProxy has closed it
+	meanwhile, for example after its "stats timeout".
+	"""
+	def __init__(self, serv, port=None, timeout=1):
+		self.serv = serv
+		self.port = get_port(port)
+		self.timeout = timeout
+		self.sock = None
+
+	def read_prompt(self):
+		out = b''
+		while not is_prompt(out):
+			data = self.sock.recv(65536)
+			if not data:
+				raise ConnectionResetError('HAProxy closed the runtime API session')
+			out += data
+
+		return out[:-2].decode(encoding='UTF-8', errors='replace')
+
+	def open(self):
+		self.sock = socket.create_connection((self.serv, self.port), timeout=self.timeout)
+		self.sock.sendall(b'prompt\n')
+		self.read_prompt()
+
+	def command(self, command):
+		for attempt in range(2):
+			try:
+				if self.sock is None:
+					self.open()
+				self.sock.sendall(command.encode('utf-8') + b'\n')
+				return self.read_prompt()
+			except OSError:
+				self.close()
+				if attempt:
+					raise
+
+	def show_info(self):
+		return parse_show_info(self.command('show info'))
+
+	def show_stat(self):
+		return parse_show_stat(self.command('show stat'))
+
+	def show_servers_state(self):
+		return parse_show_servers_state(self.command('show servers state'))
+
+	def close(self):
+		if self.sock is not None:
+			try:
+				self.sock.close()
+			except OSError:
+				pass
+		self.sock = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class AsyncSession:
+	"""
+	A kept-alive runtime API session in "prompt" mode for pollers that query one
+	HAProxy again and again. The session is reopened once if HAProxy has closed it
+	meanwhile, for example after its "stats timeout".
+	"""
+	def __init__(self, serv, port=None, timeout=1):
+		self.serv = serv
+		self.port = get_port(port)
+		self.timeout = timeout
+		self.reader = None
+		self.writer = None
+
+	async def read_prompt(self):
+		out = b''
+		while not is_prompt(out):
+			data = await asyncio.wait_for(self.reader.read(65536), self.timeout)
+			if not data:
+				raise ConnectionResetError('HAProxy closed the runtime API session')
+			out += data
+
+		return out[:-2].decode(encoding='UTF-8', errors='replace')
+
+	async def open(self):
+		self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.serv, self.port), self.timeout)
+		self.writer.write(b'prompt\n')
+		await self.writer.drain()
+		await self.read_prompt()
+
+	async def command(self, command):
+		for attempt in range(2):
+			try:
+				if self.reader is None or self.reader.at_eof():
+					self.close()
+					await self.open()
+				self.writer.write(command.encode('utf-8') + b'\n')
+				await self.writer.drain()
+				return await self.read_prompt()
+			except (OSError, asyncio.TimeoutError):
+				self.close()
+				if attempt:
+					raise
+
+	async def show_info(self):
+		return parse_show_info(await self.command('show info'))
+
+	async def show_stat(self):
+		return parse_show_stat(await self.command('show stat'))
+
+	async def show_servers_state(self):
+		return parse_show_servers_state(await self.command('show servers state'))
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+		self.reader = self.writer = None
+
+
+def parse_show_info(output):
+	info = {}
+	for line in output.splitlines():
+		if ':' in line:
+			key, value = line.split(':', 1)
+			info[key.strip()] = value.strip()
+
+	return info
+
+
+def parse_show_stat(output):
+	records = []
+	fields = []
+	for line in output.splitlines():
+		if line.startswith('# '):
+			fields = line[2:].rstrip(',').split(',')
+			continue
+		if not line or not fields:
+			continue
+		records.append(dict(zip(fields, line.split(','))))
+
+	return records
+
+
+def parse_show_backend(output):
+	backends = []
+	for line in output.splitlines():
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+		backends.append(line)
+
+	return backends
+
+
+def parse_show_servers_state(output):
+	"""
+	Return one dict per server of "show servers state", numbers as int.
+	The first line is the format version, the next one names the fields.
+	"""
+	lines = output.splitlines()
+	fields = []
+	records = []
+	for line in lines[1:]:
+		if line.startswith('# '):
+			fields = line[2:].split(' ')
+			continue
+		if not line or not fields:
+			continue
+		record = {}
+		for field, value in zip(fields, line.split(' ')):
+			record[field] = int(value) if value.lstrip('-').isdigit() else value
+		records.append(record)
+
+	return records
+
+
+def info_lines(info, patterns):
+	return [key + ': ' + value for key, value in info.items() if any(p in key + ':' for p in patterns)]
+
+
+def show_info(serv, port=None, timeout=1):
+	return parse_show_info(send_command(serv, 'show info', port=port, timeout=timeout))
+
+
+def show_stat(serv, port=None, timeout=1):
+	return parse_show_stat(send_command(serv, 'show stat', port=port, timeout=timeout))
+
+
+def show_backend(serv, port=None, timeout=1):
+	return parse_show_backend(send_command(serv, 'show backend', port=port, timeout=timeout))
+
+
+def show_servers_state(serv, port=None, timeout=1):
+	return parse_show_servers_state(send_command(serv, 'show servers state', port=port, timeout=timeout))
+
+
+async def async_show_info(serv, port=None, timeout=1):
+	return parse_show_info(await async_send_command(serv, 'show info', port=port, timeout=timeout))
+
+
+async def async_show_stat(serv, port=None, timeout=1):
+	return parse_show_stat(await async_send_command(serv, 'show stat', port=port, timeout=timeout))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import funct, sql
+import haproxy_sock
+import daemons
 import os, http.cookies
 import cgi
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('hapservers.html')
 	
 print('Content-type: text/html\n')
@@ -16,8 +18,7 @@ try:
 	users = sql.select_users()
 	groups = sql.select_groups()
 	token = sql.get_token(user_id.value)
-	cmd = "ps ax |grep -e 'keep_alive.py' |grep -v grep |wc -l"
-	keep_alive, stderr = funct.subprocess_execute(cmd)
+	keep_alive = str(daemons.count('keep_alive'))
 except:
 	pass
 	
@@ -36,26 +37,38 @@ haproxy_sock_port = sql.get_setting('haproxy_sock_port')
 haproxy_config_path  = sql.get_setting('haproxy_config_path')
 commands = [ "ls -l %s |awk '{ print $6\" \"$7\" \"$8}'" % haproxy_config_path ]
 servers_with_status1 = []
-out1 = ""
+
+
+def get_status(s):
+	try:
+		info = haproxy_sock.show_info(s[2], port=haproxy_sock_port)
+		out1 = haproxy_sock.info_lines(info, ('Ver', 'Uptime:', 'Process_num'))
+	except OSError:
+		info = False
+		out1 = False
+	try:
+		last_edit = funct.ssh_command(s[2], commands)
+	except:
+		last_edit = 'Cannot get last date'
+	return info, out1, last_edit
+	
+	
+statuses = dict((s[2], status) for s, status in funct.fan_out(get_status, servers))
+
 for s in servers:
 	servers_with_status = list()
-	cmd = 'echo "show info" |nc %s %s -w 1 |grep -e "Ver\|Uptime:\|Process_num"' % (s[2], haproxy_sock_port)
-	out = funct.subprocess_execute(cmd)
+	status = statuses.get(s[2])
+	if isinstance(status, Exception):
+		status = (False, False, 'Cannot get last date')
+	info, out1, last_edit = status
 	servers_with_status.append(s[0])
 	servers_with_status.append(s[1])
 	servers_with_status.append(s[2])
 	servers_with_status.append(s[11])
-	for k in out:
-		if "Ncat:" not in k:
-			out1 = out
-		else:
-			out1 = False
-		servers_with_status.append(out1)
+	servers_with_status.append(info)
+	servers_with_status.append(out1)
 	servers_with_status.append(s[12])
-	try:
-		servers_with_status.append(funct.ssh_command(s[2], commands))
-	except:
-		servers_with_status.append('Cannot get last date')
+	servers_with_status.append(last_edit)
 	
 	if serv:
 		try:
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-"
+import re
+import math
+
+# Lines analysed per request over SSH, the window is the newest part of the log.
+# The local log store is read whole, line by line.
+max_lines = 100000
+top_talkers = 20
+line_re = re.compile(r'\]: (?P<client_ip>[0-9a-fA-F.:]+):\d+ \[[^\]]+\] (?P<frontend>\S+) (?P<backend>[^/\s]+)/(?P<server>\S+) '
+					r'(?P<tq>-?\d+)/(?P<tw>-?\d+)/(?P<tc>-?\d+)/(?P<tr>-?\d+)/\+?(?P<tt>\d+) (?P<status>-?\d+) \+?(?P<bytes>\d+) '
+					r'\S+ \S+ (?P<termination>\S{4}) ')
+
+
+def parse(line):
+	"""
+	Return a dict of the fields of an HAProxy HTTP log line or None for other lines.
+	Timers are ints in ms, -1 when HAProxy did not reach that step.
+	"""
+	found = line_re.search(line)
+	if found is None:
+		return None
+	fields = found.groupdict()
+	for field in ('tq', 'tw', 'tc', 'tr', 'tt', 'status', 'bytes'):
+		fields[field] = int(fields[field])
+	return fields
+
+
+class QuantileSketch:
+	"""
+	Quantiles with relative error within accuracy, in memory bound by max_buckets.
+	Values are counted in logarithmic buckets, when there are too many
+	the lowest ones are merged, so only the low quantiles lose accuracy.
+	"""
+	def __init__(self, accuracy=0.01, max_buckets=1024):
+		self.gamma = (1 + accuracy) / (1 - accuracy)
+		self.log_gamma = math.log(self.gamma)
+		self.max_buckets = max_buckets
+		self.buckets = {}
+		self.zero = 0
+		self.count = 0
+
+	def add(self, value):
+		self.count += 1
+		if value <= 0:
+			self.zero += 1
+			return
+		index = int(math.ceil(math.log(value) / self.log_gamma))
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+		if len(self.buckets) > self.max_buckets:
+			lowest, second = sorted(self.buckets)[:2]
+			self.buckets[second] += self.buckets.pop(lowest)
+
+	def quantile(self, q):
+		if not self.count:
+			return None
+		rank = q * (self.count - 1)
+		seen = self.zero
+		if rank < seen:
+			return 0
+		for index in sorted(self.buckets):
+			seen += self.buckets[index]
+			if rank < seen:
+				return int(round(2 * self.gamma ** index / (self.gamma + 1)))
+		return int(round(2 * self.gamma ** max(self.buckets) / (self.gamma + 1)))
+
+
+class TopCounter:
+	"""
+	Space-saving counter: keeps size keys, the counts of the rarest ones may be overestimated
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.counts = {}
+
+	def add(self, key, count=1):
+		if key not in self.counts and len(self.counts) >= self.size:
+			rarest = min(self.counts, key=self.counts.get)
+			count += self.counts.pop(rarest)
+		self.counts[key] = self.counts.get(key, 0) + count
+
+	def top(self, count):
+		return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+class ProxyStats:
+	def __init__(self):
+		self.requests = 0
+		self.bytes = 0
+		self.statuses = {}
+		self.terminations = {}
+		self.total_time = QuantileSketch()
+		self.response_time = QuantileSketch()
+
+	def add(self, fields):
+		self.requests += 1
+		self.bytes += fields['bytes']
+		status = '%dxx' % (fields['status'] // 100) if fields['status'] > 0 else 'aborted'
+		self.statuses[status] = self.statuses.get(status, 0) + 1
+		# The first two letters tell who ended the session and how, -- is a normal end
+		termination = fields['termination'][:2]
+		if termination != '--':
+			self.terminations[termination] = self.terminations.get(termination, 0) + 1
+		self.total_time.add(fields['tt'])
+		if fields['tr'] >= 0:
+			self.response_time.add(fields['tr'])
+
+	def summary(self):
+		errors = self.statuses.get('5xx', 0) + self.statuses.get('aborted', 0)
+		return {
+			'requests': self.requests,
+			'bytes': self.bytes,
+			'error_rate': round(errors * 100.0 / self.requests, 2) if self.requests else 0,
+			'statuses': self.statuses,
+			'terminations': self.terminations,
+			'p50': self.total_time.quantile(0.5),
+			'p95': self.total_time.quantile(0.95),
+			'p99': self.total_time.quantile(0.99),
+			'tr_p95': self.response_time.quantile(0.95),
+		}
+
+
+def analyze(lines):
+	"""
+	Return per-frontend and per-backend latency percentiles, status histograms,
+	error rates and top talkers of an iterable of HAProxy log lines
+	"""
+	frontends = {}
+	backends = {}
+	talkers = TopCounter(top_talkers * 10)
+	lines_count = 0
+	parsed = 0
+
+	for line in lines:
+		lines_count += 1
+		fields = parse(line)
+		if fields is None:
+			continue
+		parsed += 1
+		frontends.setdefault(fields['frontend'], ProxyStats()).add(fields)
+		backends.setdefault(fields['backend'], ProxyStats()).add(fields)
+		talkers.add(fields['client_ip'])
+
+	return {
+		'lines': lines_count,
+		'parsed': parsed,
+		'frontends': dict((name, stats.summary()) for name, stats in sorted(frontends.items())),
+		'backends': dict((name, stats.summary()) for name, stats in sorted(backends.items())),
+		'top_talkers': talkers.top(top_talkers),
+	}
+
+
+def server_analytics(serv, hour='00', minut='00', hour1='24', minut1='00'):
+	"""
+	Analyse the lines of serv in the window. The local log store is read as a stream,
+	over SSH the newest max_lines lines are streamed.
+	"""
+	import funct
+	import sql
+	since = '%02d:%02d:00' % (int(hour), int(minut))
+	until = '%02d:%02d:00' % (int(hour1), int(minut1))
+	
+	if sql.get_setting('log_collector_enable') == "1":
+		import logstore
+		if logstore.has(serv):
+			return analyze(logstore.query(serv, since, until))
+	return analyze(funct.stream_haproxy_log(serv, max_lines, since, until))
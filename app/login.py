@@ -10,8 +10,8 @@ import sql
 import create_db
 import datetime
 import uuid
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('login.html')
 form = funct.form
 
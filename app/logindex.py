@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-"
+import os
+import re
+import json
+import collections
+
+# A sparse index keeps the offset and time of one line per block of the log,
+# so a time window query reads only the blocks that can hold matching lines.
+block_size = 65536
+time_re = re.compile(rb'(\d\d:\d\d:\d\d)')
+
+
+def get_index_file(path):
+	import funct
+	index_dir = os.path.join(funct.get_config_var('main', 'log_path'), '.index')
+	if not os.path.exists(index_dir):
+		os.makedirs(index_dir)
+	return os.path.join(index_dir, path.strip('/').replace('/', '_') + '.idx')
+
+
+def line_time(line):
+	found = time_re.search(line)
+	if found is not None:
+		return found.group(1).decode('ascii')
+
+
+def load_index(index_file):
+	try:
+		with open(index_file, 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+
+def save_index(index_file, index):
+	try:
+		with open(index_file + '.tmp', 'w') as f:
+			json.dump(index, f)
+		os.replace(index_file + '.tmp', index_file)
+	except IOError:
+		pass
+
+
+def get_index(path):
+	"""
+	Return the index of a log file, scanning only what was appended since the last call.
+	A rotated or truncated file is indexed from scratch.
+	"""
+	index_file = get_index_file(path)
+	stat = os.stat(path)
+	index = load_index(index_file)
+	if index is None or index['inode'] != stat.st_ino or index['scanned'] > stat.st_size:
+		index = {'inode': stat.st_ino, 'scanned': 0, 'points': []}
+	if index['scanned'] == stat.st_size:
+		return index
+
+	with open(path, 'rb') as f:
+		f.seek(index['scanned'])
+		pos = index['scanned']
+		next_point = index['points'][-1][0] + block_size if index['points'] else 0
+		for line in f:
+			if not line.endswith(b'\n'):
+				break
+			if pos >= next_point:
+				time = line_time(line)
+				if time is not None:
+					index['points'].append((pos, time))
+					next_point = pos + block_size
+			pos += len(line)
+	index['scanned'] = pos
+	save_index(index_file, index)
+
+	return index
+
+
+def get_ranges(points, since, until):
+	ranges = []
+	for i, (offset, start) in enumerate(points):
+		if i + 1 < len(points):
+			end_offset, end = points[i + 1]
+			# Times go back only when the log crosses midnight, such block can hold any time
+			if start <= end and (start >= until or end <= since):
+				continue
+		else:
+			end_offset = None
+		if ranges and ranges[-1][1] == offset:
+			ranges[-1][1] = end_offset
+		else:
+			ranges.append([offset, end_offset])
+
+	return ranges
+
+
+def query(path, since, until, **kwargs):
+	"""
+	Yield lines with since < time < until, like the awk filters this replaces.
+	rows keeps only the last lines of the window, grep then filters them.
+	"""
+	index = get_index(path)
+	lines = collections.deque(maxlen=int(kwargs.get('rows'))) if kwargs.get('rows') else []
+	grep = kwargs.get('grep')
+
+	with open(path, 'rb') as f:
+		for offset, end_offset in get_ranges(index['points'], since, until):
+			f.seek(offset)
+			pos = offset
+			for line in f:
+				if end_offset is not None and pos >= end_offset:
+					break
+				pos += len(line)
+				time = line_time(line)
+				if time is not None and since < time < until:
+					lines.append(line)
+
+	for line in lines:
+		line = line.decode(encoding='UTF-8', errors='replace')
+		if grep and not grep_match(grep, line):
+			continue
+		yield line
+
+
+def grep_match(grep, line):
+	try:
+		return re.search(grep, line) is not None
+	except re.error:
+		return grep in line
+
+
+def tail_start(inode, size, offset, last_inode, max_bytes):
+	if offset is None or int(offset) < 0:
+		start = size - max_bytes
+	elif str(inode) != str(last_inode) or int(offset) > size:
+		start = 0
+	else:
+		start = int(offset)
+	return max(start, size - max_bytes, 0)
+
+
+def split_tail(data, inode, start, size, offset, last_inode):
+	"""
+	Cut a read byte range to whole lines and return (inode, offset, rotated, lines).
+	The next call passes offset and inode back to get only the lines appended since.
+	"""
+	rotated = offset is not None and int(offset) >= 0 and (str(inode) != str(last_inode) or int(offset) > size)
+	if start > 0 and (offset is None or start != int(offset)) and not rotated:
+		data = data[data.find(b'\n') + 1:]
+	end = data.rfind(b'\n') + 1
+	lines = data[:end].decode(encoding='UTF-8', errors='replace').splitlines(True)
+
+	return inode, size - (len(data) - end), rotated, lines
+
+
+def tail(path, offset=None, inode=None, max_bytes=1048576):
+	with open(path, 'rb') as f:
+		stat = os.fstat(f.fileno())
+		start = tail_start(stat.st_ino, stat.st_size, offset, inode, max_bytes)
+		f.seek(start)
+		data = f.read(stat.st_size - start)
+
+	return split_tail(data, stat.st_ino, start, stat.st_size, offset, inode)
@@ -4,8 +4,8 @@ import cgi
 import funct
 import sql
 import os, http
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('logs.html')
 form = funct.form
 
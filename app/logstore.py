@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-"
+import os
+import re
+import gzip
+import json
+import time
+import collections
+
+# HAProxy lines collected from the servers are kept per server and hour as
+# gzip files. Each hour has a sidecar of parsed fields, one line per log line,
+# and a summary of the values seen, so a field query skips whole hours.
+fields = ('frontend', 'backend', 'status', 'client_ip', 'time')
+line_re = re.compile(r'\]: (?P<client_ip>[0-9a-fA-F.:]+):\d+ \[[^\]]+\] (?P<frontend>\S+) (?P<backend>[^/\s]+)/\S+ (?P<timers>[-+\d/]+) (?P<status>-?\d+)')
+# A field with more distinct values in an hour is marked as not summarised (None)
+# and its queries read the hour, so the summary of a busy hour stays small
+max_summary_values = 1000
+path = None
+
+
+def get_path():
+	global path
+	if path is None:
+		import funct
+		path = os.path.join(funct.get_config_var('main', 'fullpath'), 'log_store')
+	return path
+
+
+def server_dir(serv):
+	return os.path.join(get_path(), serv.replace('/', '_'))
+
+
+def parse(line):
+	"""
+	Return the parsed fields of an HAProxy http or tcp log line, empty strings when it does not match
+	"""
+	found = line_re.search(line)
+	if found is None:
+		return ('',) * len(fields)
+	timers = found.group('timers').split('/')
+	# A tcp log has three timers and the number after them is the bytes read, not a status
+	status = found.group('status') if len(timers) == 5 else ''
+	return found.group('frontend'), found.group('backend'), status, found.group('client_ip'), timers[-1].lstrip('+')
+
+
+def load_cursor(serv):
+	try:
+		with open(os.path.join(server_dir(serv), 'cursor.json'), 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+
+def save_cursor(serv, cursor):
+	cursor_file = os.path.join(server_dir(serv), 'cursor.json')
+	with open(cursor_file + '.tmp', 'w') as f:
+		json.dump(cursor, f)
+	os.replace(cursor_file + '.tmp', cursor_file)
+
+
+def load_summary(partition):
+	try:
+		with open(partition + '.json', 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {'lines': 0, 'values': {field: [] for field in fields[:-1]}}
+
+
+def line_partition(line, now):
+	"""
+	Return the hour of a line as YYYYMMDDHH, from its time or from now when it has none
+	"""
+	import logindex
+	line_time = logindex.line_time(line.encode('utf-8', 'replace'))
+	if line_time is None:
+		return time.strftime('%Y%m%d%H', time.localtime(now))
+	day = time.localtime(now)
+	hour, minute, second = (int(part) for part in line_time.split(':'))
+	ts = time.mktime((day.tm_year, day.tm_mon, day.tm_mday, hour, minute, second, 0, 0, -1))
+	# Syslog lines carry no year, a time well ahead of now was logged the day before
+	if ts > now + 3600:
+		ts -= 86400
+	return time.strftime('%Y%m%d%H', time.localtime(ts))
+
+
+def append(serv, lines, now=None):
+	"""
+	Append lines of one server to the partitions of the hours they were logged in
+	"""
+	if not lines:
+		return
+	if now is None:
+		now = time.time()
+	os.makedirs(server_dir(serv), exist_ok=True)
+	hours = collections.OrderedDict()
+	for line in lines:
+		hours.setdefault(line_partition(line, now), []).append(line)
+	for hour, hour_lines in hours.items():
+		append_partition(os.path.join(server_dir(serv), hour), hour_lines)
+
+
+def append_partition(partition, lines):
+	parsed = [parse(line) for line in lines]
+
+	# Every write adds a gzip member, gzip readers see the members as one stream
+	with gzip.open(partition + '.log.gz', 'at', encoding='utf-8') as f:
+		f.write(''.join(line if line.endswith('\n') else line + '\n' for line in lines))
+	with gzip.open(partition + '.idx.gz', 'at', encoding='utf-8') as f:
+		f.write(''.join('\t'.join(row) + '\n' for row in parsed))
+
+	summary = load_summary(partition)
+	summary['lines'] += len(lines)
+	for i, field in enumerate(fields[:-1]):
+		if summary['values'][field] is None:
+			continue
+		values = set(summary['values'][field])
+		values.update(row[i] for row in parsed if row[i])
+		summary['values'][field] = sorted(values) if len(values) <= max_summary_values else None
+	with open(partition + '.json.tmp', 'w') as f:
+		json.dump(summary, f)
+	os.replace(partition + '.json.tmp', partition + '.json')
+
+
+def has(serv):
+	return os.path.exists(os.path.join(server_dir(serv), 'cursor.json'))
+
+
+def partitions(serv, day, since, until):
+	try:
+		names = os.listdir(server_dir(serv))
+	except OSError:
+		return []
+	hours = sorted(name[:-len('.log.gz')] for name in names if name.endswith('.log.gz') and name.startswith(day))
+	return [os.path.join(server_dir(serv), hour) for hour in hours if since[:2] <= hour[-2:] <= until[:2]]
+
+
+def query(serv, since, until, **kwargs):
+	"""
+	Yield today's lines of serv with since < time < until, like show_haproxy_log does over SSH.
+	Keyword arguments named like fields keep only the lines with that parsed value,
+	min_time keeps requests that took at least that many ms, rows and grep work as in logindex.query.
+	Without rows the lines are read as they are yielded.
+	"""
+	import logindex
+	filters = dict((i, str(kwargs.get(field))) for i, field in enumerate(fields[:-1]) if kwargs.get(field))
+	min_time = int(kwargs.get('min_time')) if kwargs.get('min_time') else None
+	lines = scan(serv, since, until, filters, min_time, kwargs.get('day', time.strftime('%Y%m%d')))
+	if kwargs.get('rows'):
+		lines = collections.deque(lines, maxlen=int(kwargs.get('rows')))
+	grep = kwargs.get('grep')
+
+	for line in lines:
+		if grep and not logindex.grep_match(grep, line):
+			continue
+		yield line
+
+
+def scan(serv, since, until, filters, min_time, day):
+	import logindex
+	for partition in partitions(serv, day, since, until):
+		summary = load_summary(partition)
+		if any(summary['values'][fields[i]] is not None and value not in summary['values'][fields[i]] for i, value in filters.items()):
+			continue
+		with gzip.open(partition + '.log.gz', 'rt', encoding='utf-8', errors='replace') as log, \
+			gzip.open(partition + '.idx.gz', 'rt', encoding='utf-8') as idx:
+			for line, row in zip(log, idx):
+				row = row.rstrip('\n').split('\t')
+				if any(row[i] != value for i, value in filters.items()):
+					continue
+				if min_time is not None and (not row[-1].isdigit() or int(row[-1]) < min_time):
+					continue
+				line_time = logindex.line_time(line.encode('utf-8'))
+				if line_time is not None and since < line_time < until:
+					yield line
+
+
+def prune(retention, now=None):
+	"""
+	Remove the partitions older than retention days
+	"""
+	if now is None:
+		now = time.time()
+	oldest = time.strftime('%Y%m%d%H', time.localtime(now - int(retention) * 86400))
+	try:
+		servers = os.listdir(get_path())
+	except OSError:
+		return
+	for serv in servers:
+		serv_dir = os.path.join(get_path(), serv)
+		for name in os.listdir(serv_dir):
+			if name[:10].isdigit() and name[:10] < oldest:
+				try:
+					os.remove(os.path.join(serv_dir, name))
+				except OSError:
+					pass
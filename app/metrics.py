@@ -4,8 +4,8 @@ import sql
 import http.cookies
 import funct
 import sql
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('metrics.html')
 
 print('Content-type: text/html\n')
@@ -9,7 +9,7 @@ form = funct.form
 serv = form.getvalue('serv')
 act = form.getvalue('act')
 
-if form.getvalue('new_metrics') or form.getvalue('new_waf_metrics'):
+if form.getvalue('new_metrics') or form.getvalue('new_waf_metrics') or form.getvalue('tail_log'):
 	print('Content-type: application/json\n')
 else:
 	print('Content-type: text/html\n')
@@ -149,22 +149,26 @@ if form.getvalue('action_waf') is not None and serv is not None:
 if act == "overview":	
 	import asyncio
 	async def async_get_overview(serv1, serv2):
+		import haproxy_sock
 		server_status = ()
 		commands2 = [ "ps ax |grep waf/bin/modsecurity |grep -v grep |wc -l" ]
-		cmd = 'echo "show info" |nc %s %s -w 1|grep -e "Process_num"' % (serv2, sql.get_setting('haproxy_sock_port'))
+		try:
+			process_num = (await haproxy_sock.async_show_info(serv2)).get('Process_num', 0)
+		except (OSError, asyncio.TimeoutError):
+			process_num = 0
 		server_status = (serv1, 
 						serv2, 
-						funct.server_status(funct.subprocess_execute(cmd)), 
-						sql.select_servers(server=serv2, keep_alive=1),
-						funct.ssh_command(serv2, commands2),
-						sql.select_waf_servers(serv2))
+						process_num, 
+						await funct.run_in_pool(sql.select_servers, server=serv2, keep_alive=1),
+						await funct.run_in_pool(funct.ssh_command, serv2, commands2),
+						await funct.run_in_pool(sql.select_waf_servers, serv2))
 		return server_status
 
 
 	async def get_runner_overview():
 		import http.cookies
-		from jinja2 import Environment, FileSystemLoader
-		env = Environment(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
+		from jinja2 import FileSystemLoader
+		env = funct.get_env(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
 		
 		servers = []
 		template = env.get_template('overview.html')
@@ -179,7 +183,8 @@ if act == "overview":
 		print(template)
 	
 	
-	ioloop = asyncio.get_event_loop()
+	ioloop = asyncio.new_event_loop()
+	asyncio.set_event_loop(ioloop)
 	ioloop.run_until_complete(get_runner_overview())
 	ioloop.close()
 	
@@ -192,14 +197,18 @@ if act == "overviewwaf":
 		commands = [ "ps ax |grep waf/bin/modsecurity |grep -v grep |wc -l" ]
 		commands1 = [ "cat %s/waf/modsecurity.conf  |grep SecRuleEngine |grep -v '#' |awk '{print $2}'" % haproxy_dir ]
 		
-		server_status = (serv1,serv2, funct.ssh_command(serv2, commands), funct.ssh_command(serv2, commands1).strip(), sql.select_waf_metrics_enable_server(serv2))
+		server_status = (serv1,
+						serv2, 
+						await funct.run_in_pool(funct.ssh_command, serv2, commands), 
+						(await funct.run_in_pool(funct.ssh_command, serv2, commands1)).strip(), 
+						await funct.run_in_pool(sql.select_waf_metrics_enable_server, serv2))
 		return server_status
 
 
 	async def get_runner_overviewWaf(url):
 		import http.cookies
-		from jinja2 import Environment, FileSystemLoader
-		env = Environment(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
+		from jinja2 import FileSystemLoader
+		env = funct.get_env(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
 		template = env.get_template('overivewWaf.html')
 		
 		servers = []
@@ -213,7 +222,8 @@ if act == "overviewwaf":
 		template = template.render(service_status=servers_sorted, role=sql.get_user_role_by_uuid(user_id.value), url=url)
 		print(template)
 	
-	ioloop = asyncio.get_event_loop()
+	ioloop = asyncio.new_event_loop()
+	asyncio.set_event_loop(ioloop)
 	ioloop.run_until_complete(get_runner_overviewWaf(form.getvalue('page')))
 	ioloop.close()
 	
@@ -221,27 +231,27 @@ if act == "overviewwaf":
 if act == "overviewServers":
 	import asyncio	
 	async def async_get_overviewServers(serv1, serv2):
+		import haproxy_sock
 		server_status = ()
 		commands =  [ "top -u haproxy -b -n 1" ]
-		cmd = 'echo "show info" |nc %s %s -w 1|grep -e "Ver\|CurrConns\|Maxco\|MB\|Uptime:"' % (serv2, sql.get_setting('haproxy_sock_port'))
-		out = funct.subprocess_execute(cmd)
 		out1 = ""
 		
-		for k in out:
-			if "Ncat:" not in k:
-				for r in k:
-					out1 += r
-					out1 += "<br />"
-			else:
-				out1 = "Can\'t connect to HAproxy"
+		try:
+			info = await haproxy_sock.async_show_info(serv2)
+		except (OSError, asyncio.TimeoutError):
+			out1 = "Can\'t connect to HAproxy"
+		else:
+			for r in haproxy_sock.info_lines(info, ('Ver', 'CurrConns', 'Maxco', 'MB', 'Uptime:')):
+				out1 += r
+				out1 += "<br />"
 
-		server_status = (serv1,serv2, out1, funct.ssh_command(serv2, commands))
+		server_status = (serv1,serv2, out1, await funct.run_in_pool(funct.ssh_command, serv2, commands))
 		return server_status	
 		
 	async def get_runner_overviewServers(**kwargs):
 		import http.cookies
-		from jinja2 import Environment, FileSystemLoader
-		env = Environment(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
+		from jinja2 import FileSystemLoader
+		env = funct.get_env(loader=FileSystemLoader('templates/ajax'),extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.do'])
 		template = env.get_template('overviewServers.html')	
 		
 		servers = []	
@@ -259,15 +269,16 @@ if act == "overviewServers":
 	
 	id = form.getvalue('id')
 	name = form.getvalue('name')
-	ioloop = asyncio.get_event_loop()
+	ioloop = asyncio.new_event_loop()
+	asyncio.set_event_loop(ioloop)
 	ioloop.run_until_complete(get_runner_overviewServers(server1=name, server2=serv, id=id))
 	ioloop.close()
 
 	
 	
 if act == "overviewHapwi":
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'), autoescape=True)
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'), autoescape=True)
 	template = env.get_template('/overviewHapwi.html')
 	cmd = "top -b -n 1 |head -9"
 	server_status, stderr = funct.subprocess_execute(cmd)
@@ -341,34 +352,25 @@ if serv is not None and form.getvalue('rows') is not None:
 	
 	
 if serv is not None and form.getvalue('rows1') is not None:
+	import logindex
 	rows = form.getvalue('rows1')
 	grep = form.getvalue('grep')
 	hour = form.getvalue('hour')
 	minut = form.getvalue('minut')
 	hour1 = form.getvalue('hour1')
 	minut1 = form.getvalue('minut1')
-	date = hour+':'+minut
-	date1 = hour1+':'+minut1
+	date = hour+':'+minut+':00'
+	date1 = hour1+':'+minut1+':00'
 	apache_log_path = sql.get_setting('apache_log_path')
 	
-	if grep is not None:
-		grep_act  = '|grep'
-	else:
-		grep_act = ''
-		grep = ''
-		
-	if serv == 'haproxy-wi.access.log':
-		cmd="cat %s| awk -F\"/|:\" '$3>\"%s:00\" && $3<\"%s:00\"' |tail -%s  %s %s" % (apache_log_path+"/"+serv, date, date1, rows, grep_act, grep)
-	else:
-		cmd="cat %s| awk '$4>\"%s:00\" && $4<\"%s:00\"' |tail -%s  %s %s" % (apache_log_path+"/"+serv, date, date1, rows, grep_act, grep)
-
-	output, stderr = funct.subprocess_execute(cmd)
-
-	print(funct.show_log(output))
-	print(stderr)
+	try:
+		funct.print_log(logindex.query(os.path.join(apache_log_path, os.path.basename(serv)), date, date1, rows=rows, grep=grep))
+	except IOError as e:
+		print(e)
 	
 		
 if form.getvalue('viewlogs') is not None:
+	import logindex
 	viewlog = form.getvalue('viewlogs')
 	log_path = funct.get_config_var('main', 'log_path')
 	rows = form.getvalue('rows')
@@ -377,20 +379,40 @@ if form.getvalue('viewlogs') is not None:
 	minut = form.getvalue('minut')
 	hour1 = form.getvalue('hour1')
 	minut1 = form.getvalue('minut1')
-	date = hour+':'+minut
-	date1 = hour1+':'+minut1
+	date = hour+':'+minut+':00'
+	date1 = hour1+':'+minut1+':00'
 	
-	if grep is not None:
-		grep_act  = '|grep'
-	else:
-		grep_act = ''
-		grep = ''
-
-	cmd="cat %s| awk '$3>\"%s:00\" && $3<\"%s:00\"' |tail -%s  %s %s" % (log_path + viewlog, date, date1, rows, grep_act, grep)
-	output, stderr = funct.subprocess_execute(cmd)
-
-	print(funct.show_log(output))
-	print(stderr)
+	try:
+		funct.print_log(logindex.query(os.path.join(log_path, os.path.basename(viewlog)), date, date1, rows=rows, grep=grep))
+	except IOError as e:
+		print(e)
+		
+		
+if form.getvalue('tail_log') is not None:
+	import json
+	import logindex
+	tail_log = form.getvalue('tail_log')
+	offset = form.getvalue('offset')
+	inode = form.getvalue('inode')
+	grep = form.getvalue('grep')
+	# With start only the current end of the log is returned, the next calls tail from there
+	max_bytes = 0 if form.getvalue('start') else 1048576
+	
+	try:
+		if tail_log == 'apache':
+			path = os.path.join(sql.get_setting('apache_log_path'), os.path.basename(serv))
+			inode, offset, rotated, lines = logindex.tail(path, offset, inode, max_bytes)
+		elif tail_log == 'haproxywi':
+			path = os.path.join(funct.get_config_var('main', 'log_path'), os.path.basename(serv))
+			inode, offset, rotated, lines = logindex.tail(path, offset, inode, max_bytes)
+		else:
+			syslog_server, path = funct.get_haproxy_log_source(serv, waf='1' if tail_log == 'waf' else '0')
+			inode, offset, rotated, lines = funct.tail_remote_log(syslog_server, path, offset, inode, max_bytes)
+		if grep:
+			lines = [line for line in lines if logindex.grep_match(grep, line)]
+		print(json.dumps({'inode': inode, 'offset': offset, 'rotated': rotated, 'count': len(lines), 'lines': funct.show_log(lines)}))
+	except (IOError, ValueError) as e:
+		print(json.dumps({'error': str(e)}))
 		
 		
 if serv is not None and act == "showMap":
@@ -522,8 +544,8 @@ if form.getvalue('servaction') is not None:
 
 if act == "showCompareConfigs":
 	import glob
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/'), autoescape=True)
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/'), autoescape=True)
 	template = env.get_template('ajax/show_compare_configs.html')
 	left = form.getvalue('left')
 	right = form.getvalue('right')
@@ -533,12 +555,12 @@ if act == "showCompareConfigs":
 	
 	
 if serv is not None and form.getvalue('right') is not None:
-	from jinja2 import Environment, FileSystemLoader
+	from jinja2 import FileSystemLoader
 	left = form.getvalue('left')
 	right = form.getvalue('right')
 	hap_configs_dir = funct.get_config_var('configs', 'haproxy_save_configs_dir')
 	cmd='diff -ub %s%s %s%s' % (hap_configs_dir, left, hap_configs_dir, right)	
-	env = Environment(loader=FileSystemLoader('templates/'), autoescape=True, extensions=["jinja2.ext.loopcontrols", "jinja2.ext.do"])
+	env = funct.get_env(loader=FileSystemLoader('templates/'), autoescape=True, extensions=["jinja2.ext.loopcontrols", "jinja2.ext.do"])
 	template = env.get_template('ajax/compare.html')
 	
 	output, stderr = funct.subprocess_execute(cmd)
@@ -562,8 +584,8 @@ if serv is not None and act == "configShow":
 	except IOError:
 		print('<div class="alert alert-danger">Can\'t read import config file</div>')
 		
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'), autoescape=True, trim_blocks=True, lstrip_blocks=True, extensions=["jinja2.ext.loopcontrols", "jinja2.ext.do"])
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'), autoescape=True, trim_blocks=True, lstrip_blocks=True, extensions=["jinja2.ext.loopcontrols", "jinja2.ext.do"])
 	template = env.get_template('config_show.html')
 	
 	template = template.render(conf=conf, view=form.getvalue('view'), serv=serv, configver=form.getvalue('configver'), role=funct.is_admin(level=2))											
@@ -749,27 +771,65 @@ if form.getvalue('update_haproxy_wi'):
 	funct.update_haproxy_wi()
 	
 	
+if form.getvalue('update_db'):
+	import create_db
+	funct.page_for_admin()
+	create_db.update_all()
+	
+	
+if form.getvalue('check_new_version'):
+	funct.page_for_admin()
+	if funct.update_new_version():
+		print(funct.get_new_version())
+	else:
+		print('error: Cannot get new version')
+	
+	
 if form.getvalue('metrics_waf'):
 	sql.update_waf_metrics_enable(form.getvalue('metrics_waf'), form.getvalue('enable'))
 	
 		
 if form.getvalue('table_metrics'):
 	import http.cookies
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
 	template = env.get_template('table_metrics.html')
 		
 	cookie = http.cookies.SimpleCookie(os.environ.get("HTTP_COOKIE"))
 	user_id = cookie.get('uuid')	
 	table_stat = sql.select_table_metrics(user_id.value)
 
-	template = template.render(table_stat=sql.select_table_metrics(user_id.value))											
+	template = template.render(table_stat=table_stat)											
 	print(template)
 	
 	
+if form.getvalue('log_analytics'):
+	import loganalytics
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
+	template = env.get_template('log_analytics.html')
+	serv = form.getvalue('server')
+	
+	if sql.get_dick_permit(ip=serv):
+		try:
+			analytics = loganalytics.server_analytics(serv)
+		except IOError as e:
+			print('<div class="alert alert-danger">Cannot read the log of %s: %s</div>' % (funct.escape_html(serv), funct.escape_html(str(e))))
+		else:
+			template = template.render(serv=serv, analytics=analytics)
+			print(template)
+	
+	
 if form.getvalue('new_metrics'):
+	import time
 	serv = form.getvalue('server')
-	metric = sql.select_metrics(serv)
+	period = form.getvalue('period')
+	if period == '300':
+		metric = [i[:5] + (i[5][11:16],) for i in sql.select_metrics(serv, step=300, since=time.time() - 86400)]
+	elif period == '3600':
+		metric = [i[:5] + (i[5][5:16],) for i in sql.select_metrics(serv, step=3600, since=time.time() - 30*86400)]
+	else:
+		metric = [i[:5] + (i[5].split(' ')[1],) for i in sql.select_metrics(serv)]
 	metrics = {}
 	metrics['chartData'] = {}
 	metrics['chartData']['labels'] = {}
@@ -779,8 +839,7 @@ if form.getvalue('new_metrics'):
 	sess_rate = ''
 
 	for i in metric:
-		label = str(i[5])
-		label = label.split(' ')[1]
+		label = i[5]
 		#label = label.split(':')
 		#labels += label[0]+':'+label[1]+','
 		labels += label+','
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import funct, sql
 import create_db
+import daemons
 import os, http.cookies
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('ovw.html')
 	
 print('Content-type: text/html\n')
@@ -20,16 +21,11 @@ try:
 	users = sql.select_users()
 	groups = sql.select_groups()
 	token = sql.get_token(user_id.value)
-	cmd = "ps ax |grep checker_mas |grep -v grep |wc -l"
-	checker_master, stderr = funct.subprocess_execute(cmd)
-	cmd = "ps ax |grep checker_worker |grep -v grep |wc -l"
-	checker_worker, stderr = funct.subprocess_execute(cmd)
-	cmd = "ps ax |grep metrics_master |grep -v grep |wc -l"
-	metrics_master, stderr = funct.subprocess_execute(cmd)
-	cmd = "ps ax |grep -e 'metrics_worker\|metrics_waf_worker.py' |grep -v grep |wc -l"
-	metrics_worker, stderr = funct.subprocess_execute(cmd)
-	cmd = "ps ax |grep -e 'keep_alive.py' |grep -v grep |wc -l"
-	keep_alive, stderr = funct.subprocess_execute(cmd)
+	checker_master = str(daemons.count('checker_master'))
+	checker_worker = str(daemons.count('checker_master', targets=True))
+	metrics_master = str(daemons.count('metrics_master'))
+	metrics_worker = str(daemons.count('metrics_master', targets=True))
+	keep_alive = str(daemons.count('keep_alive'))
 	cmd = "ps ax |grep '(wsgi:api)'|grep -v grep|wc -l"
 	api, stderr = funct.subprocess_execute(cmd)
 except:
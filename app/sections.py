@@ -4,8 +4,8 @@ import os
 import http.cookies
 import funct
 import sql
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'), autoescape=True,extensions=['jinja2.ext.loopcontrols'])
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'), autoescape=True,extensions=['jinja2.ext.loopcontrols'])
 template = env.get_template('sections.html')
 
 print('Content-type: text/html\n')
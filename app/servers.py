@@ -5,8 +5,8 @@ import sys
 import os
 import funct
 import sql
-from jinja2 import Environment, FileSystemLoader
-env = Environment(extensions=["jinja2.ext.do"],loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(extensions=["jinja2.ext.do"],loader=FileSystemLoader('templates/'))
 template = env.get_template('servers.html')
 form = funct.form
 
@@ -20,15 +20,30 @@ def out_error(e):
 		error = e.args[0]
 	print('Content-type: text/html\n')
 	print('<span class="alert alert-danger" style="height: 20px;margin-bottom: 20px;" id="error">An error occurred: ' + error + ' <a title="Close" id="errorMess"><b>X</b></a></span>')
+	
+	
+statements = {}
+
+def statement(name, sql):
+	"""
+	Return a named statement written with ? placeholders in the style of the driver.
+	The text is built once, so every call sends the same query and hits the statement caches.
+	"""
+	if name not in statements:
+		statements[name] = sql.replace('?', '%s') if mysql_enable == '1' else sql
+	return statements[name]
 		
 def add_user(user, email, password, role, group, activeuser):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
 	if password != 'aduser':
-		sql = """INSERT INTO user (username, email, password, role, groups, activeuser) VALUES ('%s', '%s', '%s', '%s', '%s', '%s')""" % (user, email, funct.get_hash(password), role, group, activeuser)
+		sql = statement('add_user', """INSERT INTO user (username, email, password, role, groups, activeuser) VALUES (?, ?, ?, ?, ?, ?)""")
+		params = (user, email, funct.get_hash(password), role, group, activeuser)
 	else:
-		sql = """INSERT INTO user (username, email, role, groups, ldap_user, activeuser) VALUES ('%s', '%s', '%s', '%s', '1', '%s')""" % (user, email, role, group, activeuser)		
+		sql = statement('add_ldap_user', """INSERT INTO user (username, email, role, groups, ldap_user, activeuser) VALUES (?, ?, ?, ?, '1', ?)""")
+		params = (user, email, role, group, activeuser)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -40,15 +55,16 @@ def add_user(user, email, password, role, group, activeuser):
 	con.close()   
 	
 def update_user(user, email, role, group, id, activeuser):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """update user set username = '%s', 
-			email = '%s',
-			role = '%s', 
-			groups = '%s',
-			activeuser = '%s'
-			where id = '%s'""" % (user, email,  role, group, activeuser, id)
+	sql = statement('update_user', """update user set username = ?, 
+			email = ?,
+			role = ?, 
+			groups = ?,
+			activeuser = ?
+			where id = ?""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (user, email,  role, group, activeuser, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -62,10 +78,10 @@ def update_user(user, email, role, group, id, activeuser):
 	
 def update_user_password(password, id):
 	con, cur = create_db.get_cur()
-	sql = """update user set password = '%s'
-			where id = '%s'""" % (funct.get_hash(password), id)
+	sql = statement('update_user_password', """update user set password = ?
+			where id = ?""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (funct.get_hash(password), id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -78,10 +94,11 @@ def update_user_password(password, id):
 	
 
 def delete_user(id):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """delete from user where id = '%s'""" % (id)
+	sql = statement('delete_user', """delete from user where id = ?""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -91,10 +108,11 @@ def delete_user(id):
 	cur.close()
 	
 def add_group(name, description):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """INSERT INTO groups (name, description) VALUES ('%s', '%s')""" % (name, description)
+	sql = statement('add_group', """INSERT INTO groups (name, description) VALUES (?, ?)""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (name, description))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -107,10 +125,11 @@ def add_group(name, description):
 	con.close() 
 
 def delete_group(id):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """ delete from groups where id = '%s'""" % (id)
+	sql = statement('delete_group', """ delete from groups where id = ?""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -121,14 +140,15 @@ def delete_group(id):
 	con.close() 
 	
 def update_group(name, descript, id):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """ update groups set 
-		name = '%s',
-		description = '%s' 
-		where id = '%s';
-		""" % (name, descript, id)
+	sql = statement('update_group', """ update groups set 
+		name = ?,
+		description = ? 
+		where id = ?;
+		""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (name, descript, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -140,12 +160,13 @@ def update_group(name, descript, id):
 	con.close()
 
 def add_server(hostname, ip, group, typeip, enable, master, cred, alert, metrics, port, desc, active):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """ INSERT INTO servers (hostname, ip, groups, type_ip, enable, master, cred, alert, metrics, port, `desc`, active) 
-			VALUES ('%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s')
-		""" % (hostname, ip, group, typeip, enable, master, cred, alert, metrics, port, desc, active)
+	sql = statement('add_server', """ INSERT INTO servers (hostname, ip, groups, type_ip, enable, master, cred, alert, metrics, port, `desc`, active) 
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+		""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (hostname, ip, group, typeip, enable, master, cred, alert, metrics, port, desc, active))
 		con.commit()
 		return True
 	except sqltool.Error as e:
@@ -156,10 +177,11 @@ def add_server(hostname, ip, group, typeip, enable, master, cred, alert, metrics
 	con.close() 	
 
 def delete_server(id):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """ delete from servers where id = '%s'""" % (id)
+	sql = statement('delete_server', """ delete from servers where id = ?""")
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -170,23 +192,24 @@ def delete_server(id):
 	con.close() 		
 
 def update_server(hostname, ip, group, typeip, enable, master, id, cred, alert, metrics, port, desc, active):
-	con, cur = create_db.get_cur()
-	sql = """ update servers set 
-			hostname = '%s',
-			ip = '%s',
-			groups = '%s',
-			type_ip = '%s',
-			enable = '%s',
-			master = '%s',
-			cred = '%s',
-			alert = '%s',
-			metrics = '%s',
-			port = '%s',
-			`desc` = '%s',
-			active = '%s'
-			where id = '%s'""" % (hostname, ip, group, typeip, enable, master, cred, alert, metrics, port, desc, active, id)
-	try:    
-		cur.execute(sql)
+	invalidate_permit_cache()
+	con, cur = create_db.get_cur()
+	sql = statement('update_server', """ update servers set 
+			hostname = ?,
+			ip = ?,
+			groups = ?,
+			type_ip = ?,
+			enable = ?,
+			master = ?,
+			cred = ?,
+			alert = ?,
+			metrics = ?,
+			port = ?,
+			`desc` = ?,
+			active = ?
+			where id = ?""")
+	try:    
+		cur.execute(sql, (hostname, ip, group, typeip, enable, master, cred, alert, metrics, port, desc, active, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -195,16 +218,18 @@ def update_server(hostname, ip, group, typeip, enable, master, id, cred, alert,
 	con.close()
 
 def update_server_master(master, slave):
+	invalidate_permit_cache()
 	con, cur = create_db.get_cur()
-	sql = """ select id from servers where ip = '%s' """ % master
+	sql = statement('select_server_id_by_ip', """ select id from servers where ip = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (master,))
 	except sqltool.Error as e:
 		out_error(e)
-	for id in cur.fetchall():
-		sql = """ update servers set master = '%s' where ip = '%s' """ % (id[0], slave)
+	sql = statement('update_server_master', """ update servers set master = ? where ip = ? """)
+	ids = cur.fetchall()
 	try:    
-		cur.execute(sql)
+		for id in ids:
+			cur.execute(sql, (id[0], slave))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -214,11 +239,13 @@ def update_server_master(master, slave):
 	
 def select_users(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from user ORDER BY id"""
+	sql = statement('select_users', """select * from user ORDER BY id""")
+	params = ()
 	if kwargs.get("user") is not None:
-		sql = """select * from user where username='%s' """ % kwargs.get("user")
+		sql = statement('select_user', """select * from user where username=? """)
+		params = (kwargs.get("user"),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -228,11 +255,13 @@ def select_users(**kwargs):
 	
 def select_groups(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from groups ORDER BY id"""
+	sql = statement('select_groups', """select * from groups ORDER BY id""")
+	params = ()
 	if kwargs.get("group") is not None:
-		sql = """select * from groups where name='%s' """ % kwargs.get("group")
+		sql = statement('select_group', """select * from groups where name=? """)
+		params = (kwargs.get("group"),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -242,9 +271,9 @@ def select_groups(**kwargs):
 	
 def select_user_name_group(id):
 	con, cur = create_db.get_cur()
-	sql = """select name from groups where id='%s' """ % id
+	sql = statement('select_user_name_group', """select name from groups where id=? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -256,9 +285,9 @@ def select_user_name_group(id):
 	
 def select_server_by_name(name):
 	con, cur = create_db.get_cur()
-	sql = """select ip from servers where hostname='%s' """ % name
+	sql = statement('select_server_by_name', """select ip from servers where hostname=? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (name,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -270,30 +299,39 @@ def select_server_by_name(name):
 	
 def select_servers(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from servers where enable = '1' ORDER BY groups """
+	sql = statement('select_servers', """select * from servers where enable = '1' ORDER BY groups """)
+	params = ()
 	
 	if kwargs.get("server") is not None:
-		sql = """select * from servers where ip='%s' """ % kwargs.get("server")
+		sql = statement('select_server', """select * from servers where ip=? """)
+		params = (kwargs.get("server"),)
 	if kwargs.get("full") is not None:
-		sql = """select * from servers ORDER BY hostname """ 
+		sql = statement('select_servers_full', """select * from servers ORDER BY hostname """)
+		params = ()
 	if kwargs.get("get_master_servers") is not None:
-		sql = """select id,hostname from servers where master = 0 and type_ip = 0 and enable = 1 ORDER BY groups """ 
+		sql = statement('select_master_servers', """select id,hostname from servers where master = 0 and type_ip = 0 and enable = 1 ORDER BY groups """)
+		params = ()
 	if kwargs.get("get_master_servers") is not None and kwargs.get('uuid') is not None:
-		sql = """ select servers.id, servers.hostname from servers 
+		sql = statement('select_master_servers_by_uuid', """ select servers.id, servers.hostname from servers 
 			left join user as user on servers.groups = user.groups 
 			left join uuid as uuid on user.id = uuid.user_id 
-			where uuid.uuid = '%s' and servers.master = 0 and servers.type_ip = 0 and servers.enable = 1 ORDER BY servers.groups 
-			""" % kwargs.get('uuid')
+			where uuid.uuid = ? and servers.master = 0 and servers.type_ip = 0 and servers.enable = 1 ORDER BY servers.groups 
+			""")
+		params = (kwargs.get('uuid'),)
 	if kwargs.get("id"):
-		sql = """select * from servers where id='%s' """ % kwargs.get("id")
+		sql = statement('select_server_by_id', """select * from servers where id=? """)
+		params = (kwargs.get("id"),)
 	if kwargs.get("hostname"):
-		sql = """select * from servers where hostname='%s' """ % kwargs.get("hostname")
+		sql = statement('select_server_by_hostname', """select * from servers where hostname=? """)
+		params = (kwargs.get("hostname"),)
 	if kwargs.get("id_hostname"):
-		sql = """select * from servers where hostname='%s' or id = '%s' or ip = '%s'""" % (kwargs.get("id_hostname"), kwargs.get("id_hostname"), kwargs.get("id_hostname"))
+		sql = statement('select_server_by_id_hostname', """select * from servers where hostname=? or id = ? or ip = ?""")
+		params = (kwargs.get("id_hostname"), kwargs.get("id_hostname"), kwargs.get("id_hostname"))
 	if kwargs.get("server") and kwargs.get("keep_alive"):
-		sql = """select active from servers where ip='%s' """ % kwargs.get("server")
+		sql = statement('select_server_active', """select active from servers where ip=? """)
+		params = (kwargs.get("server"),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -305,18 +343,20 @@ def write_user_uuid(login, user_uuid):
 	con, cur = create_db.get_cur()
 	session_ttl = get_setting('session_ttl')
 	session_ttl = int(session_ttl)
-	sql = """ select id from user where username = '%s' """ % login
+	sql = statement('select_user_id', """ select id from user where username = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (login,))
 	except sqltool.Error as e:
 		out_error(e)
 	for id in cur.fetchall():
 		if mysql_enable == '1':
-			sql = """ insert into uuid (user_id, uuid, exp) values('%s', '%s',  now()+ INTERVAL '%s' day) """ % (id[0], user_uuid, session_ttl)
+			sql = statement('insert_uuid', """ insert into uuid (user_id, uuid, exp) values(?, ?,  now()+ INTERVAL ? day) """)
+			params = (id[0], user_uuid, session_ttl)
 		else:
-			sql = """ insert into uuid (user_id, uuid, exp) values('%s', '%s',  datetime('now', '+%s days')) """ % (id[0], user_uuid, session_ttl)
+			sql = statement('insert_uuid', """ insert into uuid (user_id, uuid, exp) values(?, ?,  datetime('now', ?)) """)
+			params = (id[0], user_uuid, '+%s days' % session_ttl)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -327,18 +367,20 @@ def write_user_uuid(login, user_uuid):
 def write_user_token(login, user_token):
 	con, cur = create_db.get_cur()
 	token_ttl = get_setting('token_ttl')	
-	sql = """ select id from user where username = '%s' """ % login
+	sql = statement('select_user_id', """ select id from user where username = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (login,))
 	except sqltool.Error as e:
 		print('<span class="alert alert-danger" id="error">An error occurred: ' + e.args[0] + ' <a title="Close" id="errorMess"><b>X</b></a></span>')
 	for id in cur.fetchall():
 		if mysql_enable == '1':
-			sql = """ insert into token (user_id, token, exp) values('%s', '%s',  now()+ INTERVAL %s day) """ % (id[0], user_token, token_ttl)
+			sql = statement('insert_token', """ insert into token (user_id, token, exp) values(?, ?,  now()+ INTERVAL ? day) """)
+			params = (id[0], user_token, int(token_ttl))
 		else:
-			sql = """ insert into token (user_id, token, exp) values('%s', '%s',  datetime('now', '+%s days')) """ % (id[0], user_token, token_ttl)
+			sql = statement('insert_token', """ insert into token (user_id, token, exp) values(?, ?,  datetime('now', ?)) """)
+			params = (id[0], user_token, '+%s days' % token_ttl)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -346,24 +388,99 @@ def write_user_token(login, user_token):
 	cur.close()    
 	con.close()
 	
-def get_token(uuid):
+session_cache = {}
+session_cache_ttl = 30
+session_cache_max = 1000
+# Touched on logout, so the other processes drop their cached sessions
+session_cache_stamp_file = None
+session_cache_stamp = None
+
+def get_session_stamp_file():
+	global session_cache_stamp_file
+	if session_cache_stamp_file is None:
+		import os
+		import tempfile
+		session_cache_stamp_file = os.path.join(tempfile.gettempdir(), 'haproxy-wi-sessions.stamp')
+	return session_cache_stamp_file
+	
+def check_session_stamp():
+	global session_cache_stamp
+	import os
+	try:
+		stamp = os.stat(get_session_stamp_file()).st_mtime
+	except OSError:
+		stamp = None
+	if stamp != session_cache_stamp:
+		session_cache.clear()
+		session_cache_stamp = stamp
+		
+def cache_session(uuid, session, expires):
+	import time
+	now = time.time()
+	if len(session_cache) >= session_cache_max:
+		for key, cached in list(session_cache.items()):
+			if now - cached[0] >= session_cache_ttl or now >= cached[2]:
+				del session_cache[key]
+		if len(session_cache) >= session_cache_max:
+			session_cache.clear()
+	session_cache[uuid] = (now, session, expires)
+
+def get_session(uuid):
+	"""
+	Return (user_id, username, role_id, groups, token, needs_touch) of a live session, or None.
+	needs_touch is 1 when the last activity was written more than a minute ago.
+	"""
+	import time
+	check_session_stamp()
+	cached = session_cache.get(uuid)
+	if cached is not None and time.time() - cached[0] < session_cache_ttl and time.time() < cached[2]:
+		return cached[1]
+		
+	session_ttl = get_setting('session_ttl')
 	con, cur = create_db.get_cur()
-	sql = """ select token.token from token left join uuid as uuid on uuid.user_id = token.user_id where uuid.uuid = '%s' """ % uuid
-	try:    
-		cur.execute(sql)
+	if mysql_enable == '1':
+		sql = statement('get_session', """ select user.id, user.username, role.id, user.groups, token.token, (case when uuid.exp < now() + INTERVAL ? DAY - INTERVAL 60 SECOND then 1 else 0 end), 
+			timestampdiff(SECOND, now(), uuid.exp) 
+			from uuid join user on user.id = uuid.user_id left join role on role.name = user.role left join token on token.user_id = user.id and token.exp > now() 
+			where uuid.uuid = ? and uuid.exp > now() order by token.exp desc """)
+		params = (int(session_ttl), uuid)
+	else:
+		sql = statement('get_session', """ select user.id, user.username, role.id, user.groups, token.token, (case when uuid.exp < datetime('now', ?, '-60 seconds') then 1 else 0 end), 
+			strftime('%s', uuid.exp) - strftime('%s', 'now') 
+			from uuid join user on user.id = uuid.user_id left join role on role.name = user.role left join token on token.user_id = user.id and token.exp > datetime('now') 
+			where uuid.uuid = ? and uuid.exp > datetime('now') order by token.exp desc """)
+		params = ('+%s days' % session_ttl, uuid)
+	try:
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
-		for token in cur.fetchall():
-			return token[0]				
-	cur.close()    
-	con.close()
+		session = cur.fetchone()
+		if session is None:
+			return None
+		cache_session(uuid, session[:6], time.time() + int(session[6]))
+		return session[:6]
+	finally:
+		cur.close()    
+		con.close()
+		
+def get_token(uuid):
+	session = get_session(uuid)
+	if session is not None:
+		return session[4]
 	
 def delete_uuid(uuid):
+	import os
+	session_cache.pop(uuid, None)
+	try:
+		with open(get_session_stamp_file(), 'a'):
+			os.utime(get_session_stamp_file())
+	except OSError:
+		pass
 	con, cur = create_db.get_cur()
-	sql = """ delete from uuid where uuid = '%s' """ % uuid
+	sql = statement('delete_uuid', """ delete from uuid where uuid = ? """)
 	try:
-		cur.execute(sql)		
+		cur.execute(sql, (uuid,))
 		con.commit()
 	except sqltool.Error as e:
 		pass
@@ -389,15 +506,22 @@ def delete_old_uuid():
 	con.close()		
 
 def update_last_act_user(uuid):
-	con, cur = create_db.get_cur()
+	import time
+	session = get_session(uuid)
+	if session is None or not session[5]:
+		return
 	session_ttl = get_setting('session_ttl')
+	cache_session(uuid, session[:5] + (0,), time.time() + int(session_ttl) * 86400)
+	con, cur = create_db.get_cur()
 	
 	if mysql_enable == '1':
-		sql = """ update uuid set exp = now()+ INTERVAL %s day where uuid = '%s' """ % (session_ttl, uuid)
+		sql = statement('update_last_act_user', """ update uuid set exp = now()+ INTERVAL ? day where uuid = ? """)
+		params = (int(session_ttl), uuid)
 	else:
-		sql = """ update uuid set exp = datetime('now', '+%s days') where uuid = '%s' """ % (session_ttl, uuid)
+		sql = statement('update_last_act_user', """ update uuid set exp = datetime('now', ?) where uuid = ? """)
+		params = ('+%s days' % session_ttl, uuid)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -406,37 +530,21 @@ def update_last_act_user(uuid):
 	con.close()
 	
 def get_user_name_by_uuid(uuid):
-	con, cur = create_db.get_cur()
-	sql = """ select user.username from user left join uuid as uuid on user.id = uuid.user_id where uuid.uuid = '%s' """ % uuid
-	try:
-		cur.execute(sql)		
-	except sqltool.Error as e:
-		out_error(e)
-	else:
-		for user_id in cur.fetchall():
-			return user_id[0]
-	cur.close()    
-	con.close() 
+	session = get_session(uuid)
+	if session is not None:
+		return session[1]
 	
 def get_user_role_by_uuid(uuid):
-	con, cur = create_db.get_cur()
-	sql = """ select role.id from user left join uuid as uuid on user.id = uuid.user_id left join role on role.name = user.role where uuid.uuid = '%s' """ % uuid
-	try:
-		cur.execute(sql)		
-	except sqltool.Error as e:
-		out_error(e)
-	else:
-		for user_id in cur.fetchall():
-			return user_id[0]
-	cur.close()    
-	con.close() 
+	session = get_session(uuid)
+	if session is not None:
+		return session[2]
 	
 	
 def get_role_id_by_name(name):
 	con, cur = create_db.get_cur()
-	sql = """ select id from role where name = '%s' """ % name
+	sql = statement('get_role_id_by_name', """ select id from role where name = ? """)
 	try:
-		cur.execute(sql)		
+		cur.execute(sql, (name,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -447,23 +555,15 @@ def get_role_id_by_name(name):
 	
 	
 def get_user_group_by_uuid(uuid):
-	con, cur = create_db.get_cur()
-	sql = """ select user.groups from user left join uuid as uuid on user.id = uuid.user_id  where uuid.uuid = '%s' """ % uuid
-	try:
-		cur.execute(sql)		
-	except sqltool.Error as e:
-		out_error(e)
-	else:
-		for user_id in cur.fetchall():
-			return user_id[0]
-	cur.close()    
-	con.close() 
+	session = get_session(uuid)
+	if session is not None:
+		return session[3]
 
 def get_user_telegram_by_uuid(uuid):
 	con, cur = create_db.get_cur()
-	sql = """ select telegram.* from telegram left join user as user on telegram.groups = user.groups left join uuid as uuid on user.id = uuid.user_id where uuid.uuid = '%s' """ % uuid
+	sql = statement('get_user_telegram_by_uuid', """ select telegram.* from telegram left join user as user on telegram.groups = user.groups left join uuid as uuid on user.id = uuid.user_id where uuid.uuid = ? """)
 	try:
-		cur.execute(sql)		
+		cur.execute(sql, (uuid,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -473,9 +573,9 @@ def get_user_telegram_by_uuid(uuid):
 	
 def get_telegram_by_ip(ip):
 	con, cur = create_db.get_cur()
-	sql = """ select telegram.* from telegram left join servers as serv on serv.groups = telegram.groups where serv.ip = '%s' """ % ip
+	sql = statement('get_telegram_by_ip', """ select telegram.* from telegram left join servers as serv on serv.groups = telegram.groups where serv.ip = ? """)
 	try:
-		cur.execute(sql)		
+		cur.execute(sql, (ip,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -483,40 +583,78 @@ def get_telegram_by_ip(ip):
 	cur.close()    
 	con.close()
 
+permit_cache = {}
+permit_cache_version = 0
+permit_cache_ttl = 30
+permit_cache_max = 1000
+	
+def invalidate_permit_cache():
+	global permit_cache_version
+	permit_cache_version += 1
+	session_cache.clear()
+	funct.ssh_pool_forget()
+	
 def get_dick_permit(**kwargs):
 	import http.cookies
 	import os
+	import time
 	cookie = http.cookies.SimpleCookie(os.environ.get("HTTP_COOKIE"))
 	user_id = cookie.get('uuid')
 	disable = ''
-	ip = ''
 	
-	con, cur = create_db.get_cur()
-	if kwargs.get('username'):
-		sql = """ select * from user where username = '%s' """ % kwargs.get('username')
-	else:
-		sql = """ select * from user where username = '%s' """ % get_user_name_by_uuid(user_id.value)
 	if kwargs.get('virt'):
 		type_ip = "" 
 	else:
 		type_ip = "and type_ip = 0" 
 	if kwargs.get('disable') == 0:
 		disable = 'or enable = 0'
+		
+	if kwargs.get('username'):
+		key = ('username', kwargs.get('username'), type_ip, disable)
+	else:
+		key = ('uuid', user_id.value, type_ip, disable)
+	cached = permit_cache.get(key)
+	
+	if cached is not None and cached[0] == permit_cache_version and time.time() - cached[1] < permit_cache_ttl:
+		servers = cached[2]
+	else:
+		servers = select_permit_servers(kwargs.get('username') or get_user_name_by_uuid(user_id.value), type_ip, disable)
+		if servers is None:
+			return None
+		now = time.time()
+		if len(permit_cache) >= permit_cache_max:
+			for old_key, old in list(permit_cache.items()):
+				if old[0] != permit_cache_version or now - old[1] >= permit_cache_ttl:
+					del permit_cache[old_key]
+			if len(permit_cache) >= permit_cache_max:
+				permit_cache.clear()
+		permit_cache[key] = (permit_cache_version, now, servers)
+			
 	if kwargs.get('ip'):
-		ip = "and ip = '%s'" % kwargs.get('ip')
-				
+		return [server for server in servers if server[2] == kwargs.get('ip')]
+	return servers
+	
+def select_permit_servers(username, type_ip, disable):
+	con, cur = create_db.get_cur()
+	sql = statement('select_user_by_name', """ select * from user where username = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (username,))
 	except sqltool.Error as e:
 		print("An error occurred:", e)
 	else:
-		for group in cur:
+		sql = None
+		# disable and type_ip are fixed fragments from get_dick_permit, not user input
+		for group in cur.fetchall():
 			if group[5] == '1':
-				sql = """ select * from servers where enable = 1 %s %s """ % (disable, type_ip)
+				sql = statement('select_permit_servers_all %s %s' % (disable, type_ip), """ select * from servers where enable = 1 %s %s """ % (disable, type_ip))
+				params = ()
 			else:
-				sql = """ select * from servers where groups like '%{group}%' and (enable = 1 {disable}) {type_ip} {ip} """.format(group=group[5], disable=disable, type_ip=type_ip, ip=ip)		
+				sql = statement('select_permit_servers %s %s' % (disable, type_ip), """ select * from servers where groups like ? and (enable = 1 {disable}) {type_ip} """.format(disable=disable, type_ip=type_ip))
+				params = ('%' + str(group[5]) + '%',)
+		if sql is None:
+			return []
 		try:   
-			cur.execute(sql)
+			cur.execute(sql, params)
 		except sqltool.Error as e:
 			out_error(e)
 		else:
@@ -526,11 +664,13 @@ def get_dick_permit(**kwargs):
 	
 def is_master(ip, **kwargs):
 	con, cur = create_db.get_cur()
-	sql = """ select slave.ip from servers as master left join servers as slave on master.id = slave.master where master.ip = '%s' """ % ip
+	sql = statement('is_master', """ select slave.ip from servers as master left join servers as slave on master.id = slave.master where master.ip = ? """)
+	params = (ip,)
 	if kwargs.get('master_slave'):
-		sql = """ select master.hostname, master.ip, slave.hostname, slave.ip from servers as master left join servers as slave on master.id = slave.master where slave.master > 0 """
+		sql = statement('select_master_slave', """ select master.hostname, master.ip, slave.hostname, slave.ip from servers as master left join servers as slave on master.id = slave.master where slave.master > 0 """)
+		params = ()
 	try:
-		cur.execute(sql)		
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -540,15 +680,19 @@ def is_master(ip, **kwargs):
 	
 def select_ssh(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from cred """
+	sql = statement('select_ssh', """select * from cred """)
+	params = ()
 	if kwargs.get("name") is not None:
-		sql = """select * from cred where name = '%s' """ % kwargs.get("name")
+		sql = statement('select_ssh_by_name', """select * from cred where name = ? """)
+		params = (kwargs.get("name"),)
 	if kwargs.get("id") is not None:
-		sql = """select * from cred where id = '%s' """ % kwargs.get("id")
+		sql = statement('select_ssh_by_id', """select * from cred where id = ? """)
+		params = (kwargs.get("id"),)
 	if kwargs.get("serv") is not None:
-		sql = """select serv.cred, cred.* from servers as serv left join cred on cred.id = serv.cred where serv.ip = '%s' """ % kwargs.get("serv")
+		sql = statement('select_ssh_by_serv', """select serv.cred, cred.*, serv.port from servers as serv left join cred on cred.id = serv.cred where serv.ip = ? """)
+		params = (kwargs.get("serv"),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -558,9 +702,9 @@ def select_ssh(**kwargs):
 	
 def insert_new_ssh(name, enable, group, username, password):
 	con, cur = create_db.get_cur()
-	sql = """insert into cred(name, enable, groups, username, password) values ('%s', '%s', '%s', '%s', '%s') """ % (name, enable, group, username, password)
+	sql = statement('insert_new_ssh', """insert into cred(name, enable, groups, username, password) values (?, ?, ?, ?, ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (name, enable, group, username, password))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -571,10 +715,11 @@ def insert_new_ssh(name, enable, group, username, password):
 	con.close() 
 	
 def delete_ssh(id):
+	funct.ssh_pool_forget(id)
 	con, cur = create_db.get_cur()
-	sql = """ delete from cred where id = %s """ % (id)
+	sql = statement('delete_ssh', """ delete from cred where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -585,15 +730,16 @@ def delete_ssh(id):
 	con.close() 
 
 def update_ssh(id, name, enable, group, username, password):
+	funct.ssh_pool_forget(id)
 	con, cur = create_db.get_cur()
-	sql = """ update cred set 
-			name = '%s',
-			enable = '%s',
-			groups = %s,
-			username = '%s',
-			password = '%s' where id = '%s' """ % (name, enable, group, username, password, id)
+	sql = statement('update_ssh', """ update cred set 
+			name = ?,
+			enable = ?,
+			groups = ?,
+			username = ?,
+			password = ? where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (name, enable, group, username, password, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -602,8 +748,8 @@ def update_ssh(id, name, enable, group, username, password):
 	con.close()
 	
 def show_update_ssh(name, page):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
 	template = env.get_template('/new_ssh.html')
 
 	print('Content-type: text/html\n')
@@ -612,9 +758,9 @@ def show_update_ssh(name, page):
 
 def insert_new_telegram(token, chanel, group):
 	con, cur = create_db.get_cur()
-	sql = """insert into telegram(`token`, `chanel_name`, `groups`) values ('%s', '%s', '%s') """ % (token, chanel, group)
+	sql = statement('insert_new_telegram', """insert into telegram(`token`, `chanel_name`, `groups`) values (?, ?, ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (token, chanel, group))
 		con.commit()
 	except sqltool.Error as e:
 		print('<span class="alert alert-danger" id="error">An error occurred: ' + e.args[0] + ' <a title="Close" id="errorMess"><b>X</b></a></span>')
@@ -626,9 +772,9 @@ def insert_new_telegram(token, chanel, group):
 
 def delete_telegram(id):
 	con, cur = create_db.get_cur()
-	sql = """ delete from telegram where id = %s """ % (id)
+	sql = statement('delete_telegram', """ delete from telegram where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -640,13 +786,16 @@ def delete_telegram(id):
 	
 def select_telegram(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from telegram  """
+	sql = statement('select_telegram', """select * from telegram  """)
+	params = ()
 	if kwargs.get('group'):
-		sql = """select * from telegram where groups = '%s' """ % kwargs.get('group')
+		sql = statement('select_telegram_by_group', """select * from telegram where groups = ? """)
+		params = (kwargs.get('group'),)
 	if kwargs.get('token'):
-		sql = """select * from telegram where token = '%s' """ % kwargs.get('token')
+		sql = statement('select_telegram_by_token', """select * from telegram where token = ? """)
+		params = (kwargs.get('token'),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -656,9 +805,9 @@ def select_telegram(**kwargs):
 	
 def insert_new_telegram(token, chanel, group):
 	con, cur = create_db.get_cur()
-	sql = """insert into telegram(`token`, `chanel_name`, `groups`) values ('%s', '%s', '%s') """ % (token, chanel, group)
+	sql = statement('insert_new_telegram', """insert into telegram(`token`, `chanel_name`, `groups`) values (?, ?, ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (token, chanel, group))
 		con.commit()
 	except sqltool.Error as e:
 		print('<span class="alert alert-danger" id="error">An error occurred: ' + e.args[0] + ' <a title="Close" id="errorMess"><b>X</b></a></span>')
@@ -670,13 +819,13 @@ def insert_new_telegram(token, chanel, group):
 	
 def update_telegram(token, chanel, group, id):
 	con, cur = create_db.get_cur()
-	sql = """ update telegram set 
-			`token` = '%s',
-			`chanel_name` = '%s',
-			`groups` = '%s'
-			where id = '%s' """ % (token, chanel, group, id)
+	sql = statement('update_telegram', """ update telegram set 
+			`token` = ?,
+			`chanel_name` = ?,
+			`groups` = ?
+			where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (token, chanel, group, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -686,9 +835,9 @@ def update_telegram(token, chanel, group, id):
 	
 def insert_new_option(option, group):
 	con, cur = create_db.get_cur()
-	sql = """insert into options(`options`, `groups`) values ('%s', '%s') """ % (option, group)
+	sql = statement('insert_new_option', """insert into options(`options`, `groups`) values (?, ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (option, group))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -700,13 +849,16 @@ def insert_new_option(option, group):
 	
 def select_options(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from options  """
+	sql = statement('select_options', """select * from options  """)
+	params = ()
 	if kwargs.get('option'):
-		sql = """select * from options where options = '%s' """ % kwargs.get('option')
+		sql = statement('select_option', """select * from options where options = ? """)
+		params = (kwargs.get('option'),)
 	if kwargs.get('group'):
-		sql = """select options from options where groups = '{}' and options like '{}%' """.format(kwargs.get('group'), kwargs.get('term'))
+		sql = statement('select_options_by_term', """select options from options where groups = ? and options like ? """)
+		params = (kwargs.get('group'), '%s%%' % kwargs.get('term'))
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -716,11 +868,11 @@ def select_options(**kwargs):
 	
 def update_options(option, id):
 	con, cur = create_db.get_cur()
-	sql = """ update options set 
-			options = '%s'
-			where id = '%s' """ % (option, id)
+	sql = statement('update_options', """ update options set 
+			options = ?
+			where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (option, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -730,9 +882,9 @@ def update_options(option, id):
 	
 def delete_option(id):
 	con, cur = create_db.get_cur()
-	sql = """ delete from options where id = %s """ % (id)
+	sql = statement('delete_option', """ delete from options where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -745,9 +897,9 @@ def delete_option(id):
 	
 def insert_new_savedserver(server, description, group):
 	con, cur = create_db.get_cur()
-	sql = """insert into saved_servers(`server`, `description`, `groups`) values ('%s', '%s', '%s') """ % (server, description, group)
+	sql = statement('insert_new_savedserver', """insert into saved_servers(`server`, `description`, `groups`) values (?, ?, ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (server, description, group))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -759,13 +911,16 @@ def insert_new_savedserver(server, description, group):
 	
 def select_saved_servers(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from saved_servers  """
+	sql = statement('select_saved_servers', """select * from saved_servers  """)
+	params = ()
 	if kwargs.get('server'):
-		sql = """select * from saved_servers where server = '%s' """ % kwargs.get('server')
+		sql = statement('select_saved_server', """select * from saved_servers where server = ? """)
+		params = (kwargs.get('server'),)
 	if kwargs.get('group'):
-		sql = """select server,description from saved_servers where groups = '{}' and server like '{}%' """.format(kwargs.get('group'), kwargs.get('term'))
+		sql = statement('select_saved_servers_by_term', """select server,description from saved_servers where groups = ? and server like ? """)
+		params = (kwargs.get('group'), '%s%%' % kwargs.get('term'))
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -775,12 +930,12 @@ def select_saved_servers(**kwargs):
 	
 def update_savedserver(server, description, id):
 	con, cur = create_db.get_cur()
-	sql = """ update saved_servers set 
-			server = '%s',
-			description = '%s'
-			where id = '%s' """ % (server, description, id)
+	sql = statement('update_savedserver', """ update saved_servers set 
+			server = ?,
+			description = ?
+			where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (server, description, id))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -790,9 +945,9 @@ def update_savedserver(server, description, id):
 	
 def delete_savedserver(id):
 	con, cur = create_db.get_cur()
-	sql = """ delete from saved_servers where id = %s """ % (id)
+	sql = statement('delete_savedserver', """ delete from saved_servers where id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -803,14 +958,88 @@ def delete_savedserver(id):
 	con.close() 
 	
 	
-def insert_mentrics(serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate):
+def insert_tsdb_metrics(kind, metrics):
+	import tsdb
+	series = {}
+	for metric in metrics:
+		series.setdefault(metric[0], []).append((date_to_ts(metric[-1]),) + tuple(metric[1:-1]))
+	
+	for serv, rows in series.items():
+		tsdb.insert(kind, serv, sorted(rows))
+		
+		
+def insert_mentrics_many(metrics):
+	db = create_db.get_cur()
+	if db is None:
+		funct.logging('localhost', ' Cannot save metrics: database is unreachable', metrics=1)
+		return False
+	con, cur = db
+	try:
+		if mysql_enable != '1':
+			cur.execute('BEGIN')
+		update_metrics_rollup(cur, metrics)
+		con.commit()
+	except (sqltool.Error, ValueError, TypeError) as e:
+		funct.logging('localhost', ' Cannot save metrics: ' + str(e), metrics=1)
+		con.rollback()
+		return False
+	finally:
+		cur.close()    
+		con.close()
+	
+	# Only after the rollup is committed, a batch spilled for retry must not be in the tsdb already.
+	# Retrying after a failure here would count the rollup twice, so the samples are only logged.
+	try:
+		insert_tsdb_metrics('metrics', metrics)
+	except OSError as e:
+		funct.logging('localhost', ' Cannot save metrics to tsdb: ' + str(e), metrics=1)
+	return True
+		
+		
+metrics_rollup_periods = (60, 3600, 86400)
+
+
+def date_to_ts(date):
+	import time
+	return int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S')))
+		
+		
+def update_metrics_rollup(cur, metrics):
+	rollups = {}
+	
+	for serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate, date in metrics:
+		ts = date_to_ts(date)
+		sess_rate = int(sess_rate or 0)
+		curr_con = int(curr_con or 0)
+		cur_ssl_con = int(cur_ssl_con or 0)
+		for period in metrics_rollup_periods:
+			rollup = rollups.setdefault((serv, period, ts // period * period), [0, 0, 0, 0, 0, 0])
+			rollup[0] += sess_rate
+			rollup[1] = max(rollup[1], sess_rate)
+			rollup[2] += curr_con
+			rollup[3] = max(rollup[3], curr_con)
+			rollup[4] += cur_ssl_con
+			rollup[5] += 1
+			
+	update = statement('update_metrics_rollup', """ update metrics_rollup set sess_sum = sess_sum + ?, sess_max = (case when sess_max > ? then sess_max else ? end), 
+			con_sum = con_sum + ?, con_max = (case when con_max > ? then con_max else ? end), ssl_sum = ssl_sum + ?, `count` = `count` + ? 
+			where serv = ? and period = ? and bucket = ? """)
+	insert = statement('insert_metrics_rollup', """ insert into metrics_rollup (serv, period, bucket, sess_sum, sess_max, con_sum, con_max, ssl_sum, `count`) 
+			values (?, ?, ?, ?, ?, ?, ?, ?, ?) """)
+			
+	for (serv, period, bucket), r in rollups.items():
+		cur.execute(update, (r[0], r[1], r[1], r[2], r[3], r[3], r[4], r[5], serv, period, bucket))
+		if cur.rowcount == 0:
+			cur.execute(insert, (serv, period, bucket, r[0], r[1], r[2], r[3], r[4], r[5]))
+			
+			
+def delete_metrics_rollup():
+	import time
+	now = int(time.time())
 	con, cur = create_db.get_cur()
-	if mysql_enable == '1':
-		sql = """ insert into metrics (serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate, date) values('%s', '%s', '%s', '%s', '%s', now()) """ % (serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate)
-	else:
-		sql = """ insert into metrics (serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate, date) values('%s', '%s', '%s', '%s', '%s',  datetime('now', 'localtime')) """ % (serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate)
+	sql = statement('delete_metrics_rollup', """ delete from metrics_rollup where (period = 60 and bucket < ?) or (period = 3600 and bucket < ?) or (period = 86400 and bucket < ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (now - 3*86400, now - 30*86400, now - 365*86400))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -818,11 +1047,12 @@ def insert_mentrics(serv, curr_con, cur_ssl_con, sess_rate, max_sess_rate):
 	cur.close()    
 	con.close()
 	
+	
 def select_waf_metrics_enable(id):
 	con, cur = create_db.get_cur()
-	sql = """ select waf.metrics from waf  left join servers as serv on waf.server_id = serv.id where server_id = '%s' """ % id
+	sql = statement('select_waf_metrics_enable', """ select waf.metrics from waf  left join servers as serv on waf.server_id = serv.id where server_id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -832,9 +1062,9 @@ def select_waf_metrics_enable(id):
 	
 def select_waf_metrics_enable_server(ip):
 	con, cur = create_db.get_cur()
-	sql = """ select waf.metrics from waf  left join servers as serv on waf.server_id = serv.id where ip = '%s' """ % ip
+	sql = statement('select_waf_metrics_enable_server', """ select waf.metrics from waf  left join servers as serv on waf.server_id = serv.id where ip = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (ip,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -845,9 +1075,9 @@ def select_waf_metrics_enable_server(ip):
 	
 def select_waf_servers(serv):
 	con, cur = create_db.get_cur()
-	sql = """ select serv.ip from waf left join servers as serv on waf.server_id = serv.id where serv.ip = '%s' """ % serv
+	sql = statement('select_waf_servers', """ select serv.ip from waf left join servers as serv on waf.server_id = serv.id where serv.ip = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (serv,))
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -871,20 +1101,22 @@ def select_all_waf_servers():
 	
 def select_waf_servers_metrics(uuid, **kwargs):
 	con, cur = create_db.get_cur()
-	sql = """ select * from user where username = '%s' """ % get_user_name_by_uuid(uuid)
+	sql = statement('select_user_by_name', """ select * from user where username = ? """)
 
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (get_user_name_by_uuid(uuid),))
 	except sqltool.Error as e:
 		print("An error occurred:", e)
 	else:
-		for group in cur:
+		for group in cur.fetchall():
 			if group[5] == '1':
-				sql = """ select servers.ip from servers left join waf as waf on waf.server_id = servers.id where servers.enable = 1 and waf.metrics = '1'  """
+				sql = statement('select_waf_servers_metrics_all', """ select servers.ip from servers left join waf as waf on waf.server_id = servers.id where servers.enable = 1 and waf.metrics = '1'  """)
+				params = ()
 			else:
-				sql = """ select servers.ip from servers left join waf as waf on waf.server_id = servers.id where servers.enable = 1 and waf.metrics = '1' and servers.groups like '%{group}%' """.format(group=group[5])		
+				sql = statement('select_waf_servers_metrics', """ select servers.ip from servers left join waf as waf on waf.server_id = servers.id where servers.enable = 1 and waf.metrics = '1' and servers.groups like ? """)
+				params = ('%' + str(group[5]) + '%',)
 		try:   
-			cur.execute(sql)
+			cur.execute(sql, params)
 		except sqltool.Error as e:
 			out_error(e)
 		else:
@@ -893,22 +1125,13 @@ def select_waf_servers_metrics(uuid, **kwargs):
 	con.close() 
 	
 def select_waf_metrics(serv, **kwargs):
-	con, cur = create_db.get_cur()
-	sql = """ select * from (select * from waf_metrics where serv = '%s' order by `date` desc limit 60) order by `date`""" % serv
-	try:    
-		cur.execute(sql)
-	except sqltool.Error as e:
-		out_error(e)
-	else:
-		return cur.fetchall()
-	cur.close()    
-	con.close()
+	return select_tsdb_metrics('waf_metrics', serv, **kwargs)
 	
 def insert_waf_metrics_enable(serv, enable):
 	con, cur = create_db.get_cur()
-	sql = """ insert into waf (server_id, metrics) values((select id from servers where ip = '%s'), '%s') """ % (serv, enable)
+	sql = statement('insert_waf_metrics_enable', """ insert into waf (server_id, metrics) values((select id from servers where ip = ?), ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (serv, enable))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -918,9 +1141,9 @@ def insert_waf_metrics_enable(serv, enable):
 	
 def delete_waf_server(id):
 	con, cur = create_db.get_cur()
-	sql = """ delete from waf where server_id = '%s' """ % id
+	sql = statement('delete_waf_server', """ delete from waf where server_id = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (id,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -928,29 +1151,21 @@ def delete_waf_server(id):
 	cur.close()    
 	con.close()
 	
-def insert_waf_mentrics(serv, conn):
-	con, cur = create_db.get_cur()
-	if mysql_enable == '1':
-		sql = """ insert into waf_metrics (serv, conn, date) values('%s', '%s', now()) """ % (serv, conn)
+def insert_waf_mentrics_many(metrics):
+	try:
+		insert_tsdb_metrics('waf_metrics', metrics)
+	except OSError as e:
+		funct.logging('localhost', ' Cannot save WAF metrics to tsdb: ' + str(e), metrics=1)
+		return False
 	else:
-		sql = """ insert into waf_metrics (serv, conn, date) values('%s', '%s',  datetime('now', 'localtime')) """ % (serv, conn)
-	try:    
-		cur.execute(sql)
-		con.commit()
-	except sqltool.Error as e:
-		out_error(e)
-		con.rollback()
-	cur.close()    
-	con.close()
+		return True
 	
 def delete_waf_mentrics():
+	import time
 	con, cur = create_db.get_cur()
-	if mysql_enable == '1':
-		sql = """ delete from metrics where date < now() - INTERVAL 3 day """ 
-	else:
-		sql = """ delete from metrics where date < datetime('now', '-3 days') """
+	sql = statement('delete_waf_metrics', """ delete from waf_metrics where ts < ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (int(time.time()) - 3*86400,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -960,9 +1175,9 @@ def delete_waf_mentrics():
 	
 def update_waf_metrics_enable(name, enable):
 	con, cur = create_db.get_cur()
-	sql = """ update waf set metrics = %s where server_id = (select id from servers where hostname = '%s') """ % (enable, name)
+	sql = statement('update_waf_metrics_enable', """ update waf set metrics = ? where server_id = (select id from servers where hostname = ?) """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (enable, name))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -971,13 +1186,11 @@ def update_waf_metrics_enable(name, enable):
 	con.close()
 	
 def delete_mentrics():
+	import time
 	con, cur = create_db.get_cur()
-	if mysql_enable == '1':
-		sql = """ delete from metrics where date < now() - INTERVAL 3 day """ 
-	else:
-		sql = """ delete from metrics where date < datetime('now', '-3 days') """
+	sql = statement('delete_metrics', """ delete from metrics where ts < ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (int(time.time()) - 3*86400,))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
@@ -985,17 +1198,18 @@ def delete_mentrics():
 	cur.close()    
 	con.close()
 	
-def select_metrics(serv, **kwargs):
-	con, cur = create_db.get_cur()
-	sql = """ select * from (select * from metrics where serv = '%s' order by `date` desc limit 60) order by `date` """ % serv
-	try:    
-		cur.execute(sql)
-	except sqltool.Error as e:
-		out_error(e)
+def select_tsdb_metrics(kind, serv, **kwargs):
+	import time
+	import tsdb
+	if kwargs.get('since') is not None:
+		rows = tsdb.read(kind, serv, int(kwargs.get('since')), step=kwargs.get('step', 0))
 	else:
-		return cur.fetchall()
-	cur.close()    
-	con.close()
+		rows = tsdb.last(kind, serv, 60, step=kwargs.get('step', 0))
+		
+	return [(serv,) + row[1:] + (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row[0])),) for row in rows]
+	
+def select_metrics(serv, **kwargs):
+	return select_tsdb_metrics('metrics', serv, **kwargs)
 	
 def select_servers_metrics_for_master():
 	con, cur = create_db.get_cur()
@@ -1011,20 +1225,22 @@ def select_servers_metrics_for_master():
 	
 def select_servers_metrics(uuid, **kwargs):
 	con, cur = create_db.get_cur()
-	sql = """ select * from user where username = '%s' """ % get_user_name_by_uuid(uuid)
+	sql = statement('select_user_by_name', """ select * from user where username = ? """)
 
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (get_user_name_by_uuid(uuid),))
 	except sqltool.Error as e:
 		print("An error occurred:", e)
 	else:
-		for group in cur:
+		for group in cur.fetchall():
 			if group[5] == '1':
-				sql = """ select ip from servers where enable = 1 and metrics = '1' """
+				sql = statement('select_servers_metrics_all', """ select ip from servers where enable = 1 and metrics = '1' """)
+				params = ()
 			else:
-				sql = """ select ip from servers where groups like '%{group}%' and metrics = '1'""".format(group=group[5])		
+				sql = statement('select_servers_metrics', """ select ip from servers where groups like ? and metrics = '1'""")
+				params = ('%' + str(group[5]) + '%',)
 		try:   
-			cur.execute(sql)
+			cur.execute(sql, params)
 		except sqltool.Error as e:
 			out_error(e)
 		else:
@@ -1033,213 +1249,56 @@ def select_servers_metrics(uuid, **kwargs):
 	con.close() 
 	
 def select_table_metrics(uuid):
+	import time
 	con, cur = create_db.get_cur()
-	groups = ""
-	sql = """ select * from user where username = '%s' """ % get_user_name_by_uuid(uuid)
+	groups = ()
+	sql = statement('select_user_by_name', """ select * from user where username = ? """)
 	
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (get_user_name_by_uuid(uuid),))
 	except sqltool.Error as e:
 		print("An error occurred:", e)
 	else:
-		for group in cur:
+		for group in cur.fetchall():
 			if group[5] == '1':
-				groups = ""
+				groups = ()
 			else:
-				groups = "and servers.groups like '%{group}%' ".format(group=group[5])
-	if mysql_enable == '1':
-		sql = """
-                select ip.ip, hostname, avg_sess_1h, avg_sess_24h, avg_sess_3d, max_sess_1h, max_sess_24h, max_sess_3d, avg_cur_1h, avg_cur_24h, avg_cur_3d, max_con_1h, max_con_24h, max_con_3d from
-                (select servers.ip from servers where metrics = 1 ) as ip,
-
-                (select servers.ip, servers.hostname as hostname from servers left join metrics as metr on servers.ip = metr.serv where servers.metrics = 1 %s) as hostname,
-
-                (select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_1h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(), INTERVAL -1 HOUR)
-                group by servers.ip)   as avg_sess_1h,
-
-                (select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_24h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -24 HOUR)
-                group by servers.ip) as avg_sess_24h,
-
-                (select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_3d from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(), INTERVAL -3 DAY)
-                group by servers.ip ) as avg_sess_3d,
-		
-		(select servers.ip,max(metr.sess_rate) as max_sess_1h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -1 HOUR)
-                group by servers.ip)   as max_sess_1h,
-
-                (select servers.ip,max(metr.sess_rate) as max_sess_24h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -24 HOUR)
-                group by servers.ip) as max_sess_24h,
-
-                (select servers.ip,max(metr.sess_rate) as max_sess_3d from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <=  now() and metr.date >= DATE_ADD(NOW(),INTERVAL -3 DAY)
-                group by servers.ip ) as max_sess_3d,
-
-                (select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_1h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -1 HOUR)
-                group by servers.ip)   as avg_cur_1h,
-
-                (select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_24h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -24 HOUR)
-                group by servers.ip) as avg_cur_24h,
+				groups = ('%' + str(group[5]) + '%',)
 				
-		(select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_3d from servers 
-			left join metrics as metr on metr.serv = servers.ip 
-			where servers.metrics = 1 and 
-			metr.date <=  now() and metr.date >= DATE_ADD(NOW(),INTERVAL -3 DAY)
-			group by servers.ip ) as avg_cur_3d,
+	now = int(time.time())
+	hour_ago = (now - 3600) // 60 * 60
+	day_ago = (now - 86400) // 3600 * 3600
+	three_days_ago = (now - 3*86400) // 3600 * 3600
+	
+	# The day columns take day_ago as a parameter, so the statement text is the same on every call
+	def avg(column, period, day=False):
+		since = 'and r.bucket >= ?' if day else ''
+		return """round(sum(case when r.period = {period} {since} then r.{column} end) * 1.0 / 
+			sum(case when r.period = {period} {since} then r.count end), 1)""".format(column=column, period=period, since=since)
 		
-		 (select servers.ip,max(metr.curr_con) as max_con_1h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -1 HOUR)
-                group by servers.ip)   as max_con_1h,
-
-                (select servers.ip,max(metr.curr_con) as max_con_24h from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -24 HOUR)
-                group by servers.ip) as max_con_24h,
-
-                (select servers.ip,max(metr.curr_con) as max_con_3d from servers
-                left join metrics as metr on metr.serv = servers.ip
-                where servers.metrics = 1 and
-                metr.date <= now() and metr.date >= DATE_ADD(NOW(),INTERVAL -3 DAY)
-                group by servers.ip ) as max_con_3d		
+	def peak(column, period, day=False):
+		since = 'and r.bucket >= ?' if day else ''
+		return """max(case when r.period = {period} {since} then r.{column} end)""".format(column=column, period=period, since=since)
 		
-		where ip.ip=hostname.ip
-                and ip.ip=avg_sess_1h.ip
-                and ip.ip=avg_sess_24h.ip
-                and ip.ip=avg_sess_3d.ip
-                and ip.ip=max_sess_1h.ip
-                and ip.ip=max_sess_24h.ip
-                and ip.ip=max_sess_3d.ip
-                and ip.ip=avg_cur_1h.ip
-                and ip.ip=avg_cur_24h.ip
-                and ip.ip=avg_cur_3d.ip
-                and ip.ip=max_con_1h.ip
-                and ip.ip=max_con_24h.ip
-                and ip.ip=max_con_3d.ip
-
-                group by hostname.ip """ % groups
-
-
-	else:
-		sql = """
-		select ip.ip, hostname, avg_sess_1h, avg_sess_24h, avg_sess_3d, max_sess_1h, max_sess_24h, max_sess_3d, avg_cur_1h, avg_cur_24h, avg_cur_3d, max_con_1h, max_con_24h, max_con_3d from
-		(select servers.ip from servers where metrics = 1 ) as ip,
-
-		(select servers.ip, servers.hostname as hostname from servers left join metrics as metr on servers.ip = metr.serv where servers.metrics = 1 %s) as hostname,
-
-		(select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_1h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-1 hours', 'localtime')
-		group by servers.ip)   as avg_sess_1h,
-
-		(select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_24h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-24 hours', 'localtime')
-		group by servers.ip) as avg_sess_24h, 
-
-		(select servers.ip,round(avg(metr.sess_rate), 1) as avg_sess_3d from servers 
-		left join metrics as metr on metr.serv = servers.ip 
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-3 days', 'localtime') 
-		group by servers.ip ) as avg_sess_3d,
-
-		(select servers.ip,max(metr.sess_rate) as max_sess_1h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-1 hours', 'localtime')
-		group by servers.ip)   as max_sess_1h,
-
-		(select servers.ip,max(metr.sess_rate) as max_sess_24h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-24 hours', 'localtime')
-		group by servers.ip) as max_sess_24h, 
-
-		(select servers.ip,max(metr.sess_rate) as max_sess_3d from servers 
-		left join metrics as metr on metr.serv = servers.ip 
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-3 days', 'localtime') 
-		group by servers.ip ) as max_sess_3d,
-
-		(select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_1h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-1 hours', 'localtime')
-		group by servers.ip)   as avg_cur_1h,
-
-		(select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_24h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-24 hours', 'localtime')
-		group by servers.ip) as avg_cur_24h, 
-
-		(select servers.ip,round(avg(metr.curr_con+metr.cur_ssl_con), 1) as avg_cur_3d from servers 
-		left join metrics as metr on metr.serv = servers.ip 
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-3 days', 'localtime') 
-		group by servers.ip ) as avg_cur_3d,
-
-		(select servers.ip,max(metr.curr_con) as max_con_1h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-1 hours', 'localtime')
-		group by servers.ip)   as max_con_1h,
-
-		(select servers.ip,max(metr.curr_con) as max_con_24h from servers 
-		left join metrics as metr on metr.serv = servers.ip  
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-24 hours', 'localtime')
-		group by servers.ip) as max_con_24h, 
-
-		(select servers.ip,max(metr.curr_con) as max_con_3d from servers 
-		left join metrics as metr on metr.serv = servers.ip 
-		where servers.metrics = 1 and 
-		metr.date <= datetime('now', 'localtime') and metr.date >= datetime('now', '-3 days', 'localtime') 
-		group by servers.ip ) as max_con_3d 
-
-		where ip.ip=hostname.ip
-		and ip.ip=avg_sess_1h.ip
-		and ip.ip=avg_sess_24h.ip
-		and ip.ip=avg_sess_3d.ip
-		and ip.ip=max_sess_1h.ip
-		and ip.ip=max_sess_24h.ip
-		and ip.ip=max_sess_3d.ip
-		and ip.ip=avg_cur_1h.ip
-		and ip.ip=avg_cur_24h.ip
-		and ip.ip=avg_cur_3d.ip
-		and ip.ip=max_con_1h.ip
-		and ip.ip=max_con_24h.ip
-		and ip.ip=max_con_3d.ip
-
-		group by hostname.ip """ % groups
-	
-	try:    
-		cur.execute(sql)
+	sql = statement('select_table_metrics' if groups else 'select_table_metrics_all', """ select servers.ip, servers.hostname, 
+		{avg_sess_1h}, {avg_sess_24h}, {avg_sess_3d}, 
+		{max_sess_1h}, {max_sess_24h}, {max_sess_3d}, 
+		round(({avg_con_1h}) + ({avg_ssl_1h}), 1), round(({avg_con_24h}) + ({avg_ssl_24h}), 1), round(({avg_con_3d}) + ({avg_ssl_3d}), 1), 
+		{max_con_1h}, {max_con_24h}, {max_con_3d} 
+		from servers join metrics_rollup as r on r.serv = servers.ip 
+		where servers.metrics = 1 {groups} and ((r.period = 60 and r.bucket >= ?) or (r.period = 3600 and r.bucket >= ?)) 
+		group by servers.ip, servers.hostname """.format(
+			avg_sess_1h=avg('sess_sum', 60), avg_sess_24h=avg('sess_sum', 3600, day=True), avg_sess_3d=avg('sess_sum', 3600),
+			max_sess_1h=peak('sess_max', 60), max_sess_24h=peak('sess_max', 3600, day=True), max_sess_3d=peak('sess_max', 3600),
+			avg_con_1h=avg('con_sum', 60), avg_con_24h=avg('con_sum', 3600, day=True), avg_con_3d=avg('con_sum', 3600),
+			avg_ssl_1h=avg('ssl_sum', 60), avg_ssl_24h=avg('ssl_sum', 3600, day=True), avg_ssl_3d=avg('ssl_sum', 3600),
+			max_con_1h=peak('con_max', 60), max_con_24h=peak('con_max', 3600, day=True), max_con_3d=peak('con_max', 3600),
+			groups='and servers.groups like ?' if groups else ''))
+	# eight day columns, then the group filter and the two window bounds
+	params = (day_ago,) * 8 + groups + (hour_ago, three_days_ago)
+	
+	try:    
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:		
@@ -1247,13 +1306,31 @@ def select_table_metrics(uuid):
 	cur.close()    
 	con.close()
 	
+settings_cache = {}
+settings_cache_version = 0
+settings_cache_loaded = (-1, 0)
+settings_cache_ttl = 30
+	
 def get_setting(param, **kwargs):
+	global settings_cache, settings_cache_loaded
+	if not kwargs.get('all'):
+		import time
+		if settings_cache_loaded[0] != settings_cache_version or time.time() - settings_cache_loaded[1] > settings_cache_ttl:
+			rows = get_setting(param, all=1)
+			if rows is None:
+				return None
+			settings_cache = dict((row[0], row[1]) for row in rows)
+			settings_cache_loaded = (settings_cache_version, time.time())
+		return settings_cache.get(param)
+		
 	con, cur = create_db.get_cur()
-	sql = """select value from `settings` where param='%s' """ % param
+	sql = statement('get_setting', """select value from `settings` where param=? """)
+	params = (param,)
 	if kwargs.get('all'):
-		sql = """select * from `settings` order by section desc"""
+		sql = statement('get_settings', """select * from `settings` order by section desc""")
+		params = ()
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
@@ -1266,14 +1343,16 @@ def get_setting(param, **kwargs):
 	con.close()  
 	
 def update_setting(param, val):
+	global settings_cache_version
 	con, cur = create_db.get_cur()
-	sql = """update `settings` set `value` = '%s' where param = '%s' """ % (val, param)
+	sql = statement('update_setting', """update `settings` set `value` = ? where param = ? """)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, (val, param))
 		con.commit()
 	except sqltool.Error as e:
 		out_error(e)
 		con.rollback()
+	settings_cache_version += 1
 	cur.close()    
 	con.close()
 	
@@ -1292,8 +1371,8 @@ def get_ver():
 	con.close()
 	
 def show_update_option(option):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
 	template = env.get_template('/new_option.html')
 
 	print('Content-type: text/html\n')
@@ -1302,8 +1381,8 @@ def show_update_option(option):
 	
 	
 def show_update_savedserver(server):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
 	template = env.get_template('/new_saved_servers.html')
 
 	print('Content-type: text/html\n')
@@ -1312,8 +1391,8 @@ def show_update_savedserver(server):
 	
 	
 def show_update_telegram(token, page):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax'))
 	template = env.get_template('/new_telegram.html')
 
 	print('Content-type: text/html\n')
@@ -1321,8 +1400,8 @@ def show_update_telegram(token, page):
 	print(output_from_parsed_template)	
 
 def show_update_user(user,page):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/'))
 	template = env.get_template('ajax/new_user.html')
 
 	print('Content-type: text/html\n')
@@ -1333,8 +1412,8 @@ def show_update_user(user,page):
 	print(template)
 		
 def show_update_server(server, page):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/'))
 	template = env.get_template('ajax/new_server.html')
 
 	print('Content-type: text/html\n')
@@ -1347,8 +1426,8 @@ def show_update_server(server, page):
 	print(output_from_parsed_template)
 
 def show_update_group(group):
-	from jinja2 import Environment, FileSystemLoader
-	env = Environment(loader=FileSystemLoader('templates/ajax/'))
+	from jinja2 import FileSystemLoader
+	env = funct.get_env(loader=FileSystemLoader('templates/ajax/'))
 	template = env.get_template('/new_group.html')
 
 	print('Content-type: text/html\n')
@@ -1357,11 +1436,13 @@ def show_update_group(group):
 	
 def select_roles(**kwargs):
 	con, cur = create_db.get_cur()
-	sql = """select * from role ORDER BY id"""
+	sql = statement('select_roles', """select * from role ORDER BY id""")
+	params = ()
 	if kwargs.get("roles") is not None:
-		sql = """select * from role where name='%s' """ % kwargs.get("roles")
+		sql = statement('select_role', """select * from role where name=? """)
+		params = (kwargs.get("roles"),)
 	try:    
-		cur.execute(sql)
+		cur.execute(sql, params)
 	except sqltool.Error as e:
 		out_error(e)
 	else:
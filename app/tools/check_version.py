@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+import os, sys
+sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
+sys.path.append(os.path.join(sys.path[0], os.getcwd()))
+import funct
+
+
+if __name__ == "__main__":
+	if not funct.update_new_version():
+		sys.exit(1)
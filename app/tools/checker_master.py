@@ -1,79 +1,224 @@
 #!/usr/bin/env python3
-import subprocess
+import asyncio
+import collections
 import time
-import argparse
 import os, sys
 sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
 sys.path.append(os.path.join(sys.path[0], os.getcwd()))
 import funct
 import sql
+import haproxy_sock
+import daemons
 import signal
 
+# Seconds between two "show stat" of one server, may be below one second
+poll_interval = 5
+max_concurrency = 50
+reconcile_interval = 20
+# A server that changed state flap_count times in flap_window seconds is flapping
+flap_window = 300
+flap_count = 4
+# Alerts of one HAProxy collected during coalesce_window seconds are sent together,
+# more than coalesce_max of them as one summary
+coalesce_window = 5
+coalesce_max = 5
+states = ('UP', 'DOWN', 'MAINT', 'DRAIN', 'NOLB')
+registry = None
+
+
 class GracefulKiller:
 	kill_now = False
 	def __init__(self):
 		signal.signal(signal.SIGINT, self.exit_gracefully)
 		signal.signal(signal.SIGTERM, self.exit_gracefully)
-	
+
 	def exit_gracefully(self,signum, frame):
 		self.kill_now = True
 
-def main():
-	servers = sql.select_alert()
-	started_workers = get_worker()
-	servers_list = []
-	
-	for serv in servers:
-		servers_list.append(serv[0])
-			
-	need_kill=list(set(started_workers) - set(servers_list))
-	need_start=list(set(servers_list) - set(started_workers))
-	
-	if need_kill:
-		for serv in need_kill:
-			kill_worker(serv)
-			
-	if need_start:
-		for serv in need_start:
-			start_worker(serv)
-	
-def start_worker(serv):
+
+def get_states(records):
+	"""
+	Return {(pxname, svname): state} of the servers in "show stat" records.
+	Transitional states like "UP 1/3" count as the state they come from.
+	"""
+	state_map = {}
+	for record in records:
+		if record.get('svname') in ('FRONTEND', 'BACKEND'):
+			continue
+		state = record.get('status', '').split(' ')[0]
+		if state in states:
+			state_map[(record.get('pxname'), record.get('svname'))] = state
+	return state_map
+
+
+def diff_states(old, new):
+	return [(key, old[key], state) for key, state in sorted(new.items()) if key in old and old[key] != state]
+
+
+class Coalescer:
+	"""
+	Collects the alerts of one HAProxy and sends them after coalesce_window seconds,
+	so a mass outage becomes one summary message instead of one message per server
+	"""
+	def __init__(self, serv):
+		self.serv = serv
+		self.alerts = []
+		self.changes = collections.Counter()
+		self.task = None
+
+	def add(self, alert, state=None):
+		self.alerts.append(alert)
+		if state is not None:
+			self.changes[state] += 1
+		if self.task is None:
+			self.task = asyncio.ensure_future(self.flush())
+
+	async def flush(self):
+		await asyncio.sleep(coalesce_window)
+		self.task = None
+		self.send()
+
+	def close(self):
+		# Sends what is pending right away, the loop may be closed before the window ends
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+		self.send()
+
+	def send(self):
+		alerts, changes = self.alerts, self.changes
+		self.alerts, self.changes = [], collections.Counter()
+		if not alerts:
+			return
+
+		if len(alerts) > coalesce_max:
+			summary = ', '.join('%s %s' % (count, state) for state, count in sorted(changes.items()))
+			mess = '%s alerts at %s: %s. First ones: %s' % (len(alerts), self.serv, summary, '; '.join(alerts[:coalesce_max]))
+		else:
+			mess = '\n'.join(alerts)
+		for alert in alerts:
+			funct.logging("localhost", " "+alert, alerting=1)
+		funct.telegram_send_mess(mess, ip=self.serv)
+
+
+class Checker:
+	def __init__(self, serv):
+		self.serv = serv
+		self.coalescer = Coalescer(serv)
+		self.state_map = None
+		self.service_up = None
+		self.history = collections.defaultdict(collections.deque)
+		self.flapping = {}
+
+	def check_flapping(self, key, state, now):
+		history = self.history[key]
+		history.append(now)
+		while history and history[0] < now - flap_window:
+			history.popleft()
+		if key in self.flapping:
+			self.flapping[key] = state
+			return True
+		if len(history) >= flap_count:
+			self.flapping[key] = state
+			self.coalescer.add("Backend: %s, server: %s is flapping, %s changes in %s sec at %s" % (key[0], key[1], len(history), flap_window, self.serv), 'FLAPPING')
+			return True
+		return False
+
+	def check_flapping_end(self, now):
+		for key, state in list(self.flapping.items()):
+			history = self.history[key]
+			if not history or history[-1] < now - flap_window:
+				del self.flapping[key]
+				self.coalescer.add("Backend: %s, server: %s stopped flapping and is now %s at %s" % (key[0], key[1], state, self.serv), state)
+
+	def update(self, state_map, now):
+		if self.state_map is not None:
+			for key, old, state in diff_states(self.state_map, state_map):
+				if not self.check_flapping(key, state, now):
+					self.coalescer.add("Backend: %s, server: %s has changed status and is now %s at %s" % (key[0], key[1], state, self.serv), state)
+		self.check_flapping_end(now)
+		self.state_map = state_map
+
+	def service(self, up):
+		if self.service_up is not None and self.service_up != up:
+			if up:
+				self.coalescer.add("Now UP HAProxy service at " + self.serv)
+			else:
+				self.coalescer.add("Can't connect to HAProxy service at " + self.serv)
+		self.service_up = up
+
+
+async def checker(serv, port, semaphore):
+	check = Checker(serv)
+	session = haproxy_sock.AsyncSession(serv, port=port)
+	try:
+		while True:
+			started = time.time()
+			try:
+				async with semaphore:
+					records = await session.show_stat()
+			except (OSError, asyncio.TimeoutError) as e:
+				registry.error(serv, e)
+				check.service(False)
+				# Changes while HAProxy was unreachable are not known, compare with the next answer only
+				check.state_map = None
+			else:
+				registry.poll(serv, poll_interval)
+				check.service(True)
+				check.update(get_states(records), started)
+
+			await asyncio.sleep(max(poll_interval - (time.time() - started), 0))
+	finally:
+		session.close()
+		check.coalescer.close()
+
+
+def reconcile(tasks, targets, port, semaphore):
+	for serv in list(tasks):
+		if serv not in targets:
+			tasks.pop(serv).cancel()
+			registry.remove(serv)
+			funct.logging("localhost", " Master stopped checker for: "+serv, alerting=1)
+
+	for serv in targets:
+		if serv in tasks and tasks[serv].done():
+			error = tasks.pop(serv).exception()
+			funct.logging("localhost", " Checker for "+serv+" died: "+str(error), alerting=1)
+		if serv not in tasks:
+			tasks[serv] = asyncio.ensure_future(checker(serv, port, semaphore))
+			funct.logging("localhost", " Master started new checker for: "+serv, alerting=1)
+
+
+async def main(killer):
+	global registry
+	loop = asyncio.get_event_loop()
+	registry = daemons.Registry('checker_master')
+	semaphore = asyncio.Semaphore(max_concurrency)
 	port = sql.get_setting('haproxy_sock_port')
-	cmd = "tools/checker_worker.py %s --port %s &" % (serv, port)
-	os.system(cmd)
-	funct.logging("localhost", " Masrer started new worker for: "+serv, alerting=1)
-	
-def kill_worker(serv):
-	cmd = "ps ax |grep 'tools/checker_worker.py %s'|grep -v grep |awk '{print $1}' |xargs kill" % serv
-	output, stderr = funct.subprocess_execute(cmd)
-	funct.logging("localhost", " Masrer killed worker for: "+serv, alerting=1)
-	if stderr:
-		funct.logging("localhost", stderr, alerting=1)
-
-def kill_all_workers():
-	cmd = "ps ax |grep 'tools/checker_worker.py' |grep -v grep |awk '{print $1}' |xargs kill"
-	output, stderr = funct.subprocess_execute(cmd)
-	funct.logging("localhost", " Masrer killing all workers", alerting=1)
-	if stderr:
-		funct.logging("localhost", stderr, alerting=1)
-		
-def get_worker():
-	cmd = "ps ax |grep 'tools/checker_worker.py' |grep -v grep |awk '{print $7}'"
-	output, stderr = funct.subprocess_execute(cmd)
-	if stderr:
-		funct.logging("localhost", stderr, alerting=1)
-	return output
-	
+	tasks = {}
+
+	while not killer.kill_now:
+		servers = await loop.run_in_executor(None, sql.select_alert)
+		reconcile(tasks, set(serv[0] for serv in servers), port, semaphore)
+
+		for i in range(reconcile_interval):
+			if killer.kill_now:
+				break
+			registry.publish()
+			await asyncio.sleep(1)
+
+	for task in tasks.values():
+		task.cancel()
+	await asyncio.gather(*tasks.values(), return_exceptions=True)
+	registry.close()
+
+
 if __name__ == "__main__":
 	funct.logging("localhost", " Checker master started", alerting=1)
 	killer = GracefulKiller()
-	
-	while True:
-		main()
-		time.sleep(20)
-		
-		if killer.kill_now:
-			break
-			
-	kill_all_workers()
-	funct.logging("localhost", " Checker master shutdown", alerting=1)
\ No newline at end of file
+
+	ioloop = asyncio.get_event_loop()
+	ioloop.run_until_complete(main(killer))
+	ioloop.close()
+
+	funct.logging("localhost", " Checker master shutdown", alerting=1)
@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+import os, sys
+sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
+sys.path.append(os.path.join(sys.path[0], os.getcwd()))
+import sql
+
+
+if __name__ == "__main__":
+	sql.delete_old_uuid()
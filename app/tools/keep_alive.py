@@ -1,59 +1,167 @@
 #!/usr/bin/env python3
-import subprocess
-from subprocess import check_output, CalledProcessError
+import asyncio
 import time
 import os, sys
 sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
 sys.path.append(os.path.join(sys.path[0], os.getcwd()))
 import funct
 import sql
+import haproxy_sock
+import daemons
 import signal
 
+probe_interval = 5
+# Failed probes in a row before a server is restarted
+suspect_probes = 2
+max_concurrency = 50
+# Restarts running at once over all servers
+max_restarts = 3
+# Wait after the first restart, doubled after every next one that did not help
+restart_backoff = 30
+max_restart_backoff = 600
+# A server healthy this long starts again from the first backoff step
+reset_after = 600
+reconcile_interval = 20
+registry = None
+
+
 class GracefulKiller:
 	kill_now = False
 	def __init__(self):
 		signal.signal(signal.SIGINT, self.exit_gracefully)
 		signal.signal(signal.SIGTERM, self.exit_gracefully)
-	
+
 	def exit_gracefully(self,signum, frame):
 		self.kill_now = True
-		
 
-def main():
-	port = sql.get_setting('haproxy_sock_port')
-	readstats = ""
-	killer = GracefulKiller()
-	
-	while True:
-		servers = sql.select_keep_alive()
-		for serv in servers:
-			try:			
-				readstats = subprocess.check_output(["echo show stat | nc "+serv[0]+" "+port], shell=True)
-			except CalledProcessError as e:
-				alert = "Try start HAProxy serivce at " + serv[0]
-				funct.logging("localhost", " "+alert, keep_alive=1)
-				
-				start_command = []
-				start_command.append('sudo '+sql.get_setting('restart_command'))
-				funct.ssh_command(serv[0], start_command)
-				time.sleep(30)
-				continue
-			except OSError as e:
-				print(e)
-				sys.exit()
+
+class Watchdog:
+	"""
+	State of one server: healthy, suspect after a failed probe, restarting while
+	restart_command runs and cooldown until the backoff after a restart ends
+	"""
+	def __init__(self, serv):
+		self.serv = serv
+		self.state = 'healthy'
+		self.failures = 0
+		self.restarts = 0
+		self.restart_at = 0
+		self.healthy_since = time.time()
+
+	def set_state(self, state):
+		if state != self.state:
+			funct.logging("localhost", " HAProxy service at "+self.serv+" is "+state, keep_alive=1)
+			self.state = state
+			registry.update(self.serv, state=state, restarts=self.restarts)
+
+	def ok(self, now):
+		if self.state != 'healthy':
+			self.healthy_since = now
+		elif now - self.healthy_since > reset_after:
+			self.restarts = 0
+		self.failures = 0
+		self.set_state('healthy')
+
+	def failed(self, now):
+		"""
+		Return True when the server has to be restarted now
+		"""
+		self.failures += 1
+		if self.failures < suspect_probes:
+			self.set_state('suspect')
+			return False
+		if now < self.restart_at:
+			self.set_state('cooldown')
+			return False
+		return True
+
+	def restarted(self, now):
+		self.restarts += 1
+		self.restart_at = now + min(restart_backoff * 2 ** (self.restarts - 1), max_restart_backoff)
+		self.set_state('cooldown')
+
+
+def restart(serv):
+	funct.logging("localhost", " Try start HAProxy serivce at " + serv, keep_alive=1)
+	funct.ssh_command(serv, ['sudo '+sql.get_setting('restart_command')])
+
+
+async def watchdog(serv, port, semaphore, restarts):
+	loop = asyncio.get_event_loop()
+	dog = Watchdog(serv)
+	session = haproxy_sock.AsyncSession(serv, port=port)
+	try:
+		while True:
+			started = time.time()
+			try:
+				async with semaphore:
+					await session.show_info()
+			except (OSError, asyncio.TimeoutError) as e:
+				registry.error(serv, e)
+				if dog.failed(started):
+					async with restarts:
+						dog.set_state('restarting')
+						try:
+							await loop.run_in_executor(None, restart, serv)
+						except Exception as e:
+							funct.logging("localhost", " Cannot restart HAProxy service at "+serv+": "+str(e), keep_alive=1)
+					dog.restarted(time.time())
 			else:
-				cur_stat_service = "Ok"
-		time.sleep(40)			
-		
+				registry.poll(serv, probe_interval)
+				dog.ok(started)
+
+			await asyncio.sleep(max(probe_interval - (time.time() - started), 0))
+	finally:
+		session.close()
+
+
+def reconcile(tasks, targets, port, semaphore, restarts):
+	for serv in list(tasks):
+		if serv not in targets:
+			tasks.pop(serv).cancel()
+			registry.remove(serv)
+			funct.logging("localhost", " Stopped keep alive for: "+serv, keep_alive=1)
+
+	for serv in targets:
+		if serv in tasks and tasks[serv].done():
+			error = tasks.pop(serv).exception()
+			funct.logging("localhost", " Keep alive for "+serv+" died: "+str(error), keep_alive=1)
+		if serv not in tasks:
+			tasks[serv] = asyncio.ensure_future(watchdog(serv, port, semaphore, restarts))
+			funct.logging("localhost", " Started keep alive for: "+serv, keep_alive=1)
+
+
+async def main(killer):
+	global registry
+	loop = asyncio.get_event_loop()
+	registry = daemons.Registry('keep_alive')
+	semaphore = asyncio.Semaphore(max_concurrency)
+	restarts = asyncio.Semaphore(max_restarts)
+	port = sql.get_setting('haproxy_sock_port')
+	tasks = {}
+
+	while not killer.kill_now:
+		servers = await loop.run_in_executor(None, sql.select_keep_alive)
+		reconcile(tasks, set(serv[0] for serv in servers), port, semaphore, restarts)
+
+		for i in range(reconcile_interval):
+			if killer.kill_now:
+				break
+			registry.publish()
+			await asyncio.sleep(1)
+
+	for task in tasks.values():
+		task.cancel()
+	await asyncio.gather(*tasks.values(), return_exceptions=True)
+	registry.close()
+
+
 if __name__ == "__main__":
 	funct.logging("localhost", " Keep alive service started", keep_alive=1)
 	killer = GracefulKiller()
-	
-	while True:
-		main()
-		time.sleep(60)
-		
-		if killer.kill_now:
-			break
-			
-	funct.logging("localhost", " Keep alive service shutdown", keep_alive=1)
\ No newline at end of file
+
+	ioloop = asyncio.get_event_loop()
+	ioloop.run_until_complete(main(killer))
+	ioloop.close()
+
+	funct.logging("localhost", " Keep alive service shutdown", keep_alive=1)
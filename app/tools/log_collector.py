@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import threading
+import time
+import os, sys
+sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
+sys.path.append(os.path.join(sys.path[0], os.getcwd()))
+import funct
+import sql
+import logstore
+import daemons
+import signal
+
+collect_interval = 10
+read_bytes = 1048576
+# Chunks read per round, a server still behind after them continues in the next round
+max_chunks = 32
+prune_interval = 3600
+# A collect that outlived the fan_out timeout still runs, the next round skips its server
+busy = {}
+
+
+class GracefulKiller:
+	kill_now = False
+	def __init__(self):
+		signal.signal(signal.SIGINT, self.exit_gracefully)
+		signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+	def exit_gracefully(self,signum, frame):
+		self.kill_now = True
+
+
+def collect(serv):
+	lock = busy.setdefault(serv, threading.Lock())
+	if not lock.acquire(blocking=False):
+		return 0
+	try:
+		cursor = logstore.load_cursor(serv)
+		syslog_server, path = funct.get_haproxy_log_source(serv)
+		if cursor.get('path') != path:
+			cursor = {}
+		inode, offset = cursor.get('inode'), cursor.get('offset')
+		count = 0
+		for i in range(max_chunks):
+			last_offset = offset
+			inode, offset, rotated, lines, size = funct.read_remote_log(syslog_server, path, offset, inode, read_bytes, follow=True)
+			if rotated:
+				funct.logging("localhost", " Log "+path+" of "+serv+" was rotated", log_collector=1)
+			if not lines and offset == last_offset and size - offset >= read_bytes:
+				# No line ends within read_bytes, skip the chunk rather than stall on it
+				funct.logging("localhost", " Skipped "+str(read_bytes)+" bytes without a line end at "+str(offset)+" in "+path+" of "+serv, log_collector=1)
+				offset += read_bytes
+			logstore.append(serv, lines)
+			logstore.save_cursor(serv, {'path': path, 'inode': inode, 'offset': offset})
+			count += len(lines)
+			if size - offset < read_bytes:
+				break
+		else:
+			funct.logging("localhost", " Log "+path+" of "+serv+" is "+str(size - offset)+" bytes behind, continues next round", log_collector=1)
+		return count
+	finally:
+		lock.release()
+
+
+def main(killer):
+	pruned = 0
+	registry = daemons.Registry('log_collector')
+
+	while not killer.kill_now:
+		if sql.get_setting('log_collector_enable') == "1":
+			if time.time() - pruned > prune_interval:
+				logstore.prune(sql.get_setting('log_store_retention') or 14)
+				pruned = time.time()
+
+			servers = [serv[2] for serv in sql.select_servers()]
+			for serv in set(registry.targets) - set(servers):
+				registry.remove(serv)
+			for serv, result in funct.fan_out(collect, servers):
+				if isinstance(result, Exception):
+					registry.error(serv, result)
+					funct.logging("localhost", " Cannot collect log of "+serv+": "+str(result), log_collector=1)
+				else:
+					registry.poll(serv, collect_interval)
+
+		for i in range(collect_interval):
+			if killer.kill_now:
+				break
+			registry.publish()
+			time.sleep(1)
+	registry.close()
+
+
+if __name__ == "__main__":
+	funct.logging("localhost", " Log collector started", log_collector=1)
+	killer = GracefulKiller()
+	main(killer)
+	funct.logging("localhost", " Log collector shutdown", log_collector=1)
@@ -1,123 +1,236 @@
 #!/usr/bin/env python3
-import subprocess
+import asyncio
+import collections
+import json
+import random
 import time
-import argparse
 import os, sys
 sys.path.append(os.path.join(sys.path[0], os.path.dirname(os.getcwd())))
 sys.path.append(os.path.join(sys.path[0], os.getcwd()))
 import funct
 import sql
+import haproxy_sock
+import tsdb
+import daemons
 import signal
 
+poll_interval = 30
+max_backoff = 300
+max_concurrency = 50
+reconcile_interval = 20
+flush_size = 500
+flush_interval = 10
+max_buffer_size = 10000
+prune_interval = 3600
+registry = None
+
+
 class GracefulKiller:
 	kill_now = False
 	def __init__(self):
 		signal.signal(signal.SIGINT, self.exit_gracefully)
 		signal.signal(signal.SIGTERM, self.exit_gracefully)
-	
+
 	def exit_gracefully(self,signum, frame):
 		self.kill_now = True
 
-def main():
-	sql.delete_mentrics()
-	sql.delete_waf_mentrics()
-	servers = sql.select_servers_metrics_for_master()
-	started_workers = get_worker()
-	servers_list = []
-	
-	for serv in servers:
-		servers_list.append(serv[0])
-			
-	need_kill=list(set(started_workers) - set(servers_list))
-	need_start=list(set(servers_list) - set(started_workers))
-	
-	if need_kill:
-		for serv in need_kill:
-			kill_worker(serv)
-			
-	if need_start:
-		for serv in need_start:
-			start_worker(serv)
-	
+
+class MetricsBuffer:
+	"""
+	Write-behind buffer for metrics samples. Samples from all collectors are
+	flushed in one executemany transaction once flush_size samples are queued
+	or flush_interval seconds have passed. When the database stalls and the
+	queue is full, the oldest samples are spilled to disk and replayed after
+	the next successful flush.
+	"""
+	def __init__(self, insert_many, spill_file):
+		self.insert_many = insert_many
+		self.spill_file = spill_file
+		self.queue = collections.deque()
+		self.flushing = False
+
+	def add(self, metric):
+		if len(self.queue) >= max_buffer_size:
+			self.spill([self.queue.popleft() for i in range(flush_size)])
+		self.queue.append(metric)
+		if len(self.queue) >= flush_size and not self.flushing:
+			asyncio.ensure_future(self.flush())
+
+	def spill(self, metrics):
+		try:
+			with open(self.spill_file, 'a') as spill:
+				for metric in metrics:
+					spill.write(json.dumps(metric) + '\n')
+		except IOError as e:
+			funct.logging("localhost", " Cannot spill metrics to "+self.spill_file+": "+str(e), metrics=1)
+
+	def unspill(self):
+		metrics = []
+		try:
+			with open(self.spill_file, 'r') as spill:
+				for line in spill:
+					try:
+						metric = tuple(json.loads(line))
+						sql.date_to_ts(metric[-1])
+					except (ValueError, TypeError, IndexError):
+						funct.logging("localhost", " Skipped malformed spilled metric: "+line.strip(), metrics=1)
+					else:
+						metrics.append(metric)
+			os.remove(self.spill_file)
+		except IOError:
+			pass
+		return metrics
+
+	async def flush(self):
+		if self.flushing or not self.queue:
+			return
+		loop = asyncio.get_event_loop()
+		self.flushing = True
+		metrics = list(self.queue)
+		self.queue.clear()
+		try:
+			if os.path.exists(self.spill_file):
+				metrics = await loop.run_in_executor(None, self.unspill) + metrics
+			try:
+				saved = await loop.run_in_executor(None, self.insert_many, metrics)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				funct.logging("localhost", " Cannot flush metrics: "+str(e), metrics=1)
+				saved = False
+			if not saved:
+				await loop.run_in_executor(None, self.spill, metrics)
+		finally:
+			self.flushing = False
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(flush_interval)
+			try:
+				await self.flush()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				funct.logging("localhost", " Metrics flusher error: "+str(e), metrics=1)
+
+
+async def get_metrics(session):
+	serv = session.serv
+	info = await session.show_info()
+	date = time.strftime('%Y-%m-%d %H:%M:%S')
+	return [(serv, info.get('CurrConns'), info.get('CurrSslConns'), info.get('SessRate'), info.get('MaxSessRate'), date)]
+
+
+async def get_waf_metrics(session):
+	serv = session.serv
+	metrics = []
+	date = time.strftime('%Y-%m-%d %H:%M:%S')
+	for stat in await session.show_stat():
+		if stat.get('svname') == 'BACKEND' and 'waf' in stat.get('pxname', ''):
+			metrics.append((serv, stat.get('rate'), date))
+	return metrics
+
+
+async def collector(serv, port, semaphore, buffer, waf=False):
+	delay = poll_interval
+	session = haproxy_sock.AsyncSession(serv, port=port)
+
+	await asyncio.sleep(random.uniform(0, poll_interval))
+
 	try:
-		waf_servers = sql.select_all_waf_servers()
-		waf_started_workers = get_waf_worker()
-		waf_servers_list = []
-				
-		for serv in waf_servers:
-			waf_servers_list.append(serv[0])
-				
-		waf_need_kill=list(set(waf_started_workers) - set(waf_servers_list))
-		waf_need_start=list(set(waf_servers_list) - set(waf_started_workers))
-		
-		if waf_need_kill:
-			for serv in waf_need_kill:
-				kill_waf_worker(serv)
-				
-		if waf_need_start:
-			for serv in waf_need_start:
-				start_waf_worker(serv)
-	except Exception as e:
-		funct.logging("localhost", 'Problems with WAF worker metrics '+e, metrics=1)
-		pass
-	
-def start_worker(serv):
-	port = sql.get_setting('haproxy_sock_port')
-	cmd = "tools/metrics_worker.py %s --port %s &" % (serv, port)
-	os.system(cmd)
-	funct.logging("localhost", " Masrer started new metrics worker for: "+serv, metrics=1)
-	
-def kill_worker(serv):
-	cmd = "ps ax |grep 'tools/metrics_worker.py %s'|grep -v grep |awk '{print $1}' |xargs kill" % serv
-	output, stderr = funct.subprocess_execute(cmd)
-	funct.logging("localhost", " Masrer killed metrics worker for: "+serv, metrics=1)
-	if stderr:
-		funct.logging("localhost", stderr, metrics=1)
-		
-def start_waf_worker(serv):
+		while True:
+			try:
+				async with semaphore:
+					if waf:
+						metrics = await get_waf_metrics(session)
+					else:
+						metrics = await get_metrics(session)
+			except (OSError, asyncio.TimeoutError) as e:
+				delay = min(delay * 2, max_backoff)
+				registry.error(target_key(serv, waf), e)
+				funct.logging("localhost", " Cannot get metrics from "+serv+": "+str(e)+". Next try in "+str(delay)+" sec", metrics=1)
+			else:
+				registry.poll(target_key(serv, waf), delay)
+				delay = poll_interval
+				for metric in metrics:
+					buffer.add(metric)
+
+			await asyncio.sleep(delay + random.uniform(-1, 1))
+	finally:
+		session.close()
+
+
+def target_key(serv, waf=False):
+	return 'waf ' + serv if waf else serv
+
+
+def reconcile(tasks, targets, port, semaphore, buffer, waf=False):
+	for serv in list(tasks):
+		if serv not in targets:
+			tasks.pop(serv).cancel()
+			registry.remove(target_key(serv, waf))
+			funct.logging("localhost", " Master stopped metrics collector for: "+serv, metrics=1)
+
+	for serv in targets:
+		if serv in tasks and tasks[serv].done():
+			error = tasks.pop(serv).exception()
+			funct.logging("localhost", " Metrics collector for "+serv+" died: "+str(error), metrics=1)
+		if serv not in tasks:
+			tasks[serv] = asyncio.ensure_future(collector(serv, port, semaphore, buffer, waf=waf))
+			funct.logging("localhost", " Master started new metrics collector for: "+serv, metrics=1)
+
+
+async def main(killer):
+	global registry
+	loop = asyncio.get_event_loop()
+	registry = daemons.Registry('metrics_master')
+	semaphore = asyncio.Semaphore(max_concurrency)
 	port = sql.get_setting('haproxy_sock_port')
-	cmd = "tools/metrics_waf_worker.py %s --port %s &" % (serv, port)
-	os.system(cmd)
-	funct.logging("localhost", " Masrer started new WAF metrics worker for: "+serv, metrics=1)
-	
-def kill_waf_worker(serv):
-	cmd = "ps ax |grep 'tools/metrics_waf_worker.py %s'|grep -v grep |awk '{print $1}' |xargs kill" % serv
-	output, stderr = funct.subprocess_execute(cmd)
-	funct.logging("localhost", " Masrer killed WAF metrics worker for: "+serv, metrics=1)
-	if stderr:
-		funct.logging("localhost", stderr, metrics=1)
-
-def kill_all_workers():
-	cmd = "ps ax |grep -e 'tools/metrics_worker.py\|tools/metrics_waf_worker.py' |grep -v grep |awk '{print $1}' |xargs kill"
-	output, stderr = funct.subprocess_execute(cmd)
-	funct.logging("localhost", " Masrer killing all metrics workers", metrics=1)
-	if stderr:
-		funct.logging("localhost", stderr, metrics=1)
-		
-def get_worker():
-	cmd = "ps ax |grep 'tools/metrics_worker.py' |grep -v grep |awk '{print $7}'"
-	output, stderr = funct.subprocess_execute(cmd)
-	if stderr:
-		funct.logging("localhost", stderr, metrics=1)
-	return output
-	
-def get_waf_worker():
-	cmd = "ps ax |grep 'tools/metrics_waf_worker.py' |grep -v grep |awk '{print $7}'"
-	output, stderr = funct.subprocess_execute(cmd)
-	if stderr:
-		funct.logging("localhost", stderr, metrics=1)
-	return output
-	
+	log_path = funct.get_config_var('main', 'log_path')
+	buffer = MetricsBuffer(sql.insert_mentrics_many, log_path + '/metrics-spill.json')
+	waf_buffer = MetricsBuffer(sql.insert_waf_mentrics_many, log_path + '/waf-metrics-spill.json')
+	flushers = [asyncio.ensure_future(buffer.run()), asyncio.ensure_future(waf_buffer.run())]
+	tasks = {}
+	waf_tasks = {}
+	pruned = 0
+
+	while not killer.kill_now:
+		if time.time() - pruned > prune_interval:
+			await loop.run_in_executor(None, sql.delete_mentrics)
+			await loop.run_in_executor(None, sql.delete_waf_mentrics)
+			await loop.run_in_executor(None, sql.delete_metrics_rollup)
+			await loop.run_in_executor(None, tsdb.prune)
+			pruned = time.time()
+
+		servers = await loop.run_in_executor(None, sql.select_servers_metrics_for_master)
+		reconcile(tasks, set(serv[0] for serv in servers), port, semaphore, buffer)
+
+		try:
+			waf_servers = await loop.run_in_executor(None, sql.select_all_waf_servers)
+			reconcile(waf_tasks, set(serv[0] for serv in waf_servers), port, semaphore, waf_buffer, waf=True)
+		except Exception as e:
+			funct.logging("localhost", 'Problems with WAF metrics collectors '+str(e), metrics=1)
+
+		for i in range(reconcile_interval):
+			if killer.kill_now:
+				break
+			registry.publish()
+			await asyncio.sleep(1)
+
+	for task in list(tasks.values()) + list(waf_tasks.values()) + flushers:
+		task.cancel()
+	await asyncio.gather(*tasks.values(), *waf_tasks.values(), *flushers, return_exceptions=True)
+	await buffer.flush()
+	await waf_buffer.flush()
+	registry.close()
+
+
 if __name__ == "__main__":
 	funct.logging("localhost", " Metrics master started", metrics=1)
 	killer = GracefulKiller()
-	
-	while True:
-		main()
-		time.sleep(20)
-		
-		if killer.kill_now:
-			break
-			
-	kill_all_workers()
-	funct.logging("localhost", " Master shutdown", metrics=1)
\ No newline at end of file
+
+	ioloop = asyncio.get_event_loop()
+	ioloop.run_until_complete(main(killer))
+	ioloop.close()
+
+	funct.logging("localhost", " Master shutdown", metrics=1)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-"
+import os
+import mmap
+import array
+import bisect
+import shutil
+import time
+
+# Every series is stored per server and tier as segment directories that
+# hold one append-only file of fixed-width unsigned ints per column.
+kinds = {
+	'metrics': (('curr_con', 'avg'), ('cur_ssl_con', 'avg'), ('sess_rate', 'avg'), ('max_sess_rate', 'max')),
+	'waf_metrics': (('conn', 'avg'),),
+}
+# step, retention, segment span
+tiers = (
+	(0, 3*86400, 86400),
+	(300, 30*86400, 7*86400),
+	(3600, 365*86400, 30*86400),
+)
+typecode = 'I'
+itemsize = array.array(typecode).itemsize
+pending = {}
+path = None
+
+
+def get_path():
+	global path
+	if path is None:
+		import funct
+		path = os.path.join(funct.get_config_var('main', 'fullpath'), 'metrics')
+	return path
+
+
+def get_tier(step):
+	for tier in tiers:
+		if tier[0] == int(step):
+			return tier
+	raise ValueError('Unknown tier step: %s' % step)
+
+
+def get_columns(kind):
+	return ('ts',) + tuple(column for column, agg in kinds[kind])
+
+
+def series_dir(kind, serv, step):
+	return os.path.join(get_path(), kind, serv.replace('/', '_'), str(step))
+
+
+def segments(kind, serv, step):
+	try:
+		return sorted(int(s) for s in os.listdir(series_dir(kind, serv, step)) if s.isdigit())
+	except OSError:
+		return []
+
+
+def to_uint(value):
+	try:
+		return min(max(int(float(value)), 0), 2**32 - 1)
+	except (TypeError, ValueError):
+		return 0
+
+
+def last_ts(path, size):
+	if not size:
+		return None
+	with open(path, 'rb') as f:
+		f.seek(size - itemsize)
+		return array.array(typecode, f.read(itemsize))[0]
+
+
+def append_segment(segment, columns, rows):
+	os.makedirs(segment, exist_ok=True)
+	files = [os.path.join(segment, column) for column in columns]
+	sizes = [os.path.getsize(f) if os.path.exists(f) else 0 for f in files]
+	size = min(sizes) // itemsize * itemsize
+
+	# Reads bisect on ts, rows at or before the last stored one (a replayed batch) are dropped
+	last = last_ts(files[0], size)
+	if last is not None:
+		rows = [row for row in rows if to_uint(row[0]) > last]
+	if not rows:
+		return
+
+	for i, f in enumerate(files):
+		with open(f, 'ab') as column:
+			# Drop a partial tail left by an interrupted append, so all columns stay aligned
+			if sizes[i] != size:
+				column.truncate(size)
+			array.array(typecode, [to_uint(row[i]) for row in rows]).tofile(column)
+
+
+def write(kind, serv, step, rows):
+	span = get_tier(step)[2]
+	columns = get_columns(kind)
+	by_segment = {}
+	for row in sorted(rows, key=lambda row: row[0]):
+		by_segment.setdefault(row[0] // span * span, []).append(row)
+
+	for start, segment_rows in sorted(by_segment.items()):
+		append_segment(os.path.join(series_dir(kind, serv, step), str(start)), columns, segment_rows)
+
+
+def read_segment(segment, columns, since, until):
+	files = []
+	maps = []
+	try:
+		for column in columns:
+			files.append(open(os.path.join(segment, column), 'rb'))
+		length = min(os.fstat(f.fileno()).st_size for f in files) // itemsize
+		if not length:
+			return []
+		for f in files:
+			maps.append(mmap.mmap(f.fileno(), length * itemsize, access=mmap.ACCESS_READ))
+		views = [memoryview(m).cast(typecode) for m in maps]
+		try:
+			lo = bisect.bisect_left(views[0], since)
+			hi = bisect.bisect_left(views[0], until)
+			return list(zip(*[view[lo:hi].tolist() for view in views]))
+		finally:
+			for view in views:
+				view.release()
+	except OSError:
+		return []
+	finally:
+		for m in maps:
+			m.close()
+		for f in files:
+			f.close()
+
+
+def read(kind, serv, since, until=None, step=0):
+	"""
+	Return (ts, column, ...) rows of a series with since <= ts < until
+	"""
+	if until is None:
+		until = 2**32 - 1
+	span = get_tier(step)[2]
+	columns = get_columns(kind)
+	rows = []
+	for start in segments(kind, serv, step):
+		if start + span > since and start < until:
+			rows += read_segment(os.path.join(series_dir(kind, serv, step), str(start)), columns, since, until)
+
+	return rows
+
+
+def last(kind, serv, count, step=0):
+	columns = get_columns(kind)
+	rows = []
+	for start in reversed(segments(kind, serv, step)):
+		rows = read_segment(os.path.join(series_dir(kind, serv, step), str(start)), columns, 0, 2**32 - 1) + rows
+		if len(rows) >= count:
+			break
+
+	return rows[-count:]
+
+
+def aggregate(kind, start, rows):
+	values = [start]
+	for i, (column, agg) in enumerate(kinds[kind], 1):
+		column_values = [row[i] for row in rows]
+		if agg == 'max':
+			values.append(max(column_values))
+		else:
+			values.append(int(round(sum(column_values) / len(column_values))))
+
+	return tuple(values)
+
+
+def downsample(kind, serv, ts):
+	"""
+	Close every bucket of the downsampled tiers that ended before ts. Each tier
+	is built from the one below it, so 1-hour points are averaged 5-minute points.
+	"""
+	source = 0
+	for step, retention, span in tiers[1:]:
+		bucket = ts // step * step
+		key = (kind, serv, step)
+		if key not in pending:
+			done = last(kind, serv, 1, step=step)
+			pending[key] = done[0][0] + step if done else bucket
+		if pending[key] < bucket:
+			buckets = {}
+			for row in read(kind, serv, pending[key], bucket, step=source):
+				buckets.setdefault(row[0] // step * step, []).append(row)
+			write(kind, serv, step, [aggregate(kind, start, rows) for start, rows in sorted(buckets.items())])
+			pending[key] = bucket
+		source = step
+
+
+def insert(kind, serv, rows):
+	"""
+	Append raw (ts, column, ...) samples of one server, ordered by ts
+	"""
+	if not rows:
+		return
+	write(kind, serv, 0, rows)
+	downsample(kind, serv, rows[-1][0])
+
+
+def prune(now=None):
+	if now is None:
+		now = int(time.time())
+	for kind in kinds:
+		try:
+			servers = os.listdir(os.path.join(get_path(), kind))
+		except OSError:
+			continue
+		for serv in servers:
+			for step, retention, span in tiers:
+				for start in segments(kind, serv, step):
+					if start + span < now - retention:
+						shutil.rmtree(os.path.join(series_dir(kind, serv, step), str(start)), ignore_errors=True)
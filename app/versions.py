@@ -4,8 +4,8 @@ import cgi
 import os
 import funct, sql
 import glob
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('delver.html')
 
 print('Content-type: text/html\n')
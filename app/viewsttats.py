@@ -3,8 +3,8 @@ import http.cookies, os
 import cgi
 import funct
 import sql
-from jinja2 import Environment, FileSystemLoader
-env = Environment(loader=FileSystemLoader('templates/'))
+from jinja2 import FileSystemLoader
+env = funct.get_env(loader=FileSystemLoader('templates/'))
 template = env.get_template('viewstats.html')
 form = funct.form
 serv = form.getvalue('serv') 
@@ -151,5 +151,20 @@ function loadMetrics() {
         }
     });
 }
-
-
+function loadLogAnalytics(server) {
+	$.ajax({
+		url: "options.py",
+		data: {
+			log_analytics: '1',
+			server: server,
+			token: $('#token').val()
+		},
+		beforeSend: function() {
+			$('#log_analytics_'+server.replace(/\./g, '_')).html('<img class="loading_full_page" src="/inc/images/loading.gif" />')
+		},
+		type: "POST",
+		success: function (data) {
+			$('#log_analytics_'+server.replace(/\./g, '_')).html(data);
+		}
+	});
+}
@@ -36,7 +36,7 @@ window.onblur= function() {
 	window.onfocus= function () {
 		if(Cookies.get('auto-refresh-pause') == "0" && Cookies.get('auto-refresh') > 5000) {
 			if (cur_url[0] == "logs.py") {
-				showLog();
+				tailLog();
 			} else if (cur_url[0] == "viewsttats.py") {
 				showStats()
 			} else if (cur_url[0] == "overview.py") {
@@ -125,7 +125,7 @@ function setRefreshInterval(interval) {
 function startSetInterval(interval) {	
 	if(Cookies.get('auto-refresh-pause') == "0") {
 		if (cur_url[0] == "logs.py") {
-			intervalId = setInterval('showLog()', interval);
+			intervalId = setInterval('tailLog()', interval);
 			showLog();
 		} else if (cur_url[0] == "viewsttats.py") {
 			intervalId = setInterval('showStats()', interval);
@@ -345,6 +345,7 @@ function showLog() {
 		type: "POST",
 		success: function( data ) {
 			$("#ajax").html(data);
+			startLogTail();
 			window.history.pushState("Logs", "Logs", cur_url[0]+"?serv="+$("#serv").val()+
 																	'&rows='+rows+
 																	'&grep='+grep+
@@ -356,6 +357,76 @@ function showLog() {
 		}					
 	} );
 }
+var logTail = null;
+function logTailKey() {
+	var log = 'haproxy';
+	if ($('#waf').is(':checked')) {
+		log = 'waf';
+	}
+	return {
+		serv: $("#serv").val(),
+		log: log,
+		grep: $('#grep').val(),
+		rows: $('#rows').val(),
+		hour1: $('#time_range_out_hour1').val()
+	}
+}
+function startLogTail() {
+	var key = logTailKey();
+	logTail = null;
+	$.ajax( {
+		url: "options.py",
+		data: {
+			tail_log: key.log,
+			serv: key.serv,
+			start: 1,
+			token: $('#token').val()
+		},
+		type: "POST",
+		dataType: "json",
+		success: function( data ) {
+			if (!data.error) {
+				logTail = $.extend(key, {inode: data.inode, offset: data.offset, count: 0});
+			}
+		}
+	} );
+}
+function tailLog() {
+	// Auto-refresh only fetches the lines appended since the last call, the full
+	// search runs again when the form changed, the log rotated or the rows are filled
+	var key = logTailKey();
+	if (logTail == null || logTail.serv != key.serv || logTail.log != key.log || logTail.grep != key.grep || 
+		logTail.rows != key.rows || (key.hour1 && key.hour1 != '24')) {
+		showLog();
+		return;
+	}
+	$.ajax( {
+		url: "options.py",
+		data: {
+			tail_log: key.log,
+			serv: key.serv,
+			grep: key.grep,
+			inode: logTail.inode,
+			offset: logTail.offset,
+			token: $('#token').val()
+		},
+		type: "POST",
+		dataType: "json",
+		success: function( data ) {
+			if (data.error || data.rotated || logTail == null || logTail.count + data.count > key.rows) {
+				showLog();
+				return;
+			}
+			logTail.inode = data.inode;
+			logTail.offset = data.offset;
+			logTail.count += data.count;
+			$("#ajax").append(data.lines);
+		},
+		error: function() {
+			showLog();
+		}
+	} );
+}
 function showMap() {
 	$("#ajax").empty();
 	$("#ajax-compare").empty();